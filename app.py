@@ -1,9 +1,9 @@
 import os
 import json
-from flask import Flask, request, redirect, session, url_for, render_template
+import time
+from flask import Flask, request, redirect, session, url_for, render_template, jsonify, Response
 from google_auth_oauthlib.flow import Flow
 from google.oauth2.credentials import Credentials
-from googleapiclient.discovery import build
 
 # --- Main Application Setup ---
 app = Flask(__name__)
@@ -20,31 +20,51 @@ SCOPES = [
     'openid'
 ]
 
-# --- Drive Copy Logic (Adapted from main.py) ---
-import json
-import time
-from datetime import datetime
-from googleapiclient.errors import HttpError
-
-PROGRESS_FILE = 'copy_progress.json'
-FAILED_LOG_FILE = 'failed_files.log'
-
-def load_progress():
-    """Loads the progress from a JSON file."""
-    if os.path.exists(PROGRESS_FILE):
-        with open(PROGRESS_FILE, 'r') as f:
-            return json.load(f)
-    return {'folder_map': {}, 'copied_files': []}
-
-def save_progress(progress):
-    """Saves the current progress to a JSON file."""
-    with open(PROGRESS_FILE, 'w') as f:
-        json.dump(progress, f, indent=4)
-
-def log_failure(path, error):
-    """Logs a failed file or folder operation to the log file."""
-    with open(FAILED_LOG_FILE, 'a') as f:
-        f.write(f"[{datetime.now().isoformat()}] Path: {path} | Error: {str(error)}\n")
+# --- Drive Copy Logic (shared with main.py) ---
+from drive_client import drive_service
+from drive_copy import DEFAULT_WORKERS, clamp_workers, log_failure
+from jobs import (create_job, get_failures, get_job, get_job_events, get_verification, is_finished, list_jobs,
+                  plan_job, resume_jobs, retry_job, shutdown, verify_job)
+import metrics
+from rate_limiter import all_limiters
+from structured_log import configure_logging, get_logger
+from transfer import DEFAULT_EXPORT_FORMAT, EXPORT_FORMAT_NAMES
+
+# Seconds between coalesced progress updates pushed to a browser.
+PROGRESS_STREAM_INTERVAL = 1.0
+# Seconds one progress stream stays open, well inside a gunicorn worker's timeout;
+# the browser then reconnects, after PROGRESS_STREAM_RETRY_MS, from the last update it got.
+PROGRESS_STREAM_SECONDS = 20
+PROGRESS_STREAM_RETRY_MS = 1000
+
+configure_logging()
+log = get_logger('app')
+
+def lookup_account(credentials):
+    """Returns the Drive account of session-stored credentials as {'id', 'email'}."""
+    with drive_service(Credentials(**credentials)) as service:
+        about = service.about().get(fields='user(emailAddress,permissionId)').execute()
+    # permissionId is stable for the account, unlike the session or its tokens
+    return {'id': about['user']['permissionId'], 'email': about['user']['emailAddress']}
+
+def current_account():
+    """Returns the signed-in Drive account as {'id', 'email'}, looked up once per session."""
+    if 'account' not in session:
+        session['account'] = lookup_account(session['credentials'])
+    return session['account']
+
+def add_identity(credentials):
+    """
+    Adds another account the user signed in with to the session's identities,
+    whose quota their forks share; returns its email, or None if it's the
+    signed-in account or already added.
+    """
+    email = lookup_account(credentials)['email']
+    identities = session.get('identities', [])
+    if email == current_account()['email'] or any(identity['email'] == email for identity in identities):
+        return None
+    session['identities'] = identities + [{'email': email, 'credentials': credentials}]
+    return email
 
 def extract_folder_id(url_or_id):
     """Extract folder ID from Google Drive URL or return the ID if already provided."""
@@ -54,150 +74,66 @@ def extract_folder_id(url_or_id):
             return url_or_id.split('/folders/')[1].split('?')[0].split('/')[0]
     return url_or_id.strip()
 
-def copy_folder_contents(service, source_folder_id, dest_folder_id, progress, path=""):
-    """Recursively copies files and folders with progress tracking."""
-    if source_folder_id not in progress['folder_map']:
-        progress['folder_map'][source_folder_id] = dest_folder_id
-        save_progress(progress)
-    
-    page_token = None
-    while True:
-        try:
-            response = service.files().list(
-                q=f"'{source_folder_id}' in parents and trashed=false",
-                fields="nextPageToken, files(id, name, mimeType)",
-                pageToken=page_token,
-                pageSize=100
-            ).execute()
-        except HttpError as e:
-            print(f"ERROR: Could not list files in folder ID '{source_folder_id}': {e}")
-            log_failure(f"{path}/<folder_listing_failed>", e)
-            return
-
-        items = response.get('files', [])
-        
-        for item in items:
-            item_id = item['id']
-            item_name = item['name']
-            item_type = item['mimeType']
-            current_path = os.path.join(path, item_name)
-
-            if item_type == 'application/vnd.google-apps.folder':
-                # Handle folders
-                new_dest_folder_id = None
-                if item_id in progress['folder_map']:
-                    print(f"SKIPPING: Folder already exists - {current_path}")
-                    new_dest_folder_id = progress['folder_map'][item_id]
-                else:
-                    print(f"CREATING: Folder - {current_path}")
-                    folder_metadata = {
-                        'name': item_name,
-                        'mimeType': 'application/vnd.google-apps.folder',
-                        'parents': [dest_folder_id]
-                    }
-                    try:
-                        new_folder = service.files().create(body=folder_metadata, fields='id').execute()
-                        new_dest_folder_id = new_folder['id']
-                        progress['folder_map'][item_id] = new_dest_folder_id
-                        save_progress(progress)
-                    except HttpError as e:
-                        print(f"ERROR: Failed to create folder '{current_path}': {e}")
-                        log_failure(current_path, e)
-                        continue
-                
-                copy_folder_contents(service, item_id, new_dest_folder_id, progress, current_path)
-
-            else:
-                # Handle files
-                if item_id in progress['copied_files']:
-                    print(f"SKIPPING: File already copied - {current_path}")
-                    continue
-
-                print(f"COPYING: File - {current_path}")
-                file_metadata = {'parents': [dest_folder_id]}
-                
-                retries = 3
-                for i in range(retries):
-                    try:
-                        service.files().copy(fileId=item_id, body=file_metadata).execute()
-                        progress['copied_files'].append(item_id)
-                        save_progress(progress)
-                        print(f"SUCCESS: Copied - {current_path}")
-                        break
-                    except HttpError as e:
-                        error_reason = json.loads(e.content).get('error', {}).get('errors', [{}])[0].get('reason', 'unknown')
-                        if error_reason in ['userRateLimitExceeded', 'rateLimitExceeded']:
-                            wait_time = (2 ** i) + 1
-                            print(f"RATE LIMIT: Waiting {wait_time}s before retry ({i+1}/{retries})")
-                            time.sleep(wait_time)
-                        elif error_reason == 'cannotCopyFile':
-                            print(f"SKIPPED: File not copyable - {current_path}")
-                            log_failure(current_path, f"Permission error: {error_reason}")
-                            break
-                        else:
-                            print(f"ERROR: Failed to copy file '{current_path}': {e}")
-                            log_failure(current_path, e)
-                            break
-
-        page_token = response.get('nextPageToken')
-        if not page_token:
-            break
-
 
 # --- Flask Routes ---
 
 @app.route('/')
 def index():
     try:
-        print("Index route called")  # Debug output
         # If a user's credentials are not in the session, show the login page
         if 'credentials' not in session:
-            print("User not logged in")  # Debug output
+            log.debug("Index: user not logged in")
             return render_template('index.html', logged_in=False)
         
         # If the user is logged in, show the main application page
-        print("User logged in")  # Debug output
-        return render_template('index.html', logged_in=True)
+        log.debug("Index: user logged in")
+        return render_template('index.html', logged_in=True,
+                               identities=[identity['email'] for identity in session.get('identities', [])])
     except Exception as e:
-        print(f"Error in index route: {e}")  # Debug output
+        log.exception("Index route failed")
         return f"Template Error: {e}"
 
 @app.route('/login')
 def login():
     try:
-        print("OAUTH: Starting authentication process...")
+        log.info("OAuth: starting authentication")
         # Create a Flow instance to manage the OAuth 2.0 Authorization Grant Flow.
         flow = Flow.from_client_secrets_file(
             CLIENT_SECRETS_FILE,
             scopes=SCOPES,
             redirect_uri=url_for('callback', _external=True)
         )
-        print(f"OAUTH: Redirect URI configured - {url_for('callback', _external=True)}")
+        log.debug("OAuth: redirect URI configured", extra={'redirect_uri': url_for('callback', _external=True)})
         
+        # Adding an account to the signed-in one: let the user pick another Google account.
+        adding = 'credentials' in session and request.args.get('add') == '1'
+        prompt = {'prompt': 'select_account consent'} if adding else {}
+
         # Generate the URL that the user will be sent to for authorization.
         authorization_url, state = flow.authorization_url(
             access_type='offline', 
-            include_granted_scopes='true'
+            include_granted_scopes='true',
+            **prompt
         )
         
         # Store the state in the session so we can verify it in the callback
         session['state'] = state
-        print(f"OAUTH: Generated authorization URL - {authorization_url}")
-        print(f"OAUTH: Redirecting user to Google authentication...")
+        session['adding_identity'] = adding
+        log.debug("OAuth: redirecting to Google", extra={'authorization_url': authorization_url})
         
         return redirect(authorization_url)
     except Exception as e:
-        print(f"OAUTH ERROR: Login failed - {e}")
+        log.exception("OAuth: login failed")
         return f"Login Error: {str(e)}", 500
 
 @app.route('/callback')
 def callback():
     try:
-        print("OAUTH: Processing authentication callback...")
+        log.debug("OAuth: processing callback")
         
         # Check if we have a state in session
         if 'state' not in session:
-            print("OAUTH ERROR: No state found in session")
+            log.warning("OAuth: no state found in session")
             return "OAuth Error: No state found in session", 400
             
         # Verify that the state from the session matches the state from the request.
@@ -206,7 +142,7 @@ def callback():
         # Check for error in the callback
         if 'error' in request.args:
             error = request.args.get('error')
-            print(f"OAUTH ERROR: Authentication failed - {error}")
+            log.warning("OAuth: authentication failed", extra={'error': error})
             return f"OAuth Error: {error}", 400
         
         flow = Flow.from_client_secrets_file(
@@ -218,14 +154,12 @@ def callback():
 
         # Use the authorization server's response to fetch the OAuth 2.0 tokens.
         authorization_response = request.url
-        print(f"OAUTH: Processing authorization response - {authorization_response}")
-        
+        # Not logged: the response URL carries the authorization code.
         flow.fetch_token(authorization_response=authorization_response)
-        print("OAUTH: Successfully obtained access tokens")
+        log.debug("OAuth: obtained access tokens")
 
-        # Store the credentials in the session.
         credentials = flow.credentials
-        session['credentials'] = {
+        credentials = {
             'token': credentials.token,
             'refresh_token': credentials.refresh_token,
             'token_uri': credentials.token_uri,
@@ -233,14 +167,31 @@ def callback():
             'client_secret': credentials.client_secret,
             'scopes': credentials.scopes
         }
-        
-        print("OAUTH: Authentication completed successfully")
+        if session.pop('adding_identity', False) and 'credentials' in session:
+            email = add_identity(credentials)
+            log.info("OAuth: account added", extra={'email': email, 'added': email is not None})
+            return redirect(url_for('index'))
+
+        # Store the credentials in the session.
+        session['credentials'] = credentials
+        session.pop('account', None)
+        session.pop('identities', None)
+        log.info("OAuth: signed in", extra={'email': current_account()['email']})
         return redirect(url_for('index'))
         
     except Exception as e:
-        print(f"OAUTH ERROR: Callback processing failed - {e}")
+        log.exception("OAuth: callback failed")
         return f"OAuth Callback Error: {str(e)}", 500
 
+@app.route('/identities/remove', methods=['POST'])
+def remove_identity():
+    """Stops spreading new forks over an added account"""
+    if 'credentials' not in session:
+        return 'User not authenticated', 401
+    email = request.form.get('email')
+    session['identities'] = [identity for identity in session.get('identities', []) if identity['email'] != email]
+    return redirect(url_for('index'))
+
 @app.route('/logout')
 def logout():
     session.clear()  # Clear entire session including credentials and state
@@ -426,35 +377,182 @@ def debug_oauth():
     except Exception as e:
         return f"Debug Error: {str(e)}"
 
+@app.route('/rate-limit')
+def rate_limit():
+    """Current request rate and throttle counts of each user's Drive rate limiter, by opaque label"""
+    return jsonify(all_limiters())
+
+@app.route('/metrics')
+def prometheus_metrics():
+    """Drive API latency, status and retry counts, copy throughput and queue depths for Prometheus"""
+    return Response(metrics.render(), content_type=metrics.CONTENT_TYPE)
+
+@app.route('/jobs')
+def jobs():
+    """Status of the signed-in account's fork jobs"""
+    if 'credentials' not in session:
+        return 'User not authenticated', 401
+    return jsonify(list_jobs(current_account()['id']))
+
+@app.route('/jobs/<job_id>')
+def job_status(job_id):
+    """Status and counts of one fork job"""
+    if 'credentials' not in session:
+        return 'User not authenticated', 401
+    job = get_job(job_id, current_account()['id'])
+    if job is None:
+        return jsonify({'error': 'Unknown job'}), 404
+    return jsonify(job)
+
+@app.route('/jobs/<job_id>/failures')
+def job_failures(job_id):
+    """Failure queue of one fork job: item, destination folder, reason, attempts and whether it is permanent"""
+    if 'credentials' not in session:
+        return 'User not authenticated', 401
+    if get_job(job_id, current_account()['id']) is None:
+        return jsonify({'error': 'Unknown job'}), 404
+    return jsonify(get_failures(job_id))
+
+@app.route('/jobs/<job_id>/retry', methods=['POST'])
+def job_retry(job_id):
+    """Queues a retry pass over a finished job's failures; `reason` also retries permanent ones with that reason"""
+    if 'credentials' not in session:
+        return 'User not authenticated', 401
+    if get_job(job_id, current_account()['id']) is None:
+        return jsonify({'error': 'Unknown job'}), 404
+    reason = request.form.get('reason') or None
+    if not retry_job(job_id, session['credentials'], reason, session.get('identities')):
+        return jsonify({'error': 'The job is still queued or running'}), 409
+    log.info("Retry queued", extra={'job_id': job_id, 'reason': reason})
+    return jsonify({'job_id': job_id}), 202
+
+@app.route('/jobs/<job_id>/verify', methods=['POST'])
+def job_verify(job_id):
+    """Queues a pass comparing a finished job's copy with its source, folder by folder"""
+    if 'credentials' not in session:
+        return 'User not authenticated', 401
+    if get_job(job_id, current_account()['id']) is None:
+        return jsonify({'error': 'Unknown job'}), 404
+    if not verify_job(job_id, session['credentials'], session.get('identities')):
+        return jsonify({'error': 'The job is still queued or running'}), 409
+    log.info("Verification queued", extra={'job_id': job_id})
+    return jsonify({'job_id': job_id}), 202
+
+@app.route('/jobs/<job_id>/verification')
+def job_verification(job_id):
+    """A job's verification report, streamed as one JSON line per missing, extra, mismatched or unlisted item"""
+    if 'credentials' not in session:
+        return 'User not authenticated', 401
+    if get_job(job_id, current_account()['id']) is None:
+        return jsonify({'error': 'Unknown job'}), 404
+    problems = get_verification(job_id)
+    if problems is None:
+        return jsonify({'error': 'The job has not been verified'}), 404
+    return Response((json.dumps(problem) + '\n' for problem in problems), mimetype='application/x-ndjson')
+
+@app.route('/jobs/<job_id>/events')
+def job_events(job_id):
+    """
+    Server-Sent Events stream of a job's progress, one coalesced update per interval.
+    Each stream closes after PROGRESS_STREAM_SECONDS; EventSource reconnects with the
+    last update's ID in Last-Event-ID and gets only the item events after it.
+    """
+    if 'credentials' not in session:
+        return 'User not authenticated', 401
+    if get_job(job_id, current_account()['id']) is None:
+        return jsonify({'error': 'Unknown job'}), 404
+    last_seq = request.headers.get('Last-Event-ID', 0, type=int)
+
+    def stream():
+        seq = last_seq
+        deadline = time.monotonic() + PROGRESS_STREAM_SECONDS
+        yield f"retry: {PROGRESS_STREAM_RETRY_MS}\n\n"
+        while True:
+            job = get_job(job_id)
+            events = get_job_events(job_id)
+            if events is not None:
+                update = events.update(seq)
+                seq = update['seq']
+            else:
+                # Not running in this process: fall back to the job's heartbeat counts.
+                update = {'counts': {'copied': job['counts']['copied_files'],
+                                     'folder_created': job['counts']['created_folders'],
+                                     'failed': job['failures']},
+                          'events': []}
+            update['status'] = job['status']
+            yield f"event: progress\nid: {seq}\ndata: {json.dumps(update)}\n\n"
+            if is_finished(job):
+                done = {'status': job['status'], 'error': job['error'], 'verification': job.get('verification')}
+                yield f"event: done\ndata: {json.dumps(done)}\n\n"
+                return
+            if time.monotonic() + PROGRESS_STREAM_INTERVAL > deadline:
+                # Frees the worker; the browser reconnects to carry on.
+                return
+            time.sleep(PROGRESS_STREAM_INTERVAL)
+
+    return Response(stream(), mimetype='text/event-stream',
+                    headers={'Cache-Control': 'no-cache', 'X-Accel-Buffering': 'no'})
+
+@app.route('/plan', methods=['POST'])
+def plan():
+    """Queues a dry run of a fork, copying nothing; the job's `plan` holds its counts and estimates once it completes"""
+    if 'credentials' not in session:
+        return 'User not authenticated', 401
+    source_id = extract_folder_id(request.form.get('source_id', ''))
+    dest_id = extract_folder_id(request.form.get('dest_id', ''))
+    if not source_id or not dest_id:
+        return 'Both source and destination folder IDs are required', 400
+
+    # Saved with the job; /copy of the same folders then skips listing the source.
+    job_id = plan_job(session['credentials'], current_account(), source_id, dest_id,
+                      request.form.get('batch') == 'on', session.get('identities'))
+    if job_id is None:
+        return jsonify({'error': 'The fork is already queued or running'}), 409
+    log.info("Plan queued", extra={'job_id': job_id, 'source_id': source_id})
+    return jsonify({'job_id': job_id}), 202
+
 @app.route('/copy', methods=['POST'])
 def copy():
     if 'credentials' not in session:
         return 'User not authenticated', 401
 
     try:
-        # Recreate credentials object from the session data
-        creds = Credentials(**session['credentials'])
-        service = build('drive', 'v3', credentials=creds)
-
         source_id = extract_folder_id(request.form.get('source_id'))
         dest_id = extract_folder_id(request.form.get('dest_id'))
         
         if not source_id or not dest_id:
             return 'Both source and destination folder IDs are required', 400
 
-        # Load progress and start copying
-        progress = load_progress()
-        
-        print(f"\nCOPY OPERATION: Initiating folder replication...")
-        print(f"SOURCE: {source_id}")
-        print(f"DESTINATION: {dest_id}")
-        
-        # Run the copy operation
-        copy_folder_contents(service, source_id, dest_id, progress)
-        
-        # Get summary stats
-        copied_files_count = len(progress.get('copied_files', []))
-        created_folders_count = len(progress.get('folder_map', {})) - 1
+        workers = clamp_workers(request.form.get('workers', DEFAULT_WORKERS, type=int))
+        batch = request.form.get('batch') == 'on'
+        sync = request.form.get('sync') == 'on'
+        replace = sync and request.form.get('replace') == 'on'
+        dedup = request.form.get('no_dedup') != 'on'
+        transfer = request.form.get('no_transfer') != 'on'
+        export_format = request.form.get('export_format', DEFAULT_EXPORT_FORMAT)
+        if export_format not in EXPORT_FORMAT_NAMES:
+            return f"Unknown export format '{export_format}'", 400
+        corpus = request.form.get('corpus') == 'on'
+        verify = request.form.get('verify') == 'on'
+
+        # The fork runs on the job executor; this request only queues it
+        job_id = create_job(session['credentials'], current_account(), source_id, dest_id, workers, batch,
+                            sync, replace, dedup, transfer, export_format, session.get('identities'), corpus,
+                            verify)
+        log.info("Job queued", extra={'job_id': job_id, 'source_id': source_id, 'dest_id': dest_id,
+                                      'workers': workers, 'batch': batch, 'sync': sync, 'replace': replace,
+                                      'dedup': dedup, 'transfer': transfer, 'export_format': export_format,
+                                      'corpus': corpus, 'verify': verify,
+                                      'identities': len(session.get('identities', []))})
+
+        # The index page submits with fetch and follows the job over /jobs/<id>/events
+        if request.accept_mimetypes.best == 'application/json':
+            return jsonify({'job_id': job_id}), 202
+        
+        if verify:
+            verification = f'<a href="/jobs/{job_id}/verification">/jobs/{job_id}/verification</a> once the copy is done'
+        else:
+            verification = f'POST /jobs/{job_id}/verify to compare the copy with the source once it is done'
         
         result_html = f"""
         <!DOCTYPE html>
@@ -462,7 +560,7 @@ def copy():
         <head>
             <meta charset="UTF-8">
             <meta name="viewport" content="width=device-width, initial-scale=1.0">
-            <title>Operation Complete - Drive Forker</title>
+            <title>Operation Started - Drive Forker</title>
             <style>
                 body {{ font-family: -apple-system, BlinkMacSystemFont, "Segoe UI", Roboto, "Helvetica Neue", Arial, sans-serif; background: #f8f9fa; margin: 0; padding: 20px; }}
                 .container {{ max-width: 700px; margin: 50px auto; background: white; border-radius: 8px; box-shadow: 0 2px 10px rgba(0,0,0,0.1); border: 1px solid #e9ecef; }}
@@ -484,15 +582,17 @@ def copy():
         <body>
             <div class="container">
                 <div class="header">
-                    <h1>Operation Completed Successfully</h1>
-                    <p>Folder replication process has finished</p>
+                    <h1>Operation Started</h1>
+                    <p>Folder replication is running in the background</p>
                 </div>
                 <div class="content">
                     <div class="summary">
                         <h3>Operation Summary</h3>
                         <ul>
-                            <li><span class="metric">Files Processed:</span> {copied_files_count}</li>
-                            <li><span class="metric">Folders Created:</span> {created_folders_count}</li>
+                            <li><span class="metric">Job ID:</span> {job_id}</li>
+                            <li><span class="metric">Status:</span> <a href="/jobs/{job_id}">/jobs/{job_id}</a></li>
+                            <li><span class="metric">Failures:</span> <a href="/jobs/{job_id}/failures">/jobs/{job_id}/failures</a></li>
+                            <li><span class="metric">Verification:</span> {verification}</li>
                         </ul>
                     </div>
                     
@@ -502,7 +602,7 @@ def copy():
                         <p><strong>Destination Location:</strong> {dest_id}</p>
                     </div>
                     
-                    {'<div class="warning"><h3>Processing Notice</h3><p>Some items could not be processed due to permissions or other restrictions. Please review the error log for detailed information.</p></div>' if os.path.exists(FAILED_LOG_FILE) else '<div class="success"><h3>Complete Success</h3><p>All items have been successfully processed and copied to the destination location.</p></div>'}
+                    <div class="success"><h3>Safe to Close</h3><p>The copy continues on the server if you leave this page, and resumes from its saved progress if the server restarts.</p></div>
                     
                     <div class="actions">
                         <a href="/" class="btn">Initiate New Operation</a>
@@ -516,7 +616,7 @@ def copy():
         return result_html
 
     except Exception as e:
-        print(f"Copy operation failed: {e}")
+        log.exception("Copy operation failed")
         log_failure("COPY_OPERATION_FAILED", e)
         return f"""
         <!DOCTYPE html>
@@ -558,7 +658,15 @@ def copy():
         </html>
         """, 500
 
+# Resume fork jobs interrupted by a restart. With the debug reloader only the
+# child process (WERKZEUG_RUN_MAIN) serves requests, so the watcher skips this.
+if __name__ != '__main__' or os.environ.get('WERKZEUG_RUN_MAIN') == 'true':
+    resume_jobs()
+
 if __name__ == '__main__':
     # Allow access from other computers on your network
     # Use 0.0.0.0 to accept connections from any IP
-    app.run('localhost', 5000, debug=True)
\ No newline at end of file
+    try:
+        app.run('localhost', 5000, debug=True)
+    finally:
+        shutdown()
\ No newline at end of file
@@ -0,0 +1,290 @@
+"""
+Benchmarks a whole fork offline, against FakeDrive instead of Google Drive.
+
+Runs the CLI (main.main) and the web /copy path (app.py + jobs.py) on the same
+synthetic tree and reports files/sec, API calls and HTTP round-trips per file,
+the time to resume after an interruption, to re-sync after some files changed
+or to verify the copy against the source, and peak memory. Every scenario runs
+in its own subprocess and temporary directory, so peak RSS, the shared rate
+limiter and module state never carry over from one scenario to the next.
+
+Run with: python benchmarks/bench_fork.py [--depth 3 --width 4 --files 25 --latency 0.02 ...]
+"""
+import os
+import sys
+import json
+import time
+import argparse
+import builtins
+import tempfile
+import subprocess
+import contextlib
+
+BENCH_DIR = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, os.path.dirname(BENCH_DIR))
+sys.path.insert(0, BENCH_DIR)
+
+try:
+    import resource
+except ImportError:  # Windows: no getrusage, peak memory is not reported
+    resource = None
+
+from fake_drive import FOLDER_MIME_TYPE, FakeDrive
+
+ENTRIES = ('cli', 'app')
+PHASES = ('full', 'resume', 'resync', 'verify')
+# Seconds between job status polls on the /copy path.
+POLL_INTERVAL = 0.02
+FAKE_CREDENTIALS = {
+    'token': 'fake-token',
+    'refresh_token': None,
+    'token_uri': 'https://oauth2.googleapis.com/token',
+    'client_id': 'fake-client',
+    'client_secret': 'fake-secret',
+    'scopes': ['https://www.googleapis.com/auth/drive'],
+}
+
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(description="Benchmark a fork against a fake Drive.")
+    parser.add_argument('--depth', type=int, default=3, help="folder levels below the root")
+    parser.add_argument('--width', type=int, default=4, help="subfolders per folder")
+    parser.add_argument('--files', type=int, default=25, help="files per folder")
+    parser.add_argument('--latency', type=float, default=0.02, help="seconds per HTTP round-trip")
+    parser.add_argument('--page-size', type=int, default=1000, help="largest page the fake lists")
+    parser.add_argument('--quota', type=float, default=None, help="calls per second before rate limiting")
+    parser.add_argument('--retry-after', type=float, default=None, help="Retry-After sent when rate limited")
+    parser.add_argument('--uncopyable', type=float, default=0.0, help="fraction of files failing cannotCopyFile")
+    parser.add_argument('--workers', type=int, default=8)
+    parser.add_argument('--batch', action='store_true')
+    parser.add_argument('--corpus', action='store_true',
+                        help="put the tree in a shared drive and list it in bulk (--corpus-listing)")
+    parser.add_argument('--interrupt-at', type=float, default=0.5,
+                        help="fraction of the files copied before the resume phase's first run is stopped")
+    parser.add_argument('--modify', type=float, default=0.05,
+                        help="fraction of the files edited before the resync phase's second run")
+    parser.add_argument('--entries', default=','.join(ENTRIES), help="comma-separated: cli, app")
+    # Internal: run one scenario in this process and print its result as JSON.
+    parser.add_argument('--scenario', help=argparse.SUPPRESS)
+    return parser.parse_args(argv)
+
+
+def make_drive(args):
+    drive = FakeDrive(latency=args.latency, max_page_size=args.page_size, quota=args.quota,
+                      retry_after=args.retry_after)
+    if args.corpus:
+        drive.drive_id = 'fakeshareddrive'
+    source_id = drive.build_tree(args.depth, args.width, args.files, args.uncopyable)
+    dest_id = drive.add('destination', FOLDER_MIME_TYPE)
+    return drive, source_id, dest_id
+
+
+def interrupt_after(drive, copies, exception):
+    """Raises `exception` once, on the first traversal call after `copies` file copies."""
+    state = {'fired': False}
+
+    def hook(method):
+        if not state['fired'] and method in ('files.list', 'files.create') and drive.calls['files.copy'] >= copies:
+            state['fired'] = True
+            raise exception
+    drive.before_call = hook
+
+
+def modify_files(args, drive, source_id):
+    """Edits a fraction of the source files, as users would between two syncs."""
+    stack, files = [source_id], []
+    while stack:
+        for child_id in drive.children[stack.pop()]:
+            if drive.items[child_id]['mimeType'] == FOLDER_MIME_TYPE:
+                stack.append(child_id)
+            else:
+                files.append(child_id)
+    for file_id in files[::max(1, round(1 / args.modify))] if args.modify else []:
+        drive.modify(file_id)
+
+
+def run_cli(args, drive, source_id, dest_id, sync=False, verify=False):
+    """Runs main.main() end to end, answering its prompts with the fake folder IDs."""
+    import main
+    from google.oauth2.credentials import Credentials
+
+    main.get_credentials = lambda: Credentials(**FAKE_CREDENTIALS)
+    main.build_service = lambda *a, **kw: drive
+    answers = iter([source_id, dest_id])
+    builtins.input = lambda prompt='': next(answers)
+    sys.argv = (['main.py', '--workers', str(args.workers)] + (['--batch'] if args.batch else [])
+                + (['--corpus-listing'] if args.corpus else []) + (['--sync', '--replace'] if sync else [])
+                + (['--verify'] if verify else []))
+    start = time.perf_counter()
+    main.main()
+    return time.perf_counter() - start
+
+
+def run_app(args, drive, source_id, dest_id, client=None, sync=False):
+    """Submits the fork to /copy like the index page does and polls until the job stops."""
+    import app
+    import jobs
+    import drive_client
+
+    drive_client.build_service = lambda *a, **kw: drive
+    if client is None:
+        client = app.app.test_client()
+        with client.session_transaction() as session:
+            session['credentials'] = FAKE_CREDENTIALS
+    start = time.perf_counter()
+    response = client.post('/copy', data={'source_id': source_id, 'dest_id': dest_id,
+                                          'workers': args.workers, 'batch': 'on' if args.batch else '',
+                                          'corpus': 'on' if args.corpus else '',
+                                          'sync': 'on' if sync else '', 'replace': 'on' if sync else ''},
+                           headers={'Accept': 'application/json'})
+    job_id = response.get_json()['job_id']
+    while True:
+        job = client.get(f'/jobs/{job_id}').get_json()
+        if jobs.is_finished(job):
+            return time.perf_counter() - start, client, job
+        time.sleep(POLL_INTERVAL)
+
+
+def verify_app(client, job_id):
+    """Queues a verification pass over a finished job like POST /jobs/<id>/verify and polls until it stops."""
+    import jobs
+
+    start = time.perf_counter()
+    client.post(f'/jobs/{job_id}/verify')
+    while True:
+        job = client.get(f'/jobs/{job_id}').get_json()
+        if jobs.is_finished(job):
+            return time.perf_counter() - start, job
+        time.sleep(POLL_INTERVAL)
+
+
+def verification_problems(summary):
+    """Differences a verification pass found, from its summary."""
+    from verifier import PROBLEMS
+
+    return sum(summary[problem] for problem in PROBLEMS)
+
+
+def run_scenario(args, entry, phase):
+    """
+    Runs one entry point once (full), stopped and resumed (resume), once more
+    with --sync after some files changed (resync), or once and then verifies the
+    copy (verify); returns the last run's metrics.
+    """
+    drive, source_id, dest_id = make_drive(args)
+    folders, files = drive.tree_size(source_id)
+    result = {'entry': entry, 'phase': phase, 'files': files, 'folders': folders}
+
+    with open(os.devnull, 'w') as devnull, contextlib.redirect_stdout(devnull):
+        if entry == 'cli':
+            if phase == 'resume':
+                interrupt_after(drive, int(files * args.interrupt_at), KeyboardInterrupt())
+                run_cli(args, drive, source_id, dest_id)
+                result['copied_before_resume'] = drive.calls['files.copy']
+                drive.calls.clear()
+                drive.round_trips.clear()
+            elif phase == 'resync':
+                run_cli(args, drive, source_id, dest_id)
+                modify_files(args, drive, source_id)
+                drive.calls.clear()
+                drive.round_trips.clear()
+            elif phase == 'verify':
+                run_cli(args, drive, source_id, dest_id)
+                drive.calls.clear()
+                drive.round_trips.clear()
+            seconds = run_cli(args, drive, source_id, dest_id, sync=phase == 'resync', verify=phase == 'verify')
+            if phase == 'verify':
+                from progress_store import fork_progress_path
+                from verifier import VERIFY_REPORT
+
+                with open(fork_progress_path(source_id, dest_id, VERIFY_REPORT)) as f:
+                    result['problems'] = verification_problems(json.loads(f.readlines()[-1])['summary'])
+        else:
+            client = None
+            if phase == 'resume':
+                from drive_copy import CopyInterrupted
+                interrupt_after(drive, int(files * args.interrupt_at), CopyInterrupted('benchmark interrupt'))
+                _, client, _ = run_app(args, drive, source_id, dest_id)
+                result['copied_before_resume'] = drive.calls['files.copy']
+                drive.calls.clear()
+                drive.round_trips.clear()
+            elif phase == 'resync':
+                _, client, _ = run_app(args, drive, source_id, dest_id)
+                modify_files(args, drive, source_id)
+                drive.calls.clear()
+                drive.round_trips.clear()
+            if phase == 'verify':
+                _, client, job = run_app(args, drive, source_id, dest_id)
+                drive.calls.clear()
+                drive.round_trips.clear()
+                seconds, job = verify_app(client, job['id'])
+                result['problems'] = verification_problems(job['verification'])
+            else:
+                seconds, _, job = run_app(args, drive, source_id, dest_id, client, sync=phase == 'resync')
+            result['job_status'] = job['status']
+
+    api_calls = sum(drive.calls.values())
+    result.update({
+        'seconds': round(seconds, 3),
+        'files_per_second': round(files / seconds, 1) if phase == 'full' else None,
+        'api_calls': api_calls,
+        'copies': drive.calls['files.copy'],
+        'list_calls': drive.calls['files.list'],
+        'api_calls_per_file': round(api_calls / files, 3),
+        'round_trips_per_file': round(sum(drive.round_trips.values()) / files, 3),
+        'rate_limited': drive.errors['userRateLimitExceeded'],
+        'uncopyable': drive.errors['cannotCopyFile'],
+        'complete': drive.snapshot(source_id) == drive.snapshot(dest_id) if not args.uncopyable else None,
+        # ru_maxrss is in KiB on Linux and bytes on macOS.
+        'peak_rss_mb': (round(resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+                              / (1024 * 1024 if sys.platform == 'darwin' else 1024), 1)
+                        if resource else None),
+    })
+    return result
+
+
+def run_subprocess(argv, entry, phase):
+    """Runs a scenario in a fresh interpreter inside a scratch directory."""
+    with tempfile.TemporaryDirectory() as tmp:
+        output = subprocess.run([sys.executable, os.path.abspath(__file__), *argv, '--scenario',
+                                 f'{entry}:{phase}'], cwd=tmp, capture_output=True, text=True)
+    if output.returncode != 0:
+        raise RuntimeError(f"{entry}/{phase} failed:\n{output.stderr}")
+    return json.loads(output.stdout.strip().splitlines()[-1])
+
+
+def main():
+    argv = sys.argv[1:]
+    args = parse_args(argv)
+    if args.scenario:
+        entry, phase = args.scenario.split(':')
+        print(json.dumps(run_scenario(args, entry, phase)))
+        return
+
+    print(f"--- Fork benchmark: depth {args.depth}, width {args.width}, {args.files} files/folder, "
+          f"{args.latency * 1000:.0f} ms/round-trip, {args.workers} workers"
+          f"{', batched' if args.batch else ''}{', corpus listing' if args.corpus else ''} ---")
+    print(f"  {'entry':<5} {'phase':<7} {'files':>7} {'seconds':>8} {'files/s':>8} {'calls/file':>10} "
+          f"{'trips/file':>10} {'lists':>6} {'throttled':>9} {'peak MB':>8}")
+    for entry in args.entries.split(','):
+        for phase in PHASES:
+            r = run_subprocess(argv, entry, phase)
+            files_per_second = f"{r['files_per_second']:8.1f}" if r['files_per_second'] else f"{'-':>8}"
+            print(f"  {entry:<5} {phase:<7} {r['files']:>7} {r['seconds']:>8.2f} {files_per_second} "
+                  f"{r['api_calls_per_file']:>10.3f} {r['round_trips_per_file']:>10.3f} {r['list_calls']:>6} "
+                  f"{r['rate_limited']:>9} "
+                  f"{r['peak_rss_mb'] if r['peak_rss_mb'] is not None else '-':>8}")
+            if r['complete'] is False:
+                print(f"  WARNING: {entry}/{phase} left the destination incomplete")
+            if phase == 'resume':
+                print(f"  {'':<13} (resumed after {r['copied_before_resume']} copies)")
+            elif phase == 'resync':
+                print(f"  {'':<13} ({r['copies']} files re-copied)")
+            elif phase == 'verify':
+                print(f"  {'':<13} ({r['problems']} differences found)")
+                if r['problems'] and not args.uncopyable:
+                    print(f"  WARNING: {entry}/{phase} found differences in a complete copy")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,131 @@
+"""
+Measures the copy engine's memory as the source tree grows.
+
+Forks trees of increasing size from GeneratedDrive, which computes its listings
+and keeps nothing copied into it, so what grows is the engine's own state: the
+in-memory JSON progress store (which holds every copied ID by design) against
+the SQLite store, whose memory should stay flat however many items the tree has.
+Every run is a subprocess of its own, so peak RSS never carries over.
+
+Run with: python benchmarks/bench_memory.py [--depths 2,3,4 --width 10 --files 100 --stores json,db]
+"""
+import os
+import sys
+import json
+import time
+import argparse
+import tempfile
+import subprocess
+
+BENCH_DIR = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, os.path.dirname(BENCH_DIR))
+sys.path.insert(0, BENCH_DIR)
+
+try:
+    import resource
+except ImportError:  # Windows: no getrusage, peak memory is not reported
+    resource = None
+
+from fake_drive import GeneratedDrive
+
+STORES = {'json': 'copy_progress.json', 'db': 'copy_progress.db'}
+# The fake has no quota: the rate limiter starts wide open.
+UNLIMITED_RATE = 1e9
+FAKE_CREDENTIALS = {
+    'token': 'fake-token',
+    'refresh_token': None,
+    'token_uri': 'https://oauth2.googleapis.com/token',
+    'client_id': 'fake-client',
+    'client_secret': 'fake-secret',
+    'scopes': ['https://www.googleapis.com/auth/drive'],
+}
+
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(description="Measure a fork's memory against growing fake trees.")
+    parser.add_argument('--depths', default='2,3', help="comma-separated folder levels below the root, one run each")
+    parser.add_argument('--width', type=int, default=10, help="subfolders per folder")
+    parser.add_argument('--files', type=int, default=100, help="files per folder")
+    parser.add_argument('--workers', type=int, default=8)
+    parser.add_argument('--stores', default=','.join(STORES), help="comma-separated: json, db")
+    # Internal: run one scenario in this process and print its result as JSON.
+    parser.add_argument('--scenario', help=argparse.SUPPRESS)
+    return parser.parse_args(argv)
+
+
+def rss_mb():
+    """Peak RSS of this process so far; ru_maxrss is in KiB on Linux and bytes on macOS."""
+    if resource is None:
+        return None
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / (1024 * 1024 if sys.platform == 'darwin' else 1024)
+
+
+def run_scenario(args, store, depth):
+    """Forks a generated tree `depth` levels deep into `store` and returns its time and memory."""
+    from google.oauth2.credentials import Credentials
+
+    from drive_client import user_limiter
+    from drive_copy import fork_folder
+    from progress_store import load_progress
+    from structured_log import configure_logging
+
+    configure_logging('WARNING')
+    credentials = Credentials(**FAKE_CREDENTIALS)
+    limiter = user_limiter(credentials)
+    limiter.max_rate = UNLIMITED_RATE
+    limiter.on_success(UNLIMITED_RATE)
+    drive = GeneratedDrive(depth, args.width, args.files)
+    folders, files = drive.tree_size()
+    progress = load_progress(STORES[store])
+    baseline = rss_mb()
+    start = time.perf_counter()
+    fork_folder(drive, credentials, drive.root, drive.dest, progress, args.workers)
+    seconds = time.perf_counter() - start
+    progress.close()
+    peak = rss_mb()
+    return {
+        'store': store,
+        'folders': folders,
+        'files': files,
+        'copies': drive.calls['files.copy'],
+        'seconds': round(seconds, 2),
+        'baseline_mb': round(baseline, 1) if baseline is not None else None,
+        'peak_rss_mb': round(peak, 1) if peak is not None else None,
+    }
+
+
+def run_subprocess(argv, store, depth):
+    """Runs a scenario in a fresh interpreter inside a scratch directory."""
+    with tempfile.TemporaryDirectory() as tmp:
+        output = subprocess.run([sys.executable, os.path.abspath(__file__), *argv, '--scenario', f'{store}:{depth}'],
+                                cwd=tmp, capture_output=True, text=True)
+    if output.returncode != 0:
+        raise RuntimeError(f"{store}/depth {depth} failed:\n{output.stderr}")
+    return json.loads(output.stdout.strip().splitlines()[-1])
+
+
+def main():
+    argv = sys.argv[1:]
+    args = parse_args(argv)
+    if args.scenario:
+        store, depth = args.scenario.split(':')
+        print(json.dumps(run_scenario(args, store, int(depth))))
+        return
+
+    print(f"--- Memory benchmark: width {args.width}, {args.files} files/folder, {args.workers} workers ---")
+    print(f"  {'store':<5} {'folders':>8} {'files':>9} {'seconds':>8} {'files/s':>8} {'base MB':>8} "
+          f"{'peak MB':>8} {'growth MB':>9}")
+    for store in args.stores.split(','):
+        for depth in (int(depth) for depth in args.depths.split(',')):
+            r = run_subprocess(argv, store, depth)
+            growth = (f"{r['peak_rss_mb'] - r['baseline_mb']:>9.1f}" if r['peak_rss_mb'] is not None
+                      else f"{'-':>9}")
+            print(f"  {store:<5} {r['folders']:>8} {r['files']:>9} {r['seconds']:>8.2f} "
+                  f"{r['files'] / r['seconds']:>8.0f} {r['baseline_mb'] or '-':>8} {r['peak_rss_mb'] or '-':>8} "
+                  f"{growth}")
+            if r['copies'] != r['files']:
+                print(f"  WARNING: {store}/depth {depth} copied {r['copies']} of {r['files']} files")
+
+
+if __name__ == '__main__':
+    main()
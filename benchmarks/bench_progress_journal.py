@@ -0,0 +1,79 @@
+"""
+Measures the cost of recording progress as a job grows.
+
+Compares the old behaviour (rewriting the whole progress JSON after every item)
+with the journaled ProgressStore. Run with: python benchmarks/bench_progress_journal.py
+"""
+import os
+import sys
+import json
+import time
+import tempfile
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from progress_store import ProgressStore, load_progress
+
+WINDOW = 10000
+JOURNAL_ITEMS = 200000
+# The full-rewrite baseline is quadratic, so it only gets a short run.
+REWRITE_ITEMS = 5000
+
+
+def fake_id(n):
+    return f"1{n:032d}"
+
+
+def bench_full_rewrite(path, total):
+    """Old save_progress: re-serialize everything after every item."""
+    progress = {'folder_map': {}, 'copied_files': []}
+    rows = []
+    window = total // 5
+    start = time.perf_counter()
+    for n in range(total):
+        progress['copied_files'].append(fake_id(n))
+        with open(path, 'w') as f:
+            json.dump(progress, f, indent=4)
+        if (n + 1) % window == 0:
+            now = time.perf_counter()
+            rows.append((n + 1, (now - start) / window * 1e6))
+            start = now
+    return rows
+
+
+def bench_journal(path, total):
+    store = ProgressStore(path)
+    rows = []
+    start = time.perf_counter()
+    for n in range(total):
+        if n % 50 == 0:
+            store.add_folder(f"d{fake_id(n)}", f"e{fake_id(n)}")
+        store.add_file(fake_id(n))
+        if (n + 1) % WINDOW == 0:
+            now = time.perf_counter()
+            rows.append((n + 1, (now - start) / WINDOW * 1e6))
+            start = now
+    store.close()
+    return rows
+
+
+def main():
+    with tempfile.TemporaryDirectory() as tmp:
+        print(f"--- Full rewrite per item ({REWRITE_ITEMS} items) ---")
+        for count, per_item in bench_full_rewrite(os.path.join(tmp, 'rewrite.json'), REWRITE_ITEMS):
+            print(f"  items {count:>8}: {per_item:10.1f} us/item")
+
+        path = os.path.join(tmp, 'journal.json')
+        print(f"\n--- Journal + snapshot ({JOURNAL_ITEMS} items) ---")
+        for count, per_item in bench_journal(path, JOURNAL_ITEMS):
+            print(f"  items {count:>8}: {per_item:10.1f} us/item")
+
+        start = time.perf_counter()
+        progress = load_progress(path)
+        elapsed = time.perf_counter() - start
+        print(f"\nResume: loaded {len(progress.copied_files)} files and "
+              f"{len(progress.folder_map)} folders in {elapsed * 1000:.1f} ms")
+
+
+if __name__ == '__main__':
+    main()
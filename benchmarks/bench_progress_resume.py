@@ -0,0 +1,80 @@
+"""
+Measures resume cost on a synthetic 500k-entry progress file.
+
+Compares the old layout (indented JSON with a copied_files list, checked with a
+list scan) against the ProgressStore snapshot loaded into a set.
+Run with: python benchmarks/bench_progress_resume.py
+"""
+import os
+import sys
+import json
+import time
+import random
+import tempfile
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from progress_store import ProgressStore, load_progress
+
+ENTRIES = 500000
+FOLDERS = 10000
+LOOKUPS = 2000
+# A list scan is so slow that the old layout only gets a sample of lookups.
+LIST_LOOKUPS = 200
+
+
+def fake_id(n):
+    return f"1{n:032d}"
+
+
+def timed(fn):
+    start = time.perf_counter()
+    result = fn()
+    return result, time.perf_counter() - start
+
+
+def main():
+    file_ids = [fake_id(n) for n in range(ENTRIES)]
+    folder_map = {f"d{fake_id(n)}": f"e{fake_id(n)}" for n in range(FOLDERS)}
+    # Half hits, half misses, like a resume that is partway through the tree.
+    probes = [fake_id(random.randrange(ENTRIES * 2)) for _ in range(LOOKUPS)]
+
+    with tempfile.TemporaryDirectory() as tmp:
+        legacy_path = os.path.join(tmp, 'legacy.json')
+        with open(legacy_path, 'w') as f:
+            json.dump({'folder_map': folder_map, 'copied_files': file_ids}, f, indent=4)
+
+        store_path = os.path.join(tmp, 'store.json')
+        store = ProgressStore(store_path)
+        store.folder_map = dict(folder_map)
+        store.copied_files = set(file_ids)
+        store.compact()
+
+        print(f"--- {ENTRIES} copied files, {FOLDERS} folders ---")
+        print(f"  legacy file size:   {os.path.getsize(legacy_path) / 1e6:8.1f} MB")
+        print(f"  snapshot file size: {os.path.getsize(store_path) / 1e6:8.1f} MB")
+
+        def load_legacy():
+            with open(legacy_path) as f:
+                return json.load(f)
+
+        legacy, legacy_load = timed(load_legacy)
+        print(f"\n  legacy load:         {legacy_load * 1000:8.1f} ms")
+        progress, store_load = timed(lambda: load_progress(store_path))
+        print(f"  snapshot load:       {store_load * 1000:8.1f} ms")
+        converted, convert_load = timed(lambda: load_progress(legacy_path))
+        print(f"  legacy -> set load:  {convert_load * 1000:8.1f} ms")
+        assert len(converted.copied_files) == len(progress.copied_files) == ENTRIES
+
+        copied_list = legacy['copied_files']
+        _, list_time = timed(lambda: [p in copied_list for p in probes[:LIST_LOOKUPS]])
+        _, set_time = timed(lambda: [p in progress.copied_files for p in probes])
+        print(f"\n  list membership:     {list_time / LIST_LOOKUPS * 1e6:10.2f} us/check")
+        print(f"  set membership:      {set_time / LOOKUPS * 1e6:10.2f} us/check")
+        print(f"  full skip phase over {ENTRIES} items: "
+              f"~{list_time / LIST_LOOKUPS * ENTRIES:.0f} s (list) vs "
+              f"~{set_time / LOOKUPS * ENTRIES:.2f} s (set)")
+
+
+if __name__ == '__main__':
+    main()
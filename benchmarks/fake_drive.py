@@ -0,0 +1,552 @@
+"""
+In-memory stand-in for the part of the Drive v3 API the copy engine uses.
+
+FakeDrive answers files().list / get / create / copy / update, the changes feed,
+about().get and batch requests like googleapiclient does (request objects with
+.execute(http=...), HttpErrors with Drive's JSON error body), so drive_copy,
+main.py and app.py run against it unchanged. Media downloads (get_media,
+export_media) answer MediaIoBaseDownload's Range requests, and uploads to
+files().create take resumable chunks, so streamed transfers run too. Latency,
+page size, a per-second quota and uncopyable files can be configured to
+reproduce what a real fork runs into.
+"""
+import re
+import json
+import time
+import random
+import hashlib
+import threading
+from collections import Counter, defaultdict, deque
+
+import httplib2
+from googleapiclient.errors import HttpError
+from googleapiclient.http import MediaUploadProgress
+
+FOLDER_MIME_TYPE = 'application/vnd.google-apps.folder'
+# Google Docs, Sheets, ...: no content of their own, only exports.
+GOOGLE_APPS_PREFIX = 'application/vnd.google-apps.'
+# Drive's own limit; pageSize values above it are clamped.
+MAX_PAGE_SIZE = 1000
+SHORTCUT_MIME_TYPE = 'application/vnd.google-apps.shortcut'
+LISTED_FIELDS = ('id', 'name', 'mimeType', 'size', 'modifiedTime', 'md5Checksum', 'version', 'appProperties',
+                 'shortcutDetails')
+
+
+def drive_error(status, reason, retry_after=None):
+    """Builds an HttpError shaped like the ones Drive returns."""
+    headers = {'status': status}
+    if retry_after is not None:
+        headers['retry-after'] = str(retry_after)
+    content = json.dumps({'error': {'code': status, 'errors': [{'reason': reason}]}}).encode('utf-8')
+    return HttpError(httplib2.Response(headers), content)
+
+
+class FakeRequest:
+    """A pending API call; execute() sends it as its own HTTP round-trip."""
+
+    def __init__(self, drive, method, fn):
+        self.drive = drive
+        self.method = method
+        self.fn = fn
+        self.http = drive.http
+
+    def execute(self, http=None, num_retries=0):
+        self.drive._round_trip()
+        return self.drive._call(self, http if http is not None else self.http)
+
+
+class FakeBatch:
+    """Mirrors BatchHttpRequest: one round-trip, one quota unit and callback per call."""
+
+    def __init__(self, drive, callback=None):
+        self.drive = drive
+        self.callback = callback
+        self.requests = []
+
+    def add(self, request, callback=None, request_id=None):
+        self.requests.append((request_id, request, callback or self.callback))
+
+    def execute(self, http=None):
+        self.drive._round_trip('batch')
+        for request_id, request, callback in self.requests:
+            try:
+                response, error = self.drive._call(request, http), None
+            except HttpError as e:
+                response, error = None, e
+            callback(request_id, response, error)
+
+
+class FakeMediaRequest:
+    """
+    A files().get_media / export_media request. MediaIoBaseDownload sends its
+    Range requests to request.http, which is always the fake's, whatever
+    transport the caller sets.
+    """
+
+    def __init__(self, drive, file_id, export_type=None):
+        self.drive = drive
+        self.file_id = file_id
+        self.export_type = export_type
+        self.method = 'files.export' if export_type else 'files.get_media'
+        self.uri = f"fake://files/{file_id}"
+        self.headers = {}
+
+    @property
+    def http(self):
+        return self
+
+    @http.setter
+    def http(self, value):
+        pass
+
+    def request(self, uri, method='GET', body=None, headers=None, **kwargs):
+        self.drive._round_trip('media')
+        return self.drive._call(FakeRequest(self.drive, self.method, lambda: self.drive._download(
+            self.file_id, self.export_type, (headers or {}).get('range'))))
+
+
+class FakeUpload:
+    """A resumable files().create upload; each next_chunk() sends one chunk, as googleapiclient does."""
+
+    def __init__(self, drive, body, media):
+        self.drive = drive
+        self.body = body
+        self.media = media
+        self.progress = 0
+        self._md5 = hashlib.md5()
+
+    def next_chunk(self, http=None, num_retries=0):
+        self.drive._round_trip('upload')
+        # Named apart from metadata-only creates, which the traversal makes.
+        return self.drive._call(FakeRequest(self.drive, 'files.upload', self._send), http)
+
+    def _send(self):
+        # Like googleapiclient: the total size is read before the chunk.
+        size = self.media.size()
+        data = self.media.getbytes(self.progress, self.media.chunksize())
+        self._md5.update(data)
+        self.progress += len(data)
+        with self.drive._lock:
+            self.drive.bytes_uploaded += len(data)
+        if len(data) == self.media.chunksize() and (size is None or self.progress < size):
+            return MediaUploadProgress(self.progress, size), None
+        return None, self.drive._uploaded(self.body, self.progress, self._md5.hexdigest())
+
+
+class _Files:
+    def __init__(self, drive):
+        self.drive = drive
+
+    def list(self, q, fields=None, pageToken=None, pageSize=100, corpora=None, driveId=None, **kwargs):
+        page_size = min(pageSize, self.drive.max_page_size, MAX_PAGE_SIZE)
+        if corpora == 'drive':
+            return FakeRequest(self.drive, 'files.list', lambda: self.drive._list_drive(driveId, pageToken, page_size))
+        parent = re.search(r"'([^']+)' in parents", q).group(1)
+        return FakeRequest(self.drive, 'files.list', lambda: self.drive._list(parent, pageToken, page_size))
+
+    def create(self, body, fields=None, media_body=None, **kwargs):
+        if media_body is not None:
+            return FakeUpload(self.drive, body, media_body)
+        return FakeRequest(self.drive, 'files.create',
+                           lambda: {'id': self.drive.add(body['name'], body['mimeType'], body['parents'][0],
+                                                         app_properties=body.get('appProperties'),
+                                                         target=body.get('shortcutDetails', {}).get('targetId'))})
+
+    def get(self, fileId, fields=None, **kwargs):
+        return FakeRequest(self.drive, 'files.get', lambda: self.drive._get(fileId))
+
+    def get_media(self, fileId, **kwargs):
+        return FakeMediaRequest(self.drive, fileId)
+
+    def export_media(self, fileId, mimeType, **kwargs):
+        return FakeMediaRequest(self.drive, fileId, mimeType)
+
+    def copy(self, fileId, body, fields=None, **kwargs):
+        return FakeRequest(self.drive, 'files.copy', lambda: self.drive._copy(fileId, body))
+
+    def update(self, fileId, body, fields=None, **kwargs):
+        return FakeRequest(self.drive, 'files.update', lambda: self.drive._update(fileId, body))
+
+
+class _Changes:
+    def __init__(self, drive):
+        self.drive = drive
+
+    def getStartPageToken(self, **kwargs):
+        return FakeRequest(self.drive, 'changes.getStartPageToken',
+                           lambda: {'startPageToken': str(len(self.drive.change_log) + 1)})
+
+    def list(self, pageToken, pageSize=100, fields=None, **kwargs):
+        page_size = min(pageSize, self.drive.max_page_size, MAX_PAGE_SIZE)
+        return FakeRequest(self.drive, 'changes.list', lambda: self.drive._changes(pageToken, page_size))
+
+
+class _About:
+    def __init__(self, drive):
+        self.drive = drive
+
+    def get(self, fields=None):
+        return FakeRequest(self.drive, 'about.get', lambda: {'user': dict(self.drive.user)})
+
+
+class FakeDrive:
+    """
+    A Drive account held in memory, usable wherever a `build('drive', 'v3')`
+    service object is expected.
+
+    latency:      seconds each HTTP round-trip (a single call or a whole batch) takes
+    max_page_size: largest page files().list returns, whatever pageSize asks for
+    quota:        calls allowed per rolling second and user (the credentials of the
+                  transport a call is sent on) before 403 userRateLimitExceeded
+    retry_after:  Retry-After header sent with rate-limit errors, if any
+
+    With `drive_id` set, every item is in that shared drive, the items without a
+    parent at its top level, and the drive can be listed whole (corpora='drive').
+    """
+
+    def __init__(self, latency=0.0, max_page_size=MAX_PAGE_SIZE, quota=None, retry_after=None, seed=0):
+        self.latency = latency
+        self.max_page_size = max_page_size
+        self.quota = quota
+        self.retry_after = retry_after
+        self.user = {'permissionId': '00000000000000000001', 'emailAddress': 'bench@example.com'}
+        self.drive_id = None
+        # Transport requests are made on unless execute() is given one, like a built service's.
+        self.http = None
+        self.items = {}
+        self.children = defaultdict(list)
+        # IDs of changed items in order; changes feed page tokens are 1-based positions in it.
+        self.change_log = []
+        # Source files whose copy fails with cannotCopyFile.
+        self.uncopyable = set()
+        # File contents as (pattern, size): the pattern repeated up to size bytes,
+        # so large files cost no memory. Uploaded content isn't kept.
+        self.contents = {}
+        self.bytes_downloaded = 0
+        self.bytes_uploaded = 0
+        # Called with the method name before each call runs, e.g. to interrupt a run.
+        self.before_call = None
+        self.calls = Counter()
+        self.round_trips = Counter()
+        self.errors = Counter()
+        self._random = random.Random(seed)
+        self._next_id = 0
+        self._recent = defaultdict(deque)
+        self._lock = threading.Lock()
+
+    # --- googleapiclient surface ---
+
+    def files(self):
+        return _Files(self)
+
+    def changes(self):
+        return _Changes(self)
+
+    def about(self):
+        return _About(self)
+
+    def new_batch_http_request(self, callback=None):
+        return FakeBatch(self, callback)
+
+    # --- Tree building ---
+
+    def add(self, name, mime_type, parent=None, content=None, app_properties=None, size=None, target=None):
+        """
+        Creates an item and returns its ID; `size` repeats `content` (or the ID)
+        up to that many bytes. A shortcut (SHORTCUT_MIME_TYPE) points at `target`.
+        """
+        with self._lock:
+            self._next_id += 1
+            item_id = f"fake{self._next_id:012d}"
+            self.items[item_id] = {'id': item_id, 'name': name, 'mimeType': mime_type, 'parent': parent,
+                                   'version': 1, 'modifiedTime': self._now()}
+            if not mime_type.startswith(GOOGLE_APPS_PREFIX):
+                self._set_content(item_id, content or item_id, size)
+            if app_properties:
+                self.items[item_id]['appProperties'] = dict(app_properties)
+            if mime_type == SHORTCUT_MIME_TYPE:
+                self.items[item_id]['shortcutDetails'] = {'targetId': target}
+            self.children[parent].append(item_id)
+            self.change_log.append(item_id)
+        return item_id
+
+    def modify(self, item_id, content=None):
+        """Edits a file's content, as if a user had saved a new version."""
+        with self._lock:
+            item = self.items[item_id]
+            item['version'] += 1
+            item['modifiedTime'] = self._now()
+            if not item['mimeType'].startswith(GOOGLE_APPS_PREFIX):
+                self._set_content(item_id, content or f"{item_id}/{item['version']}")
+            self.change_log.append(item_id)
+
+    def _set_content(self, item_id, content, size=None):
+        pattern = content.encode('utf-8')
+        size = len(pattern) if size is None else size
+        self.contents[item_id] = (pattern, size)
+        md5 = hashlib.md5()
+        for start in range(0, size, 1024 * 1024):
+            md5.update(self._read(item_id, start, min(start + 1024 * 1024, size) - 1))
+        self.items[item_id].update(md5Checksum=md5.hexdigest(), size=str(size))
+
+    def _read(self, item_id, start, end):
+        """Returns bytes start..end (inclusive) of a file's content."""
+        pattern, _ = self.contents[item_id]
+        skip = start % len(pattern)
+        repeats = (end - start + skip) // len(pattern) + 1
+        return (pattern * repeats)[skip:skip + end - start + 1]
+
+    def _now(self):
+        # Distinct per change even within one clock tick, like Drive's millisecond timestamps.
+        return f"{time.time():.6f}/{self._next_id}/{len(self.change_log)}"
+
+    def build_tree(self, depth=3, width=4, files=25, uncopyable=0.0, name='source'):
+        """
+        Adds a source tree `depth` folders deep where every folder holds `files`
+        files and `width` subfolders; `uncopyable` is the fraction of files that
+        can't be copied. Returns the root folder ID.
+        """
+        root = self.add(name, FOLDER_MIME_TYPE)
+        level = [root]
+        for current in range(depth + 1):
+            next_level = []
+            for folder_id in level:
+                for n in range(files):
+                    file_id = self.add(f"file{n:05d}.txt", 'text/plain', folder_id)
+                    if self._random.random() < uncopyable:
+                        self.uncopyable.add(file_id)
+                if current < depth:
+                    next_level.extend(self.add(f"folder{n:03d}", FOLDER_MIME_TYPE, folder_id)
+                                      for n in range(width))
+            level = next_level
+        return root
+
+    def tree_size(self, root):
+        """Returns (folders, files) under root, root included."""
+        folders, files, stack = 0, 0, [root]
+        while stack:
+            folders += 1
+            for child_id in self.children[stack.pop()]:
+                if self.items[child_id]['mimeType'] == FOLDER_MIME_TYPE:
+                    stack.append(child_id)
+                else:
+                    files += 1
+        return folders, files
+
+    def snapshot(self, root):
+        """Returns the set of relative paths under root, for comparing source and copy."""
+        paths, stack = set(), [(root, '')]
+        while stack:
+            folder_id, prefix = stack.pop()
+            for child_id in self.children[folder_id]:
+                item = self.items[child_id]
+                path = prefix + item['name']
+                if item['mimeType'] == FOLDER_MIME_TYPE:
+                    paths.add(path + '/')
+                    stack.append((child_id, path + '/'))
+                else:
+                    paths.add(path)
+        return paths
+
+    # --- Call handling ---
+
+    def _round_trip(self, kind='single'):
+        with self._lock:
+            self.round_trips[kind] += 1
+        if self.latency:
+            time.sleep(self.latency)
+
+    def _caller(self, http):
+        """The user a transport is authorized as, by token; None for calls without one."""
+        credentials = getattr(http, 'credentials', None)
+        return getattr(credentials, 'token', None)
+
+    def _call(self, request, http=None):
+        if self.before_call is not None:
+            self.before_call(request.method)
+        with self._lock:
+            self.calls[request.method] += 1
+            if self.quota is not None:
+                now = time.monotonic()
+                recent = self._recent[self._caller(http)]
+                while recent and now - recent[0] >= 1.0:
+                    recent.popleft()
+                if len(recent) >= self.quota:
+                    self.errors['userRateLimitExceeded'] += 1
+                    raise drive_error(403, 'userRateLimitExceeded', self.retry_after)
+                recent.append(now)
+        return request.fn()
+
+    def _list(self, parent, page_token, page_size):
+        start = int(page_token or 0)
+        with self._lock:
+            page = self.children[parent][start:start + page_size]
+            more = start + page_size < len(self.children[parent])
+        response = {'files': [{key: self.items[item_id][key] for key in LISTED_FIELDS if key in self.items[item_id]}
+                              for item_id in page]}
+        if more:
+            response['nextPageToken'] = str(start + page_size)
+        return response
+
+    def _list_drive(self, drive_id, page_token, page_size):
+        if drive_id is None or drive_id != self.drive_id:
+            raise drive_error(404, 'notFound')
+        start = int(page_token or 0)
+        with self._lock:
+            items = [item for item in self.items.values() if not item.get('trashed')]
+        page = items[start:start + page_size]
+        response = {'files': [dict({key: item[key] for key in LISTED_FIELDS if key in item},
+                                   parents=[item['parent'] or drive_id]) for item in page]}
+        if start + page_size < len(items):
+            response['nextPageToken'] = str(start + page_size)
+        return response
+
+    def _get(self, file_id):
+        item = self.items[file_id]
+        response = {key: item[key] for key in LISTED_FIELDS if key in item}
+        if self.drive_id:
+            response['driveId'] = self.drive_id
+        return response
+
+    def _copy(self, file_id, body):
+        if file_id in self.uncopyable:
+            with self._lock:
+                self.errors['cannotCopyFile'] += 1
+            raise drive_error(403, 'cannotCopyFile')
+        source = self.items[file_id]
+        new_id = self.add(source['name'], source['mimeType'], body['parents'][0],
+                          app_properties=body.get('appProperties'),
+                          target=source.get('shortcutDetails', {}).get('targetId'))
+        for key in ('md5Checksum', 'size'):
+            if key in source:
+                self.items[new_id][key] = source[key]
+        if file_id in self.contents:
+            self.contents[new_id] = self.contents[file_id]
+        return {key: self.items[new_id][key] for key in ('id', 'size') if key in self.items[new_id]}
+
+    def _download(self, file_id, export_type, range_header):
+        item = self.items[file_id]
+        if export_type is not None:
+            if not item['mimeType'].startswith(GOOGLE_APPS_PREFIX):
+                raise drive_error(403, 'fileNotExportable')
+            # Drive sends an export whole, whatever the Range asks for.
+            data = f"{file_id} exported as {export_type}".encode('utf-8')
+            response = httplib2.Response({'status': 200, 'content-length': str(len(data))})
+        elif item['mimeType'].startswith(GOOGLE_APPS_PREFIX):
+            raise drive_error(403, 'fileNotDownloadable')
+        else:
+            total = self.contents[file_id][1]
+            start, end = (int(n) for n in re.match(r'bytes=(\d+)-(\d+)', range_header).groups())
+            if start >= total:
+                return httplib2.Response({'status': 416, 'content-range': f"bytes */{total}"}), b''
+            end = min(end, total - 1)
+            data = self._read(file_id, start, end)
+            response = httplib2.Response({'status': 206, 'content-range': f"bytes {start}-{end}/{total}",
+                                          'content-length': str(len(data))})
+        with self._lock:
+            self.bytes_downloaded += len(data)
+        return response, data
+
+    def _uploaded(self, body, size, md5):
+        new_id = self.add(body['name'], body['mimeType'], body['parents'][0],
+                          app_properties=body.get('appProperties'))
+        self.contents.pop(new_id, None)
+        if not body['mimeType'].startswith(GOOGLE_APPS_PREFIX):
+            # Uploads to a Google type are converted and have no size of their own.
+            self.items[new_id].update(md5Checksum=md5, size=str(size))
+        return {key: self.items[new_id][key] for key in ('id', 'size') if key in self.items[new_id]}
+
+    def _update(self, file_id, body):
+        with self._lock:
+            item = self.items[file_id]
+            if body.get('trashed') and not item.get('trashed'):
+                # Trashed items drop out of listings, like trashed=false queries do.
+                item['trashed'] = True
+                self.children[item['parent']].remove(file_id)
+            item['version'] += 1
+            self.change_log.append(file_id)
+        return {'id': file_id}
+
+    def _changes(self, page_token, page_size):
+        start = int(page_token) - 1
+        with self._lock:
+            changed = self.change_log[start:start + page_size]
+            end = start + len(changed)
+            done = end >= len(self.change_log)
+            changes = []
+            for item_id in changed:
+                item = self.items[item_id]
+                file = {key: item[key] for key in LISTED_FIELDS if key in item}
+                file.update(parents=[item['parent']] if item['parent'] else [], trashed=item.get('trashed', False))
+                changes.append({'fileId': item_id, 'removed': False, 'file': file})
+        response = {'changes': changes}
+        if done:
+            response['newStartPageToken'] = str(end + 1)
+        else:
+            response['nextPageToken'] = str(end + 1)
+        return response
+
+
+class GeneratedDrive(FakeDrive):
+    """
+    A FakeDrive whose source tree is computed from item IDs rather than stored,
+    and which keeps nothing created in it, so a tree of millions of items costs
+    it no memory and a benchmark's memory is the copy engine's own.
+
+    The tree is build_tree()'s shape: `depth` folder levels below the root,
+    every folder holding `files` files and `width` subfolders. Folders are
+    numbered breadth-first (folder n's subfolders are n * width + 1 ...), which
+    both item IDs carry, padded to the length of real Drive IDs.
+    """
+
+    def __init__(self, depth=3, width=4, files=25, **kwargs):
+        super().__init__(**kwargs)
+        self.depth = depth
+        self.width = width
+        self.files_per_folder = files
+        # Folders with subfolders: every level but the last.
+        self.inner_folders = sum(width ** level for level in range(depth))
+        self.root = self._folder_id(0)
+        self.dest = 'destination'
+
+    def _folder_id(self, n):
+        return f"gfolder{n:026d}"
+
+    def _file_id(self, n, index):
+        return f"gfile{n:021d}x{index:06d}"
+
+    def _entry(self, n, index):
+        """Item `index` of folder n's listing: its files, then its subfolders."""
+        if index < self.files_per_folder:
+            item_id = self._file_id(n, index)
+            return {'id': item_id, 'name': f"file{index:05d}.txt", 'mimeType': 'text/plain', 'size': '1024',
+                    'modifiedTime': '2024-01-01T00:00:00.000Z', 'version': 1,
+                    'md5Checksum': hashlib.md5(item_id.encode()).hexdigest()}
+        subfolder = n * self.width + index - self.files_per_folder + 1
+        return {'id': self._folder_id(subfolder), 'name': f"folder{index - self.files_per_folder:03d}",
+                'mimeType': FOLDER_MIME_TYPE, 'modifiedTime': '2024-01-01T00:00:00.000Z', 'version': 1}
+
+    def add(self, name, mime_type, parent=None, content=None, app_properties=None, size=None, target=None):
+        """Returns a new ID without keeping the item."""
+        with self._lock:
+            self._next_id += 1
+            return f"new{self._next_id:030d}"
+
+    def tree_size(self, root=None):
+        folders = self.inner_folders + self.width ** self.depth
+        return folders, folders * self.files_per_folder
+
+    def _list(self, parent, page_token, page_size):
+        if not parent.startswith('gfolder'):
+            # The destination, or a folder created in it: always empty.
+            return {'files': []}
+        n = int(parent[len('gfolder'):])
+        count = self.files_per_folder + (self.width if n < self.inner_folders else 0)
+        start = int(page_token or 0)
+        response = {'files': [self._entry(n, index) for index in range(start, min(start + page_size, count))]}
+        if start + page_size < count:
+            response['nextPageToken'] = str(start + page_size)
+        return response
+
+    def _copy(self, file_id, body):
+        return {'id': self.add(None, None), 'size': '1024'}
@@ -0,0 +1,156 @@
+import os
+import json
+import sqlite3
+import tempfile
+
+from googleapiclient.errors import HttpError
+
+from drive_copy import (ALL_DRIVES, FOLDER_MIME_TYPE, LIST_PAGE_SIZE, TRANSPORT_ERRORS, compact_page,
+                        execute_request)
+from planner import PlannedLister
+from structured_log import get_logger
+
+# drive_copy.LIST_FIELDS plus the parents the tree is rebuilt from.
+CORPUS_FIELDS = ("nextPageToken, files(id, name, mimeType, size, modifiedTime, md5Checksum, version, "
+                 "shortcutDetails/targetId, parents)")
+# Marks the page tokens of indexed listings; anything else is a Drive page token.
+TOKEN_PREFIX = 'corpus:'
+# Listing pages of the shared drive between commits while the index is built.
+COMMIT_EVERY = 20
+
+log = get_logger('corpus')
+
+_SCHEMA = """
+CREATE TABLE items (
+    parent TEXT NOT NULL,
+    id TEXT NOT NULL,
+    item TEXT NOT NULL,
+    PRIMARY KEY (parent, id)
+) WITHOUT ROWID;
+CREATE TABLE folders (
+    id TEXT PRIMARY KEY
+) WITHOUT ROWID;
+"""
+
+
+class CorpusIndex:
+    """
+    The whole shared drive a fork's source is in, listed in bulk and indexed by
+    parent, so the fork reads each folder's listing from the index instead of
+    listing it: one files().list call per 1000 items of the drive, however many
+    folders hold them, where a walk makes at least one per folder.
+
+    The index is built on the fork's first listing (a re-sync that reads the
+    changes feed never needs it) into a temporary SQLite file, so a drive of
+    millions of items isn't held in memory, and removed on close(). A source in
+    My Drive isn't indexed and is listed folder by folder, as are folders the
+    index doesn't have, e.g. ones made since it was built.
+
+    Indexed pages are the folder's children ordered by ID, with a page token
+    naming the last one, so a resume reads on from the same place in an index
+    built again, whatever order Drive listed the drive in.
+    """
+
+    def __init__(self, service, source_id):
+        self.service = service
+        self.source_id = source_id
+        self.drive_id = None
+        self.path = None
+        self._conn = None
+        self._built = False
+
+    def _build(self):
+        self._built = True
+        try:
+            source = execute_request(self.service.files().get(fileId=self.source_id, fields='driveId',
+                                                              **ALL_DRIVES))
+        except (HttpError, *TRANSPORT_ERRORS) as e:
+            log.warning("Could not look up the source's drive, listing it folder by folder", extra={'error': str(e)})
+            return
+        drive_id = source.get('driveId')
+        if not drive_id:
+            log.info("Source is not in a shared drive, listing it folder by folder")
+            return
+        fd, self.path = tempfile.mkstemp(prefix='corpus-', suffix='.db')
+        os.close(fd)
+        self._conn = sqlite3.connect(self.path)
+        self._conn.executescript(_SCHEMA)
+        log.info("Indexing the shared drive", extra={'drive_id': drive_id})
+        items = calls = 0
+        page_token = None
+        try:
+            while True:
+                response = execute_request(self.service.files().list(
+                    q="trashed=false",
+                    corpora='drive',
+                    driveId=drive_id,
+                    includeItemsFromAllDrives=True,
+                    supportsAllDrives=True,
+                    fields=CORPUS_FIELDS,
+                    pageToken=page_token,
+                    pageSize=LIST_PAGE_SIZE
+                ))
+                calls += 1
+                rows, folders = [], []
+                for item in response.get('files', []):
+                    parents = item.pop('parents', [])
+                    record = json.dumps(item, separators=(',', ':'))
+                    rows.extend((parent, item['id'], record) for parent in parents)
+                    if item['mimeType'] == FOLDER_MIME_TYPE:
+                        folders.append((item['id'],))
+                self._conn.executemany("INSERT OR IGNORE INTO items VALUES (?, ?, ?)", rows)
+                self._conn.executemany("INSERT OR IGNORE INTO folders VALUES (?)", folders)
+                items += len(response.get('files', []))
+                if calls % COMMIT_EVERY == 0:
+                    self._conn.commit()
+                page_token = response.get('nextPageToken')
+                if not page_token:
+                    break
+        except (HttpError, *TRANSPORT_ERRORS) as e:
+            # A partial index would leave items out of the copy.
+            log.warning("Could not index the shared drive, listing it folder by folder",
+                        extra={'error': str(e), 'indexed': items})
+            self._discard()
+            return
+        # The drive's root is the parent of its top-level items.
+        self._conn.execute("INSERT OR IGNORE INTO folders VALUES (?)", (drive_id,))
+        self._conn.commit()
+        self.drive_id = drive_id
+        log.info("Indexed the shared drive", extra={'drive_id': drive_id, 'items': items, 'list_calls': calls})
+
+    def has_page(self, folder_id, page_token=None):
+        """True if the index can serve this listing page (built on the first call)."""
+        if not self._built:
+            self._build()
+        if self.drive_id is None or (page_token is not None and not page_token.startswith(TOKEN_PREFIX)):
+            return False
+        return self._conn.execute("SELECT 1 FROM folders WHERE id = ?", (folder_id,)).fetchone() is not None
+
+    def page(self, folder_id, page_token=None):
+        """Returns an indexed listing page of the folder, shaped like files().list's, or None."""
+        if not self.has_page(folder_id, page_token):
+            return None
+        after = page_token[len(TOKEN_PREFIX):] if page_token else ''
+        rows = self._conn.execute("SELECT id, item FROM items WHERE parent = ? AND id > ? ORDER BY id LIMIT ?",
+                                  (folder_id, after, LIST_PAGE_SIZE + 1)).fetchall()
+        response = {'files': [json.loads(item) for _, item in rows[:LIST_PAGE_SIZE]]}
+        if len(rows) > LIST_PAGE_SIZE:
+            response['nextPageToken'] = TOKEN_PREFIX + rows[LIST_PAGE_SIZE - 1][0]
+        return compact_page(response)
+
+    def lister(self, service, fallback=None):
+        """Returns a lister serving the indexed folders, and listing the others with `fallback` (a FolderLister)."""
+        return PlannedLister(self, service, fallback)
+
+    def _discard(self):
+        if self._conn is not None:
+            self._conn.close()
+            self._conn = None
+        if self.path is not None:
+            os.remove(self.path)
+            self.path = None
+
+    def close(self):
+        """Removes the index."""
+        self._discard()
+        self.drive_id = None
@@ -0,0 +1,307 @@
+import os
+import copy
+import json
+import hashlib
+import time
+import threading
+from collections import Counter, defaultdict
+from contextlib import contextmanager
+
+import httplib2
+import google_auth_httplib2
+from googleapiclient import discovery_cache
+from googleapiclient.discovery import build, build_from_document
+
+from rate_limiter import drop_limiter, get_limiter
+from structured_log import get_logger
+
+API_NAME = 'drive'
+API_VERSION = 'v3'
+# Idle transports kept per user; more are built while they're all in use, and
+# the ones returned beyond this are closed.
+MAX_IDLE_TRANSPORTS = 16
+# A user none of whose transports has been in use for this many seconds is let
+# go: their idle transports are closed and their credentials and rate limiter
+# forgotten. Checked at most once per IDLE_SWEEP_INTERVAL.
+IDLE_TIMEOUT = 15 * 60
+IDLE_SWEEP_INTERVAL = 60
+# Calls an identity of an IdentityPool may be refused (while another identity
+# could make them) before it's taken out of the pool as having lost access.
+MAX_ACCESS_STRIKES = 3
+
+log = get_logger('drive_client')
+
+_document = None
+_document_lock = threading.Lock()
+
+
+def discovery_document():
+    """
+    Returns a copy of the Drive discovery document bundled with googleapiclient,
+    parsed once per process, or None if this googleapiclient has none bundled.
+    """
+    global _document
+    with _document_lock:
+        if _document is None:
+            static = discovery_cache.get_static_doc(API_NAME, API_VERSION)
+            if static is None:
+                return None
+            _document = json.loads(static)
+    # A service fixes up a method's parameters in place whenever it builds one of
+    # its resources (e.g. on every service.files()), so each gets its own copy.
+    return copy.deepcopy(_document)
+
+
+def user_key(credentials):
+    """Identifies the user behind credentials, across the Credentials objects made from one session."""
+    return (credentials.client_id, credentials.refresh_token or credentials.token)
+
+
+class TransportPool:
+    """
+    Authorized HTTP transports kept open between calls, per user.
+
+    httplib2 keeps its connections alive, so a transport taken back from the
+    pool skips the TCP and TLS handshakes. Every transport of a user shares one
+    Credentials object, so a token refreshed by any of them (google-auth does it
+    before a request once the token has expired) is used by all the others.
+    A transport is used by one thread at a time: acquire() it, release() it after.
+    Users whose transports all sat unused for IDLE_TIMEOUT are let go.
+    """
+
+    def __init__(self, max_idle=MAX_IDLE_TRANSPORTS, idle_timeout=IDLE_TIMEOUT):
+        self.max_idle = max_idle
+        self.idle_timeout = idle_timeout
+        self._credentials = {}
+        self._idle = defaultdict(list)
+        # Per user: transports acquired and not yet released, and when one last was.
+        self._in_use = Counter()
+        self._last_used = {}
+        self._next_sweep = time.monotonic() + IDLE_SWEEP_INTERVAL
+        self._lock = threading.Lock()
+
+    def credentials(self, credentials):
+        """Returns the Credentials object every transport of this user shares."""
+        key = user_key(credentials)
+        with self._lock:
+            self._last_used[key] = time.monotonic()
+            return self._credentials.setdefault(key, credentials)
+
+    def acquire(self, credentials):
+        """Returns an idle transport of the user, or a new one; a ShardedHttp for an IdentityPool."""
+        if isinstance(credentials, IdentityPool):
+            return ShardedHttp(credentials)
+        key = user_key(credentials)
+        with self._lock:
+            shared = self._credentials.setdefault(key, credentials)
+            self._in_use[key] += 1
+            idle = self._idle[key]
+            if idle:
+                return idle.pop()
+        return google_auth_httplib2.AuthorizedHttp(shared, http=httplib2.Http())
+
+    def release(self, http):
+        """Hands a transport back for reuse; the calling thread must not use it after."""
+        if isinstance(http, ShardedHttp):
+            http.close()
+            return
+        key = user_key(http.credentials)
+        now = time.monotonic()
+        with self._lock:
+            self._in_use[key] -= 1
+            if self._in_use[key] <= 0:
+                del self._in_use[key]
+            self._last_used[key] = now
+            idle = self._idle[key]
+            if len(idle) < self.max_idle:
+                idle.append(http)
+                http = None
+        if http is not None:
+            http.close()
+        if now >= self._next_sweep:
+            self.sweep(now)
+
+    def sweep(self, now=None):
+        """Lets go of the users that have no transport in use and none used within idle_timeout."""
+        now = time.monotonic() if now is None else now
+        with self._lock:
+            self._next_sweep = now + IDLE_SWEEP_INTERVAL
+            stale = [key for key, last_used in self._last_used.items()
+                     if key not in self._in_use and now - last_used >= self.idle_timeout]
+            gone = []
+            for key in stale:
+                del self._last_used[key]
+                gone.append((self._credentials.pop(key, None), self._idle.pop(key, [])))
+        for credentials, idle in gone:
+            for http in idle:
+                http.close()
+            if credentials is not None:
+                drop_limiter(identity_label(credentials))
+
+    def close(self):
+        """Closes every idle transport."""
+        with self._lock:
+            idle = [http for transports in self._idle.values() for http in transports]
+            self._idle.clear()
+        for http in idle:
+            http.close()
+
+
+# Shared by every job, request and worker thread of the process.
+transports = TransportPool()
+# Keys the hashes that label identities in /rate-limit and /metrics, so a label
+# can't be matched to an account outside this process.
+_label_key = os.urandom(16)
+
+
+def identity_label(credentials):
+    """Returns the opaque rate limiter key and metrics label of a user."""
+    digest = hashlib.blake2b(repr(user_key(credentials)).encode('utf-8'), key=_label_key, digest_size=6)
+    return f"identity:{digest.hexdigest()}"
+
+
+def user_limiter(credentials):
+    """
+    Returns the rate limiter of the user behind `credentials`. Drive's quota is
+    per user, so one user being throttled doesn't slow anyone else down.
+    """
+    return get_limiter(identity_label(credentials))
+
+
+def limiter_for(http):
+    """Returns the rate limiter of the user a transport is authorized as, 'default' without one."""
+    credentials = getattr(http, 'credentials', None)
+    return user_limiter(credentials) if credentials is not None else get_limiter()
+
+
+class IdentityPool:
+    """
+    Several accounts that all have access to a fork's source and destination.
+
+    Drive's quota is per user, so spreading the fork's calls over more users
+    raises its ceiling: every call goes to the identity whose rate limiter is
+    least busy, and one that's throttled is paused on its own while the others
+    carry on. An identity that loses access (revoked token, removed from the
+    folders) is taken out of the pool. Stands in for a Credentials object
+    wherever the copy engine takes one; copies belong to the identity that made them.
+    """
+
+    def __init__(self, credentials, names=None):
+        self.credentials = [transports.credentials(c) for c in credentials]
+        self.names = list(names) if names else [f"identity{n + 1}" for n in range(len(self.credentials))]
+        # The names are email addresses; anything exposed by the server uses these.
+        self.labels = [identity_label(c) for c in self.credentials]
+        self._lost = set()
+        self._strikes = Counter()
+        self._next = 0
+        self._lock = threading.Lock()
+
+    def __len__(self):
+        return len(self.credentials)
+
+    def limiter(self, index):
+        return get_limiter(self.labels[index])
+
+    def active(self):
+        """Indexes of the identities still in the pool."""
+        with self._lock:
+            return [index for index in range(len(self.credentials)) if index not in self._lost]
+
+    def choose(self, exclude=()):
+        """Returns the index of the least busy identity not in `exclude`, or None if there's none."""
+        with self._lock:
+            start = self._next
+            candidates = [(start + n) % len(self.credentials) for n in range(len(self.credentials))]
+            candidates = [index for index in candidates if index not in self._lost and index not in exclude]
+        if not candidates:
+            return None
+        # Ties go to the next identity in turn.
+        index = min(candidates, key=lambda index: self.limiter(index).delay())
+        with self._lock:
+            self._next = (index + 1) % len(self.credentials)
+        return index
+
+    def lose(self, index, error):
+        """Takes an identity out of the pool, unless it's the last one (whose errors are then reported)."""
+        with self._lock:
+            if index in self._lost or len(self._lost) + 1 >= len(self.credentials):
+                return
+            self._lost.add(index)
+        log.warning("Identity lost access, no longer used", extra={'identity': self.names[index],
+                                                                   'error': str(error)})
+
+    def strike(self, index, error):
+        """Counts a call refused to an identity that another one could make; enough of them lose it."""
+        with self._lock:
+            self._strikes[index] += 1
+            strikes = self._strikes[index]
+        if strikes >= MAX_ACCESS_STRIKES:
+            self.lose(index, error)
+
+    def succeeded(self, index):
+        if self._strikes[index]:
+            with self._lock:
+                self._strikes[index] = 0
+
+
+class ShardedHttp:
+    """
+    One thread's transports to the identities of an IdentityPool, taken from the
+    transport pool as each identity is first used. execute_request() picks the
+    identity of every call; code that sends on the transport directly (media
+    downloads, resumable uploads, batches) gets the identity used last.
+    """
+
+    def __init__(self, identities):
+        self.identities = identities
+        self.current = None
+        self._https = {}
+
+    def transport(self, index):
+        """Returns this thread's transport of identity `index`, which becomes the current one."""
+        if index not in self._https:
+            self._https[index] = transports.acquire(self.identities.credentials[index])
+        self.current = index
+        return self._https[index]
+
+    def pin(self):
+        """Returns the least busy identity's transport, for work that must stay with one (e.g. a resumable upload)."""
+        return self.transport(self.identities.choose())
+
+    def request(self, *args, **kwargs):
+        if self.current is None or self.current not in self.identities.active():
+            return self.pin().request(*args, **kwargs)
+        return self._https[self.current].request(*args, **kwargs)
+
+    def close(self):
+        """Hands every transport back to the transport pool."""
+        while self._https:
+            transports.release(self._https.popitem()[1])
+
+
+def build_service(credentials, http=None):
+    """
+    Returns a Drive v3 service making its calls on `http`, by default a new
+    transport authorized with the user's shared credentials (or an IdentityPool's).
+
+    Built from the cached discovery document, which saves re-reading and
+    parsing it on every build.
+    """
+    if http is None and isinstance(credentials, IdentityPool):
+        http = ShardedHttp(credentials)
+    elif http is None:
+        http = google_auth_httplib2.AuthorizedHttp(transports.credentials(credentials), http=httplib2.Http())
+    document = discovery_document()
+    if document is None:
+        return build(API_NAME, API_VERSION, http=http)
+    return build_from_document(document, http=http)
+
+
+@contextmanager
+def drive_service(credentials):
+    """Yields a Drive service on a pooled transport, given back to the pool on exit."""
+    http = transports.acquire(credentials)
+    try:
+        yield build_service(credentials, http)
+    finally:
+        transports.release(http)
@@ -0,0 +1,1651 @@
+import os
+import sys
+import json
+import time
+import threading
+from collections import deque
+from functools import partial
+from concurrent.futures import ThreadPoolExecutor
+
+import httplib2
+from google.auth.exceptions import RefreshError
+from googleapiclient.errors import HttpError
+
+import metrics
+from drive_client import IdentityPool, ShardedHttp, limiter_for, transports
+from progress_events import ProgressEvents, emit
+from progress_store import FAILED_LOG_FILE, log_failure
+from rate_limiter import get_limiter
+from structured_log import ProgressReporter, get_logger
+
+FOLDER_MIME_TYPE = 'application/vnd.google-apps.folder'
+SHORTCUT_MIME_TYPE = 'application/vnd.google-apps.shortcut'
+RATE_LIMIT_REASONS = ['userRateLimitExceeded', 'rateLimitExceeded']
+# Number of concurrent files().copy calls; 1 copies inline on the calling thread.
+DEFAULT_WORKERS = 8
+MAX_WORKERS = 32
+# Drive accepts at most 100 calls in one batch request.
+BATCH_SIZE = 100
+# How often a throttled request is retried before it is logged as failed.
+MAX_RETRIES = 6
+# Drive error reasons no retry can fix: the item stays in the failure queue for
+# a person to look at. Anything else (rate limits, 5xx, timeouts) is transient.
+PERMANENT_REASONS = {
+    'cannotCopyFile',
+    'cannotDownloadFile',
+    'cannotExportFile',
+    'exportSizeLimitExceeded',
+    'notFound',
+    'insufficientFilePermissions',
+    'insufficientParentPermissions',
+    'storageQuotaExceeded',
+    'teamDriveFileLimitExceeded',
+}
+# Files Drive won't copy server-side that can still be streamed through this
+# process (see transfer.py), so they're only permanent without a TransferPool.
+TRANSFERABLE_REASONS = {'cannotCopyFile'}
+# Attempts after which a transient failure is given up on like a permanent one.
+MAX_FAILURE_ATTEMPTS = 5
+# Retry passes a fork makes over its transient failures before it ends, and the
+# pause before the first one, doubled before each next. Far longer than the
+# per-call backoff, so a quota window or a Drive outage has passed.
+RETRY_PASSES = 3
+RETRY_BACKOFF = 30.0
+# Errors with no HTTP response (timeouts, dropped connections, DNS); always transient.
+TRANSPORT_ERRORS = (OSError, httplib2.HttpLib2Error)
+# Errors that can mean one identity of an IdentityPool has no access to an item
+# the others can reach; the call is tried with another identity (see execute_request()).
+ACCESS_REASONS = {'authError', 'insufficientFilePermissions', 'insufficientParentPermissions', 'notFound'}
+# Drive's maximum files().list page size.
+LIST_PAGE_SIZE = 1000
+# Threads that list folders ahead of the copy, and how many folder pages may be
+# listed ahead (in flight or waiting to be copied) at once.
+LIST_WORKERS = 4
+PREFETCH_PAGES = 64
+# Listed with every file so a later re-sync can tell whether it changed, and
+# the destination index can match it against files already there.
+# Shortcuts come with their target, so they're recreated without a lookup each.
+LIST_FIELDS = ("nextPageToken, files(id, name, mimeType, size, modifiedTime, md5Checksum, version, "
+               "shortcutDetails/targetId)")
+DEST_LIST_FIELDS = "nextPageToken, files(id, name, mimeType, size, md5Checksum, appProperties)"
+# Destination folders this run created that the DestinationIndex remembers as
+# empty; past this, the oldest are forgotten and cost one listing when visited.
+MAX_CREATED_FOLDERS = 65536
+# Drive leaves shared drive items out of a call's results, and refuses to act on
+# them, unless the call says it supports them.
+ALL_DRIVES = {'supportsAllDrives': True}
+# A listing by parent reaches into the parent's shared drive with these alone;
+# corpora='allDrives' would search every drive and may return incomplete results.
+LIST_ALL_DRIVES = {'supportsAllDrives': True, 'includeItemsFromAllDrives': True}
+# App property stamped on every copy and created folder, holding the source item's ID.
+SOURCE_PROPERTY = 'forkedFrom'
+# What retry_shortcut() reads back of a shortcut the failure queue only has the ID of.
+SHORTCUT_FIELDS = "id, name, mimeType, modifiedTime, version, shortcutDetails/targetId"
+CHANGE_FIELDS = ("nextPageToken, newStartPageToken, changes(fileId, removed, "
+                 "file(id, name, mimeType, parents, trashed, modifiedTime, md5Checksum, version, "
+                 "shortcutDetails/targetId))")
+
+log = get_logger('drive_copy')
+# Set by jobs.shutdown() as the server exits, so a fork pausing between retry
+# passes stops at once instead of holding up the exit. (The CLI forks on its
+# main thread, where Ctrl-C already cuts the pause short.)
+shutting_down = threading.Event()
+
+
+class CopyInterrupted(Exception):
+    """Raised when the process is shutting down and no more copies can be scheduled."""
+
+
+def record_failure(progress, path, error, item_id=None, parent_id=None, reason=None, kind='file'):
+    """
+    Records a failure in the job's progress store and reports it to any listener.
+
+    item_id and parent_id (the destination folder) queue the item for a retry
+    pass (see retry_failures()); reason defaults to the Drive error reason of an
+    HttpError, or the exception type of a transport error, and kind is 'file',
+    'shortcut', 'folder', 'listing' or 'replace'.
+    """
+    if reason is None and isinstance(error, HttpError):
+        reason = get_error_reason(error)
+    elif reason is None and isinstance(error, Exception):
+        reason = type(error).__name__
+    progress.add_failure(path, error, item_id, parent_id, reason, kind)
+    emit(progress, 'failed', path, str(error))
+
+
+def is_permanent(failure, transfers=None, attempts=True):
+    """
+    True for a queued failure that retrying won't fix, or (unless `attempts` is
+    False) that has been retried enough. With `transfers` (a TransferPool, or True
+    if one will be there), files Drive refused to copy can still be streamed, so
+    they aren't permanent.
+    """
+    if attempts and failure['attempts'] >= MAX_FAILURE_ATTEMPTS:
+        return True
+    if transfers and failure['kind'] == 'file' and failure['reason'] in TRANSFERABLE_REASONS:
+        return False
+    return failure['reason'] in PERMANENT_REASONS
+
+
+def get_error_reason(error):
+    """Returns the Drive error reason (e.g. 'cannotCopyFile') from an HttpError."""
+    try:
+        return json.loads(error.content).get('error', {}).get('errors', [{}])[0].get('reason', 'unknown')
+    except (ValueError, AttributeError, IndexError):
+        return 'unknown'
+
+
+def is_rate_limited(error):
+    """True for 429 responses and 403s whose reason is a rate limit."""
+    status = getattr(getattr(error, 'resp', None), 'status', None)
+    return status == 429 or get_error_reason(error) in RATE_LIMIT_REASONS
+
+
+def get_retry_after(error):
+    """Returns the Retry-After delay in seconds from an HttpError, if Drive sent one."""
+    try:
+        return float(error.resp.get('retry-after'))
+    except (AttributeError, TypeError, ValueError):
+        return None
+
+
+def throttle(error, attempt, limiter=None):
+    """Reports a rate-limit error to `limiter`, by default the shared one, and returns the pause."""
+    return (limiter or get_limiter()).on_throttle(get_retry_after(error), attempt)
+
+
+def is_access_error(error):
+    """True for a revoked or invalid token, or a permission or not-found error (see ACCESS_REASONS)."""
+    if isinstance(error, RefreshError):
+        return True
+    return isinstance(error, HttpError) and (error.resp.status == 401 or get_error_reason(error) in ACCESS_REASONS)
+
+
+def sharded(http, request=None):
+    """Returns the ShardedHttp a call goes out on (`http`, or else the request's own), or None."""
+    if http is None:
+        http = getattr(request, 'http', None)
+    return http if isinstance(http, ShardedHttp) else None
+
+
+def count_call(method, error=None):
+    """Counts one Drive call in the metrics by its HTTP status and error reason."""
+    if error is None:
+        metrics.api_requests.inc(method=method, status=200, reason='')
+    elif isinstance(error, HttpError):
+        metrics.api_requests.inc(method=method, status=error.resp.status, reason=get_error_reason(error))
+    else:
+        # No HTTP response at all (timeout, connection reset, ...).
+        metrics.api_requests.inc(method=method, status='none', reason=type(error).__name__)
+
+
+def execute_request(request, http=None):
+    """
+    Executes a single Drive request through the rate limiter of the user it's sent as.
+
+    Rate-limited calls are retried up to MAX_RETRIES times; any other error,
+    or the last rate-limit error, is raised to the caller.
+
+    On a ShardedHttp, every attempt goes to the least busy identity of its
+    IdentityPool, so a retry moves off a throttled identity. A call refused for
+    lack of access (see is_access_error()) is tried with the other identities
+    before its error is raised; the refusing identity is struck, or lost at once
+    if its token no longer works.
+    """
+    shards = sharded(http, request)
+    method = metrics.request_method(request)
+    refused = []
+    attempt = 0
+    while True:
+        if shards is not None:
+            identities = shards.identities
+            index = identities.choose(exclude=refused)
+            limiter, target = identities.limiter(index), shards.transport(index)
+        else:
+            limiter, target = limiter_for(http if http is not None else getattr(request, 'http', None)), http
+        limiter.acquire()
+        started = time.monotonic()
+        try:
+            response = request.execute(http=target)
+        except Exception as e:
+            metrics.api_latency.observe(time.monotonic() - started, method=method)
+            count_call(method, e)
+            if shards is not None and is_access_error(e) and identities.choose(exclude=refused + [index]) is not None:
+                refused.append(index)
+                refusal = e
+                if isinstance(e, RefreshError) or getattr(getattr(e, 'resp', None), 'status', None) == 401:
+                    identities.lose(index, e)
+                metrics.identity_failovers.inc(identity=identities.labels[index], cause='access')
+                continue
+            if not isinstance(e, HttpError) or not is_rate_limited(e) or attempt == MAX_RETRIES:
+                raise
+            metrics.api_retries.inc(method=method)
+            wait_time = throttle(e, attempt, limiter)
+            if shards is not None:
+                metrics.identity_failovers.inc(identity=identities.labels[index], cause='rate_limit')
+            log.info("Rate limited, backing off", extra={'wait_seconds': round(wait_time, 1),
+                                                         'rate': round(limiter.rate, 1), 'attempt': attempt + 1})
+            attempt += 1
+            continue
+        metrics.api_latency.observe(time.monotonic() - started, method=method)
+        count_call(method)
+        limiter.on_success()
+        if shards is not None:
+            # Another identity got through, so the refusals were about those identities.
+            for other in refused:
+                identities.strike(other, refusal)
+            identities.succeeded(index)
+        return response
+
+
+def file_fingerprint(item):
+    """Returns 'modifiedTime|md5Checksum|version' for a listed file (Google Docs have no md5)."""
+    return f"{item.get('modifiedTime', '')}|{item.get('md5Checksum', '')}|{item.get('version', '')}"
+
+
+def is_modified(old_fingerprint, new_fingerprint):
+    """
+    True if the content changed. version also moves on metadata-only changes
+    (sharing, starring), so only modifiedTime and md5Checksum are compared.
+    """
+    return old_fingerprint.split('|')[:2] != new_fingerprint.split('|')[:2]
+
+
+def chunked(items, size):
+    """Yields consecutive slices of at most `size` items."""
+    for start in range(0, len(items), size):
+        yield items[start:start + size]
+
+
+def execute_batch(service, requests, http=None, attempt=0):
+    """
+    Sends up to BATCH_SIZE requests in one HTTP round-trip, as the least busy
+    identity if `http` is a ShardedHttp.
+
+    Returns a (response, exception) pair per request, in the order given. If the
+    batch itself fails, every request gets that error so the caller can retry them.
+    A rate limit is reported to the sender's limiter as the caller's `attempt`.
+    """
+    results = [(None, None)] * len(requests)
+
+    def callback(request_id, response, exception):
+        results[int(request_id)] = (response, exception)
+
+    batch = service.new_batch_http_request(callback=callback)
+    for index, req in enumerate(requests):
+        batch.add(req, request_id=str(index))
+    shards = sharded(http, requests[0])
+    if shards is not None:
+        identity = shards.identities.choose()
+        limiter, http = shards.identities.limiter(identity), shards.transport(identity)
+    else:
+        limiter = limiter_for(http if http is not None else getattr(requests[0], 'http', None))
+    # Drive counts every call inside a batch against the quota.
+    limiter.acquire(len(requests))
+    started = time.monotonic()
+    try:
+        batch.execute(http=http)
+    except (HttpError, *TRANSPORT_ERRORS) as e:
+        results = [(None, e)] * len(requests)
+    metrics.api_latency.observe(time.monotonic() - started, method='batch')
+    for req, (_, error) in zip(requests, results):
+        count_call(metrics.request_method(req), error)
+    succeeded = sum(1 for _, error in results if error is None)
+    if succeeded:
+        limiter.on_success(succeeded)
+    throttled = next((error for _, error in results if error is not None and is_rate_limited(error)), None)
+    if throttled is not None:
+        # The limiter pauses the next acquire(); one report per batch is enough.
+        throttle(throttled, attempt, limiter)
+    return results
+
+
+def clamp_workers(workers):
+    """Keeps a user-supplied worker count within the supported range."""
+    return max(1, min(int(workers), MAX_WORKERS))
+
+
+def release_all(https):
+    """Gives the per-thread transports of stopped workers back to the transport pool."""
+    while https:
+        transports.release(https.pop())
+
+
+class CopyPool:
+    """
+    Bounded pool of file-copy workers.
+
+    httplib2 connections are not thread-safe, so every worker thread executes its
+    requests on its own authorized Http object, taken from the process's
+    transport pool and given back when the pool closes.
+    """
+
+    def __init__(self, credentials, workers=DEFAULT_WORKERS, failure_log=None, name='copy-worker',
+                 queue=metrics.copy_queue, queue_size=None):
+        self.credentials = credentials
+        self.workers = clamp_workers(workers)
+        self.failure_log = failure_log
+        self.queue = queue
+        self._local = threading.local()
+        self._transports = []
+        self._executor = ThreadPoolExecutor(max_workers=self.workers, thread_name_prefix=name)
+        # Caps queued copies so a folder with 100k files isn't queued all at once.
+        self._slots = threading.BoundedSemaphore(queue_size or self.workers * 2)
+        self._idle = threading.Condition()
+        self._pending = 0
+
+    def http(self):
+        """Returns the calling worker's private authorized transport."""
+        if not hasattr(self._local, 'http'):
+            self._local.http = transports.acquire(self.credentials)
+            self._transports.append(self._local.http)
+        return self._local.http
+
+    def submit(self, fn, *args, callback=None, label=None):
+        """
+        Schedules fn(*args, http=...) on a worker, blocking while the queue is full.
+        callback, if given, is called with fn's result (False if it raised) before
+        wait() can return; label names the work in the failure log if fn raises.
+        """
+        self._slots.acquire()
+        with self._idle:
+            self._pending += 1
+        self.queue.inc()
+        try:
+            future = self._executor.submit(self._run, fn, args, callback, label)
+        except RuntimeError as e:
+            # The executor refuses new work once the interpreter starts exiting.
+            self._done()
+            raise CopyInterrupted(str(e)) from e
+        future.add_done_callback(self._cancelled)
+
+    def _cancelled(self, future):
+        # Work dropped by close(cancel=True) never runs; free its slot for blocked submitters.
+        if future.cancelled():
+            self._done()
+
+    def _run(self, fn, args, callback, label):
+        result = False
+        try:
+            result = fn(*args, http=self.http())
+        except Exception as e:
+            # Never let a worker die silently; the item is recorded as failed instead.
+            log.error("Copy worker failed", extra={'path': label, 'error': str(e)})
+            log_failure(label or "<copy_batch>", e, self.failure_log)
+        finally:
+            try:
+                if callback is not None:
+                    callback(result)
+            finally:
+                self._done()
+
+    def _done(self):
+        self.queue.dec()
+        self._slots.release()
+        with self._idle:
+            self._pending -= 1
+            if self._pending == 0:
+                self._idle.notify_all()
+
+    def wait(self):
+        """Blocks until every scheduled copy has finished."""
+        with self._idle:
+            while self._pending:
+                self._idle.wait()
+
+    def close(self, cancel=False):
+        """Waits for (or cancels) outstanding copies and stops the workers."""
+        if not cancel:
+            self.wait()
+        self._executor.shutdown(wait=True, cancel_futures=cancel)
+        release_all(self._transports)
+
+
+def list_page(service, folder_id, page_token=None, http=None, fields=LIST_FIELDS):
+    """Lists one page of a folder's children that aren't trashed."""
+    return execute_request(service.files().list(
+        q=f"'{folder_id}' in parents and trashed=false",
+        fields=fields,
+        pageToken=page_token,
+        pageSize=LIST_PAGE_SIZE,
+        **LIST_ALL_DRIVES
+    ), http)
+
+
+def list_pages(service, folder_id, page_token=None, fields=LIST_FIELDS, http=None):
+    """Yields a folder's listing pages, from page_token on, on the calling thread."""
+    while True:
+        response = list_page(service, folder_id, page_token, http, fields)
+        yield response
+        page_token = response.get('nextPageToken')
+        if not page_token:
+            return
+
+
+class ListedItem:
+    """
+    One file or folder of a listing page (its LIST_FIELDS), read like the dict
+    Drive returned: item['id'], item.get('size'), 'md5Checksum' in item. Pages
+    listed ahead are held as these, which take about a third less memory than
+    the dicts, with the MIME type interned.
+    """
+    __slots__ = ('id', 'name', 'mimeType', 'size', 'modifiedTime', 'md5Checksum', 'version', 'shortcutDetails')
+
+    def __init__(self, item):
+        for field in self.__slots__:
+            setattr(self, field, item.get(field))
+        self.mimeType = sys.intern(self.mimeType)
+
+    def get(self, field, default=None):
+        value = getattr(self, field, None) if field in self.__slots__ else None
+        return default if value is None else value
+
+    def __getitem__(self, field):
+        value = self.get(field)
+        if value is None:
+            raise KeyError(field)
+        return value
+
+    def __contains__(self, field):
+        return self.get(field) is not None
+
+
+def compact_page(response):
+    """Turns a LIST_FIELDS listing page's files into ListedItems, in place, and returns it."""
+    response['files'] = [ListedItem(item) for item in response.get('files', [])]
+    return response
+
+
+class FolderLister:
+    """
+    Lists folders ahead of the copy on threads of its own.
+
+    The traversal asks for the folders it will visit next with prefetch(); pages()
+    then hands back the listing as soon as it's ready and starts fetching the
+    folder's next page while the current one is being copied. At most `prefetch`
+    pages are listed ahead, so a very wide tree can't be enumerated into memory;
+    with `compact` (LIST_FIELDS only) they're held as ListedItems.
+    Only the traversal thread may call prefetch() and pages().
+    """
+
+    def __init__(self, service, credentials, workers=LIST_WORKERS, prefetch=PREFETCH_PAGES, fields=LIST_FIELDS,
+                 compact=True):
+        self.service = service
+        self.credentials = credentials
+        self.fields = fields
+        self.compact = compact and fields == LIST_FIELDS
+        self._local = threading.local()
+        self._transports = []
+        self._executor = ThreadPoolExecutor(max_workers=workers, thread_name_prefix='list-worker')
+        self._slots = threading.Semaphore(prefetch)
+        self._pages = {}
+
+    def _http(self):
+        if not hasattr(self._local, 'http'):
+            self._local.http = transports.acquire(self.credentials)
+            self._transports.append(self._local.http)
+        return self._local.http
+
+    def _list(self, folder_id, page_token, ahead=True):
+        response = list_page(self.service, folder_id, page_token, self._http() if ahead else None, self.fields)
+        return compact_page(response) if self.compact else response
+
+    def prefetch(self, folder_id, page_token=None):
+        """Starts listing a page in the background; False once the frontier is full."""
+        key = (folder_id, page_token)
+        if key in self._pages:
+            return True
+        if not self._slots.acquire(blocking=False):
+            return False
+        try:
+            self._pages[key] = self._executor.submit(self._list, folder_id, page_token)
+        except RuntimeError:
+            # Shutting down: the traversal lists synchronously until it stops.
+            self._slots.release()
+            return False
+        metrics.list_queue.inc()
+        return True
+
+    def prefetch_all(self, pages):
+        """Prefetches (folder_id, page_token) pages, in order, until the frontier is full."""
+        for folder_id, page_token in pages:
+            if not self.prefetch(folder_id, page_token):
+                return
+
+    def discard(self, folder_id, page_token=None):
+        """Forgets a prefetched page the traversal won't visit after all."""
+        future = self._pages.pop((folder_id, page_token), None)
+        if future is not None:
+            future.cancel()
+            self._release()
+
+    def _release(self):
+        metrics.list_queue.dec()
+        self._slots.release()
+
+    def _take(self, folder_id, page_token):
+        future = self._pages.pop((folder_id, page_token), None)
+        if future is None:
+            # Not prefetched (frontier full): list it here, on the caller's connection.
+            return self._list(folder_id, page_token, ahead=False)
+        self._release()
+        return future.result()
+
+    def pages(self, folder_id, page_token=None):
+        """Yields a folder's listing pages from page_token on, fetching each next page in the background."""
+        while True:
+            response = self._take(folder_id, page_token)
+            page_token = response.get('nextPageToken')
+            if page_token:
+                self.prefetch(folder_id, page_token)
+            yield response
+            if not page_token:
+                return
+
+    def close(self):
+        """Drops listings nobody will ask for and stops the listing threads."""
+        self._executor.shutdown(wait=True, cancel_futures=True)
+        release_all(self._transports)
+
+
+def count_copy(new_file):
+    """Counts a finished copy, and its size when Drive reports one, in the metrics."""
+    metrics.files_copied.inc()
+    metrics.bytes_copied.inc(int(new_file.get('size', 0)))
+
+
+def trash_file(service, file_id, progress, current_path, http=None):
+    """Moves a stale destination copy to the trash and returns whether it did; a failure is recorded, not raised."""
+    try:
+        execute_request(service.files().update(fileId=file_id, body={'trashed': True}, **ALL_DRIVES), http)
+        log.debug("Trashed stale copy", extra={'path': current_path})
+        return True
+    except (HttpError, *TRANSPORT_ERRORS) as e:
+        log.error("Could not trash the stale copy", extra={'path': current_path, 'error': str(e)})
+        record_failure(progress, current_path, f"Could not trash stale copy {file_id}: {e}", file_id,
+                       reason=get_error_reason(e) if isinstance(e, HttpError) else type(e).__name__,
+                       kind='replace')
+        return False
+
+
+def copy_file(service, item_id, dest_folder_id, progress, current_path, fingerprint=None, replace_id=None,
+              fallback=None, http=None):
+    """
+    Copies one file into dest_folder_id and returns whether it succeeded; rate
+    limits are retried by execute_request. fingerprint is recorded for re-syncs,
+    and replace_id, the copy a re-sync found stale, is trashed once the new one exists.
+    A file Drive refuses to copy is handed to `fallback` (see transfer_fallback()),
+    which counts as success.
+    """
+    # The body only needs the new parent folder ID. Name and other metadata are copied.
+    file_metadata = {'parents': [dest_folder_id], 'appProperties': {SOURCE_PROPERTY: item_id}}
+
+    try:
+        new_file = execute_request(service.files().copy(fileId=item_id, body=file_metadata, fields='id, size',
+                                                        **ALL_DRIVES), http)
+        # IMPORTANT: Record progress immediately after successful copy.
+        progress.add_file(item_id, new_file['id'], fingerprint)
+        count_copy(new_file)
+        emit(progress, 'copied', current_path)
+        log.debug("Copied", extra={'path': current_path})
+        if replace_id:
+            trash_file(service, replace_id, progress, current_path, http)
+        return True
+    except HttpError as e:
+        error_reason = get_error_reason(e)
+        if is_rate_limited(e):
+            log.error("Still rate limited, giving up", extra={'path': current_path, 'retries': MAX_RETRIES})
+            record_failure(progress, current_path, f"Rate limit retries exhausted: {error_reason}",
+                           item_id, dest_folder_id, error_reason)
+        elif error_reason in TRANSFERABLE_REASONS and fallback is not None:
+            fallback(item_id, dest_folder_id, current_path, fingerprint, replace_id)
+            return True
+        elif error_reason == 'cannotCopyFile':
+            log.warning("File not copyable", extra={'path': current_path})
+            record_failure(progress, current_path, f"Permission error: {error_reason}",
+                           item_id, dest_folder_id, error_reason)
+        else:
+            log.error("Failed to copy file", extra={'path': current_path, 'error': str(e)})
+            record_failure(progress, current_path, e, item_id, dest_folder_id)
+        return False
+    except TRANSPORT_ERRORS as e:
+        log.error("Failed to copy file", extra={'path': current_path, 'error': str(e)})
+        record_failure(progress, current_path, e, item_id, dest_folder_id)
+        return False
+
+
+def copy_files_batched(service, files, progress, fallback=None, http=None):
+    """
+    Copies (item_id, dest_folder_id, current_path, fingerprint, replace_id) tuples
+    in batch requests and returns whether all of them succeeded. See copy_file().
+
+    Only the sub-requests that hit a rate limit are re-queued for the next round.
+    """
+    pending = list(files)
+    all_copied = True
+    for attempt in range(MAX_RETRIES + 1):
+        rate_limited = []
+        for chunk in chunked(pending, BATCH_SIZE):
+            requests = [service.files().copy(fileId=item_id, fields='id, size', body={
+                            'parents': [dest_folder_id],
+                            'appProperties': {SOURCE_PROPERTY: item_id}
+                        }, **ALL_DRIVES)
+                        for item_id, dest_folder_id, *_ in chunk]
+            for file, (response, error) in zip(chunk, execute_batch(service, requests, http, attempt)):
+                item_id, dest_folder_id, current_path, fingerprint, replace_id = file
+                if error is None:
+                    progress.add_file(item_id, response['id'], fingerprint)
+                    count_copy(response)
+                    emit(progress, 'copied', current_path)
+                    log.debug("Copied", extra={'path': current_path})
+                    if replace_id:
+                        trash_file(service, replace_id, progress, current_path, http)
+                    continue
+                error_reason = get_error_reason(error)
+                if is_rate_limited(error):
+                    rate_limited.append((file, error))
+                elif error_reason in TRANSFERABLE_REASONS and fallback is not None:
+                    fallback(item_id, dest_folder_id, current_path, fingerprint, replace_id)
+                elif error_reason == 'cannotCopyFile':
+                    log.warning("File not copyable", extra={'path': current_path})
+                    record_failure(progress, current_path, f"Permission error: {error_reason}",
+                                   item_id, dest_folder_id, error_reason)
+                    all_copied = False
+                else:
+                    log.error("Failed to copy file", extra={'path': current_path, 'error': str(error)})
+                    record_failure(progress, current_path, error, item_id, dest_folder_id)
+                    all_copied = False
+        if not rate_limited:
+            return all_copied
+        if attempt == MAX_RETRIES:
+            break
+        metrics.api_retries.inc(len(rate_limited), method='files.copy')
+        log.info("Batched copies rate limited, retrying",
+                 extra={'throttled': len(rate_limited), 'attempt': attempt + 1})
+        pending = [file for file, _ in rate_limited]
+
+    for (item_id, dest_folder_id, current_path, *_), error in rate_limited:
+        error_reason = get_error_reason(error)
+        log.error("Still rate limited, giving up", extra={'path': current_path, 'retries': MAX_RETRIES})
+        record_failure(progress, current_path, f"Rate limit retries exhausted: {error_reason}",
+                       item_id, dest_folder_id, error_reason)
+    return False
+
+
+def shortcut_target(item):
+    """Returns the ID a listed shortcut points at, or None for anything else (or a listing without it)."""
+    if item['mimeType'] != SHORTCUT_MIME_TYPE:
+        return None
+    return (item.get('shortcutDetails') or {}).get('targetId')
+
+
+def copied_target(progress, target_id):
+    """Returns the ID of this fork's copy of a shortcut's target, or None if it made none."""
+    if target_id in progress.folder_map:
+        return progress.folder_map[target_id]
+    recorded = progress.file_version(target_id)
+    return recorded[0] if recorded else None
+
+
+def create_shortcut(service, item_id, target_id, name, dest_folder_id, progress, current_path, fingerprint=None,
+                    replace_id=None, http=None):
+    """
+    Recreates a source shortcut in dest_folder_id, pointing at target_id, and
+    returns whether it succeeded. Recorded like a copied file, see copy_file().
+    """
+    body = {
+        'name': name,
+        'mimeType': SHORTCUT_MIME_TYPE,
+        'parents': [dest_folder_id],
+        'shortcutDetails': {'targetId': target_id},
+        'appProperties': {SOURCE_PROPERTY: item_id}
+    }
+    try:
+        new_shortcut = execute_request(service.files().create(body=body, fields='id', **ALL_DRIVES), http)
+    except (HttpError, *TRANSPORT_ERRORS) as e:
+        log.error("Failed to create shortcut", extra={'path': current_path, 'error': str(e)})
+        record_failure(progress, current_path, e, item_id, dest_folder_id, kind='shortcut')
+        return False
+    progress.add_file(item_id, new_shortcut['id'], fingerprint)
+    emit(progress, 'copied', current_path)
+    log.debug("Recreated shortcut", extra={'path': current_path})
+    if replace_id:
+        trash_file(service, replace_id, progress, current_path, http)
+    return True
+
+
+class DeferredShortcuts:
+    """
+    Shortcuts whose target the walk hasn't copied yet, held back until it has
+    walked the whole tree: one pointing inside the tree then points at the copy
+    whichever of the two was listed first, and one pointing outside it at the
+    original. Their pages stay open meanwhile (see FolderCheckpoint), so a run
+    interrupted before they're made lists them again.
+    """
+
+    def __init__(self):
+        self._shortcuts = []
+
+    def __len__(self):
+        return len(self._shortcuts)
+
+    def defer(self, checkpoint, page, service, item_id, target_id, *args):
+        """Holds back create_shortcut(service, item_id, target_id, *args), keeping the page open."""
+        checkpoint.add(page)
+        self._shortcuts.append((checkpoint, page, service, item_id, target_id, args))
+
+    def create(self, progress, pool=None):
+        """Creates the held back shortcuts, inline or on the pool."""
+        shortcuts, self._shortcuts = self._shortcuts, []
+        for checkpoint, page, service, item_id, target_id, args in shortcuts:
+            target_id = copied_target(progress, target_id) or target_id
+            if pool is None:
+                checkpoint.done(page, create_shortcut(service, item_id, target_id, *args))
+            else:
+                # args[3] is the shortcut's path.
+                pool.submit(create_shortcut, service, item_id, target_id, *args,
+                            callback=partial(checkpoint.done, page), label=args[3])
+
+
+def transfer_fallback(transfers, service, progress, checkpoint=None, page=None, results=None):
+    """
+    Returns the `fallback` copy_file() hands the files Drive won't copy to, which
+    queues them on `transfers` (a transfer.TransferPool), or None without one.
+
+    A transfer keeps the checkpoint's page open until it finishes, or appends its
+    result to `results`.
+    """
+    if transfers is None:
+        return None
+
+    def fallback(item_id, dest_folder_id, current_path, fingerprint=None, replace_id=None):
+        callback = results.append if results is not None else None
+        if checkpoint is not None:
+            checkpoint.add(page)
+            callback = partial(checkpoint.done, page)
+        transfers.transfer(service, item_id, dest_folder_id, progress, current_path, fingerprint, replace_id,
+                           callback=callback)
+
+    return fallback
+
+
+def create_folders_batched(service, folders, dest_folder_id, progress):
+    """
+    Creates (item_id, item_name, current_path) folders under dest_folder_id in
+    batch requests and records each one in progress.folder_map.
+    """
+    pending = list(folders)
+    for attempt in range(MAX_RETRIES + 1):
+        rate_limited = []
+        for chunk in chunked(pending, BATCH_SIZE):
+            requests = [service.files().create(body={
+                            'name': item_name,
+                            'mimeType': FOLDER_MIME_TYPE,
+                            'parents': [dest_folder_id],
+                            'appProperties': {SOURCE_PROPERTY: item_id}
+                        }, fields='id', **ALL_DRIVES)
+                        for item_id, item_name, _ in chunk]
+            for folder, (response, error) in zip(chunk, execute_batch(service, requests, attempt=attempt)):
+                item_id, _, current_path = folder
+                if error is None:
+                    progress.add_folder(item_id, response['id'])
+                    emit(progress, 'folder_created', current_path)
+                elif is_rate_limited(error):
+                    rate_limited.append((folder, error))
+                else:
+                    log.error("Failed to create folder", extra={'path': current_path, 'error': str(error)})
+                    record_failure(progress, current_path, error, item_id, dest_folder_id, kind='folder')
+        if not rate_limited:
+            return
+        if attempt == MAX_RETRIES:
+            break
+        metrics.api_retries.inc(len(rate_limited), method='files.create')
+        log.info("Batched folder creations rate limited, retrying",
+                 extra={'throttled': len(rate_limited), 'attempt': attempt + 1})
+        pending = [folder for folder, _ in rate_limited]
+
+    for (item_id, _, current_path), error in rate_limited:
+        error_reason = get_error_reason(error)
+        log.error("Still rate limited, giving up", extra={'path': current_path, 'retries': MAX_RETRIES})
+        record_failure(progress, current_path, f"Rate limit retries exhausted: {error_reason}",
+                       item_id, dest_folder_id, error_reason, 'folder')
+
+
+class DestinationIndex:
+    """
+    Finds items that already exist in the destination, so a fork whose progress
+    was lost, or that targets a partly filled folder, adopts them instead of
+    copying them again.
+
+    Each destination folder is listed once, lazily, when the traversal first
+    needs to copy or create something in it; folders this run created are known
+    to be empty and not listed (up to MAX_CREATED_FOLDERS of them at a time).
+    """
+
+    def __init__(self, service, max_created=MAX_CREATED_FOLDERS):
+        self.service = service
+        self.max_created = max_created
+        # Insertion-ordered, so the oldest entry is the first one.
+        self._created = {}
+
+    def created(self, dest_folder_id):
+        """Notes a folder this run created."""
+        self._created[dest_folder_id] = None
+        if len(self._created) > self.max_created:
+            del self._created[next(iter(self._created))]
+
+    def folder(self, dest_folder_id):
+        """Returns a DestinationListing of dest_folder_id, or None if this run created it."""
+        if dest_folder_id in self._created:
+            # Visited once, so the entry can go.
+            del self._created[dest_folder_id]
+            return None
+        return DestinationListing(self.service, dest_folder_id)
+
+
+class DestinationListing:
+    """
+    The children of one existing destination folder, indexed by the source ID
+    stamped on them (SOURCE_PROPERTY), by the name of folders without a stamp,
+    and by file name + size + md5Checksum. A matched item is removed so it's
+    adopted at most once.
+    """
+
+    def __init__(self, service, folder_id):
+        self.service = service
+        self.folder_id = folder_id
+        self._by_source = None
+        self._folders = None
+        self._by_content = None
+
+    def _load(self):
+        self._by_source, self._folders, self._by_content = {}, {}, {}
+        try:
+            for response in list_pages(self.service, self.folder_id, fields=DEST_LIST_FIELDS):
+                for item in response.get('files', []):
+                    source_id = (item.get('appProperties') or {}).get(SOURCE_PROPERTY)
+                    if source_id:
+                        self._by_source.setdefault(source_id, item)
+                    if item['mimeType'] == FOLDER_MIME_TYPE:
+                        # A stamped folder copies the source folder it names, whatever its name.
+                        if not source_id:
+                            self._folders.setdefault(item['name'], item)
+                    elif 'md5Checksum' in item:
+                        self._by_content.setdefault((item['name'], item.get('size'), item['md5Checksum']), item)
+        except (HttpError, *TRANSPORT_ERRORS) as e:
+            # Without the index everything is copied, as if the folder were empty.
+            log.warning("Could not list destination folder, not checking it for duplicates",
+                        extra={'folder_id': self.folder_id, 'error': str(e)})
+
+    def _take(self, match):
+        for index, key in ((self._by_source, (match.get('appProperties') or {}).get(SOURCE_PROPERTY)),
+                           (self._folders, match['name']),
+                           (self._by_content, (match['name'], match.get('size'), match.get('md5Checksum')))):
+            if index.get(key) is match:
+                del index[key]
+        return match['id']
+
+    def find_folder(self, source_id, name):
+        """Returns the ID of an existing copy of a source folder (or an unstamped folder with its name), or None."""
+        if self._folders is None:
+            self._load()
+        match = self._by_source.get(source_id)
+        if match is None or match['mimeType'] != FOLDER_MIME_TYPE:
+            match = self._folders.get(name)
+        return self._take(match) if match else None
+
+    def find_file(self, item):
+        """
+        Returns (dest_id, verified) for an existing copy of a source file, or None.
+        verified is False for files without an md5Checksum (Google Docs), which are
+        matched by the source ID stamped on them and can't be compared.
+        """
+        if self._folders is None:
+            self._load()
+        match = self._by_source.get(item['id'])
+        if match is not None and match.get('md5Checksum') == item.get('md5Checksum'):
+            return self._take(match), 'md5Checksum' in item
+        if 'md5Checksum' in item:
+            match = self._by_content.get((item['name'], item.get('size'), item['md5Checksum']))
+            if match is not None:
+                return self._take(match), True
+        return None
+
+
+class FolderCheckpoint:
+    """
+    Moves a folder's saved place in the frontier forward as its copies finish.
+
+    A page only counts as done once every copy queued from it has succeeded, so
+    a resume never skips a file that was still in flight or failed: the folder is
+    re-listed from its first unfinished page. Once all pages are done the folder
+    is marked complete and won't be listed again.
+    """
+
+    def __init__(self, progress, source_id, dest_id, path):
+        self.progress = progress
+        self.source_id = source_id
+        self.dest_id = dest_id
+        self.path = path
+        self._lock = threading.Lock()
+        # Open pages in listing order: [page_token, outstanding work, all succeeded].
+        self._pages = deque()
+        self._next_token = None
+        self._listed = False
+
+    def start_page(self, page_token, next_token):
+        """Opens a listed page; it stays open until page_queued() and a done() per add()."""
+        page = [page_token, 1, True]
+        with self._lock:
+            self._pages.append(page)
+            self._next_token = next_token
+        return page
+
+    def add(self, page):
+        with self._lock:
+            page[1] += 1
+
+    def done(self, page, succeeded=True):
+        with self._lock:
+            page[1] -= 1
+            page[2] = page[2] and bool(succeeded)
+            self._advance()
+
+    def fail(self, page):
+        """Keeps a page open for the next run, e.g. after a subfolder couldn't be created."""
+        with self._lock:
+            page[2] = False
+
+    def page_queued(self, page):
+        """Closes a page once all of its work has been handed out."""
+        self.done(page)
+
+    def finish(self):
+        """Called after the folder's last page has been queued."""
+        with self._lock:
+            self._listed = True
+            self._advance()
+
+    def _advance(self):
+        moved = False
+        while self._pages and self._pages[0][1] == 0 and self._pages[0][2]:
+            self._pages.popleft()
+            moved = True
+        if not self._pages and self._listed:
+            self._listed = False # Only complete once
+            self.progress.complete_folder(self.source_id)
+        elif moved:
+            page_token = self._pages[0][0] if self._pages else self._next_token
+            self.progress.set_pending(self.source_id, self.dest_id, self.path, page_token)
+
+
+def _schedule(pool, checkpoint, page, fn, *args, label=None):
+    """Runs fn(*args) inline or on the pool, reporting its result to the page's checkpoint."""
+    checkpoint.add(page)
+    if pool is None:
+        checkpoint.done(page, fn(*args))
+    else:
+        pool.submit(fn, *args, callback=partial(checkpoint.done, page), label=label)
+
+
+def copy_folder(service, source_folder_id, dest_folder_id, progress, path="", page_token=None,
+                pool=None, batch=False, lister=None, sync=False, replace=False, index=None, transfers=None,
+                shortcuts=None):
+    """
+    Copies the files directly inside one folder, from page_token on, and creates
+    its subfolders, queuing those still to visit in the frontier (see walk_frontier()).
+
+    With `sync`, files copied before are copied again if they changed since, and
+    with `replace` their stale copies are trashed. With an `index`, identical
+    items already in the destination folder are adopted instead of copied. With
+    `transfers`, files Drive won't copy are streamed instead (see transfer.py).
+
+    Shortcuts are recreated rather than copied, pointing at the fork's copy of
+    their target if it has one; the others are held in `shortcuts` (a
+    DeferredShortcuts) until the tree is walked, or without it point at the
+    original target.
+    """
+    checkpoint = FolderCheckpoint(progress, source_folder_id, dest_folder_id, path)
+    existing = index.folder(dest_folder_id) if index else None
+    resumed_token = page_token
+    pages = lister.pages(source_folder_id, page_token) if lister else list_pages(service, source_folder_id, page_token)
+    while True:
+        try:
+            response = next(pages, None)
+        except (HttpError, *TRANSPORT_ERRORS) as e:
+            if resumed_token and getattr(getattr(e, 'resp', None), 'status', None) == 400:
+                # Page tokens expire; the already-copied files are skipped anyway.
+                log.warning("Saved listing position expired, re-listing from the start", extra={'path': path or '/'})
+                page_token = resumed_token = None
+                pages = lister.pages(source_folder_id) if lister else list_pages(service, source_folder_id)
+                continue
+            log.error("Could not list folder", extra={'path': path or '/', 'folder_id': source_folder_id,
+                                                      'error': str(e)})
+            record_failure(progress, f"{path}/<folder_listing_failed>", e, source_folder_id, dest_folder_id,
+                           kind='listing')
+            # The folder stays in the frontier and is listed again on the next run.
+            return
+        if response is None:
+            break # Exit the loop when all pages are processed
+        resumed_token = None
+
+        page = checkpoint.start_page(page_token, response.get('nextPageToken'))
+        fallback = transfer_fallback(transfers, service, progress, checkpoint, page)
+        page_token = response.get('nextPageToken')
+        items = response.get('files', [])
+        subfolders = []
+        to_copy = []
+
+        for item in items:
+            item_id = item['id']
+            item_name = item['name']
+            item_type = item['mimeType']
+            current_path = os.path.join(path, item_name)
+
+            if item_type == FOLDER_MIME_TYPE:
+                # Create subfolders after this page's files are queued, so the
+                # workers stay busy meanwhile.
+                subfolders.append((item_id, item_name, current_path))
+
+            else:
+                emit(progress, 'discovered', current_path)
+                fingerprint = file_fingerprint(item)
+                replace_id = None
+                changed = False
+                if item_id in progress.copied_files:
+                    recorded = progress.file_version(item_id) if sync else None
+                    if recorded is None or not is_modified(recorded[1], fingerprint):
+                        # This file was already copied in a previous run.
+                        if sync and recorded is None:
+                            # Copied before versions were recorded: the baseline for the next re-sync.
+                            progress.add_file(item_id, None, fingerprint)
+                        log.debug("Skipping file, already copied", extra={'path': current_path})
+                        emit(progress, 'skipped', current_path)
+                        continue
+                    log.debug("File modified since it was copied", extra={'path': current_path})
+                    replace_id = recorded[0] if replace else None
+                    changed = True
+
+                failure = progress.failure(item_id) if not changed else None
+                # A transient failure is copied again by every walk, however many
+                # retry passes it used up; they only stop the passes retrying it.
+                if failure is not None and is_permanent(failure, transfers, attempts=False):
+                    # Retrying won't help; it stays queued for retry_failed() with its reason.
+                    log.debug("Skipping file that can't be copied", extra={'path': current_path,
+                                                                           'reason': failure['reason']})
+                    emit(progress, 'skipped', current_path)
+                    continue
+
+                match = existing.find_file(item) if existing is not None and not changed else None
+                if match is not None:
+                    dest_id, verified = match
+                    log.debug("Adopting file already in the destination", extra={'path': current_path})
+                    progress.add_file(item_id, dest_id, fingerprint if verified else None)
+                    emit(progress, 'skipped', current_path)
+                    continue
+
+                target_id = shortcut_target(item)
+                if target_id:
+                    args = (item_name, dest_folder_id, progress, current_path, fingerprint, replace_id)
+                    copied_id = copied_target(progress, target_id)
+                    if copied_id is None and shortcuts is not None:
+                        shortcuts.defer(checkpoint, page, service, item_id, target_id, *args)
+                    else:
+                        _schedule(pool, checkpoint, page, create_shortcut, service, item_id, copied_id or target_id,
+                                  *args, label=current_path)
+                    continue
+
+                log.debug("Copying file", extra={'path': current_path})
+                if batch:
+                    to_copy.append((item_id, dest_folder_id, current_path, fingerprint, replace_id))
+                else:
+                    _schedule(pool, checkpoint, page, copy_file, service, item_id, dest_folder_id, progress,
+                              current_path, fingerprint, replace_id, fallback, label=current_path)
+
+        if to_copy:
+            if pool is None:
+                _schedule(None, checkpoint, page, copy_files_batched, service, to_copy, progress, fallback)
+            else:
+                for chunk in chunked(to_copy, BATCH_SIZE):
+                    _schedule(pool, checkpoint, page, copy_files_batched, service, chunk, progress, fallback)
+
+        new_folders = []
+        for folder in subfolders:
+            item_id, item_name, current_path = folder
+            if item_id in progress.folder_map:
+                continue
+            match = existing.find_folder(item_id, item_name) if existing is not None else None
+            if match is not None:
+                log.debug("Adopting folder already in the destination", extra={'path': current_path})
+                progress.add_folder(item_id, match)
+            else:
+                new_folders.append(folder)
+
+        if batch:
+            for _, _, current_path in new_folders:
+                log.debug("Creating folder", extra={'path': current_path})
+            create_folders_batched(service, new_folders, dest_folder_id, progress)
+            if index:
+                for item_id, _, _ in new_folders:
+                    if item_id in progress.folder_map:
+                        index.created(progress.folder_map[item_id])
+
+        for item_id, item_name, current_path in subfolders:
+            if item_id in progress.done_folders:
+                log.debug("Skipping folder, already complete", extra={'path': current_path})
+                continue
+            if item_id in progress.frontier:
+                # Created in a previous run and already waiting in the frontier.
+                continue
+            if item_id in progress.folder_map:
+                # Adopted above, or created in a previous run that stopped before queuing it.
+                new_dest_folder_id = progress.folder_map[item_id]
+            elif batch:
+                # Its creation failed and has been logged; list this folder again next run.
+                checkpoint.fail(page)
+                continue
+            else:
+                log.debug("Creating folder", extra={'path': current_path})
+                folder_metadata = {
+                    'name': item_name,
+                    'mimeType': FOLDER_MIME_TYPE,
+                    'parents': [dest_folder_id],
+                    'appProperties': {SOURCE_PROPERTY: item_id}
+                }
+                try:
+                    new_folder = execute_request(service.files().create(body=folder_metadata, fields='id',
+                                                                        **ALL_DRIVES))
+                    new_dest_folder_id = new_folder['id']
+                    # IMPORTANT: Record progress immediately after successful creation.
+                    progress.add_folder(item_id, new_dest_folder_id)
+                    emit(progress, 'folder_created', current_path)
+                    if index:
+                        index.created(new_dest_folder_id)
+                except (HttpError, *TRANSPORT_ERRORS) as e:
+                    log.error("Failed to create folder", extra={'path': current_path, 'error': str(e)})
+                    record_failure(progress, current_path, e, item_id, dest_folder_id, kind='folder')
+                    checkpoint.fail(page)
+                    continue # Skip to the next item
+
+            # Queue the subfolder before this folder can be marked complete.
+            progress.set_pending(item_id, new_dest_folder_id, current_path)
+
+        checkpoint.page_queued(page)
+
+    checkpoint.finish()
+
+
+def copy_folder_contents(service, source_folder_id, dest_folder_id, progress, path="", pool=None, batch=False,
+                         lister=None, sync=False, replace=False, index=None, transfers=None):
+    """
+    Copies a folder tree from a source to a destination, tracking progress and
+    handling interruptions.
+
+    The tree is walked depth-first from the frontier saved in `progress` (folders
+    created but not yet complete, with the page to resume listing at) rather than
+    by recursion, so no depth can exhaust the stack, and a resumed run starts
+    straight from those folders and never re-lists a finished one. `progress`
+    holds this one fork; a fork that finished is walked again from its root.
+
+    Folders are created on the calling thread before their children are visited;
+    file copies go to `pool` when one is given, otherwise they run inline. With
+    `batch`, a page's copies and folder creations are grouped into batch requests.
+    With a `lister`, folders are listed ahead in the background. See copy_folder()
+    for `sync`, `replace`, `index` and `transfers`.
+    """
+    # Map the root source folder to the root destination folder to start
+    if source_folder_id not in progress.folder_map:
+        progress.add_folder(source_folder_id, dest_folder_id)
+
+    if not progress.has_pending():
+        if source_folder_id in progress.done_folders:
+            if sync:
+                # The changes feed brought the finished tree up to date.
+                log.info("Every folder is already complete")
+                return
+            # A finished fork run again: walk the tree again for items added
+            # since, copying only what isn't copied yet, as a first run would.
+            progress.reset_traversal()
+        progress.set_pending(source_folder_id, progress.folder_map[source_folder_id], path)
+    walk_frontier(service, progress, pool, batch, lister, sync, replace, index, transfers)
+
+
+def walk_frontier(service, progress, pool=None, batch=False, lister=None, sync=False, replace=False, index=None,
+                  transfers=None):
+    """
+    Copies the folders pending in the frontier and everything below them.
+
+    The frontier saved in `progress` is the work list itself: the newest pending
+    folder is copied next, so the tree is walked depth-first, and the subfolders
+    it queues are read back from the store a window at a time. Only the folders
+    being copied or listed ahead are held here, however wide the tree.
+
+    Shortcuts to items not copied yet are recreated once the rest of the tree
+    is walked (see DeferredShortcuts), after the copies in flight have finished.
+    """
+    # Folders copied this run that are still pending, with copies in flight or a
+    # page that failed; the ones completed since are pruned as the set grows.
+    visited = set()
+    prune_at = PREFETCH_PAGES
+    shortcuts = DeferredShortcuts()
+    while True:
+        window = progress.newest_pending(PREFETCH_PAGES if lister else 1, visited)
+        if not window:
+            if not shortcuts:
+                return
+            wait_for(pool, transfers)
+            shortcuts.create(progress, pool)
+            continue
+        if lister:
+            # Keep the folders visited next listing while this one is copied.
+            lister.prefetch_all((entry[0], entry[3]) for entry in window)
+        folder_id, folder_dest_id, folder_path, page_token = window[0]
+        visited.add(folder_id)
+        copy_folder(service, folder_id, folder_dest_id, progress, folder_path, page_token,
+                    pool, batch, lister, sync, replace, index, transfers, shortcuts)
+        if len(visited) >= prune_at:
+            visited = {pending for pending in visited if pending in progress.frontier}
+            prune_at = max(PREFETCH_PAGES, 2 * len(visited))
+
+
+def is_resolved(progress, failure):
+    """True once a queued failure's item has made it after all, e.g. on a later run."""
+    if failure['kind'] in ('file', 'shortcut'):
+        return failure['item_id'] in progress.copied_files
+    if failure['kind'] == 'folder':
+        return failure['item_id'] in progress.folder_map
+    if failure['kind'] == 'listing':
+        return failure['item_id'] in progress.done_folders
+    return False
+
+
+def is_retryable(failure, force=False, transfers=None):
+    """
+    True for a queued failure a retry pass can act on and, unless `force`, that
+    may still succeed (see is_permanent() for `transfers`).
+    """
+    if not failure['item_id'] or (is_permanent(failure, transfers) and not force):
+        return False
+    return failure['kind'] in ('listing', 'replace') or bool(failure['parent_id'])
+
+
+def prune_failures(progress):
+    """Drops the queued failures whose items have made it since, and returns how many."""
+    pruned = 0
+    for failure in progress.failures():
+        if is_resolved(progress, failure):
+            progress.remove_failure(failure['id'])
+            pruned += 1
+    return pruned
+
+
+def retry_folder(service, item_id, dest_folder_id, progress, current_path, http=None):
+    """
+    Creates a folder whose creation failed before and queues it in the frontier,
+    so its contents are copied next; returns whether it did.
+    """
+    try:
+        # The failure only kept the path, and names may contain '/'.
+        name = execute_request(service.files().get(fileId=item_id, fields='name', **ALL_DRIVES), http)['name']
+        new_folder = execute_request(service.files().create(body={
+            'name': name,
+            'mimeType': FOLDER_MIME_TYPE,
+            'parents': [dest_folder_id],
+            'appProperties': {SOURCE_PROPERTY: item_id}
+        }, fields='id', **ALL_DRIVES), http)
+    except (HttpError, *TRANSPORT_ERRORS) as e:
+        log.error("Failed to create folder", extra={'path': current_path, 'error': str(e)})
+        record_failure(progress, current_path, e, item_id, dest_folder_id, kind='folder')
+        return False
+    progress.add_folder(item_id, new_folder['id'])
+    progress.set_pending(item_id, new_folder['id'], current_path)
+    emit(progress, 'folder_created', current_path)
+    return True
+
+
+def retry_shortcut(service, item_id, dest_folder_id, progress, current_path, http=None):
+    """Recreates a shortcut whose creation failed before (see create_shortcut()); returns whether it did."""
+    try:
+        item = execute_request(service.files().get(fileId=item_id, fields=SHORTCUT_FIELDS, **ALL_DRIVES), http)
+    except (HttpError, *TRANSPORT_ERRORS) as e:
+        log.error("Failed to create shortcut", extra={'path': current_path, 'error': str(e)})
+        record_failure(progress, current_path, e, item_id, dest_folder_id, kind='shortcut')
+        return False
+    target_id = shortcut_target(item)
+    return create_shortcut(service, item_id, copied_target(progress, target_id) or target_id, item['name'],
+                           dest_folder_id, progress, current_path, file_fingerprint(item), http=http)
+
+
+def wait_for(pool, transfers=None):
+    """Waits for the pooled copies, then for the transfers they handed over."""
+    if pool is not None:
+        pool.wait()
+    if transfers is not None:
+        transfers.wait()
+
+
+def _retried(progress, failure, succeeded):
+    if succeeded:
+        progress.remove_failure(failure['id'])
+
+
+def retry_failures(service, progress, reason=None, pool=None, batch=False, lister=None, sync=False,
+                   replace=False, index=None, transfers=None):
+    """
+    Makes one pass over the failure queue and returns how many failures it
+    retried and how many of those are resolved now.
+
+    Transient failures are retried, or with `reason` every failure with that
+    reason, permanent or not. Files are copied again into their recorded
+    destination folder (or with `transfers`, streamed if Drive still won't copy
+    them), folders created again and stale copies trashed again; a failed listing
+    kept its folder in the frontier, so the frontier is walked again, which also
+    copies the contents of the folders created here. A failure that happens again
+    stays queued with one more attempt.
+    """
+    prune_failures(progress)
+    queue = [failure for failure in progress.failures(reason)
+             if is_retryable(failure, force=reason is not None, transfers=transfers)]
+    fallback = transfer_fallback(transfers, service, progress)
+    for failure in queue:
+        log.debug("Retrying", extra={'path': failure['path'], 'kind': failure['kind'],
+                                     'reason': failure['reason'], 'attempts': failure['attempts']})
+        callback = partial(_retried, progress, failure)
+        if failure['kind'] == 'file':
+            retry = partial(copy_file, service, failure['item_id'], failure['parent_id'], progress,
+                            failure['path'], None, None, fallback)
+            # Pruned below once the copy is recorded; a hand-over to `transfers` may still fail.
+            callback = None
+        elif failure['kind'] == 'folder':
+            # On this thread: the walk below needs the folder.
+            _retried(progress, failure, retry_folder(service, failure['item_id'], failure['parent_id'], progress,
+                                                     failure['path']))
+            continue
+        elif failure['kind'] == 'shortcut':
+            retry = partial(retry_shortcut, service, failure['item_id'], failure['parent_id'], progress,
+                            failure['path'])
+        elif failure['kind'] == 'replace':
+            retry = partial(trash_file, service, failure['item_id'], progress, failure['path'])
+        else:
+            continue # Listings are retried by the walk below
+        if pool is None:
+            succeeded = retry()
+            if callback is not None:
+                callback(succeeded)
+        else:
+            pool.submit(retry, callback=callback, label=failure['path'])
+    wait_for(pool, transfers)
+    if progress.has_pending():
+        walk_frontier(service, progress, pool, batch, lister, sync, replace, index, transfers)
+        wait_for(pool, transfers)
+    listed = {failure['id']: failure['attempts'] for failure in queue if failure['kind'] == 'listing'}
+    for failure in progress.failures(reason):
+        if listed.get(failure['id']) == failure['attempts']:
+            # Its folder was in the frontier and listed without failing again.
+            progress.remove_failure(failure['id'])
+    prune_failures(progress)
+    remaining = {failure['id'] for failure in progress.failures(reason)}
+    recovered = sum(1 for failure in queue if failure['id'] not in remaining)
+    log.info("Retried failed items", extra={'retried': len(queue), 'recovered': recovered})
+    return len(queue), recovered
+
+
+def retry_failed(service, credentials, progress, reason=None, workers=DEFAULT_WORKERS, batch=False, dedup=True,
+                 transfers=None):
+    """
+    The retry-failed command: one retry pass over a fork's failure queue (see
+    retry_failures()), on `workers` threads. Returns (retried, recovered).
+    """
+    workers = clamp_workers(workers)
+    pool = CopyPool(credentials, workers, progress.failure_log) if workers > 1 else None
+    if progress.events is None:
+        progress.events = ProgressEvents()
+    try:
+        result = retry_failures(service, progress, reason, pool, batch,
+                                index=DestinationIndex(service) if dedup else None, transfers=transfers)
+    except BaseException:
+        if transfers is not None:
+            transfers.close(cancel=True)
+        if pool is not None:
+            pool.close(cancel=True)
+        raise
+    if pool is not None:
+        pool.close()
+    return result
+
+
+def get_changes_token(service):
+    """Returns the current position of the Drive changes feed, or None if it can't be read."""
+    try:
+        return execute_request(service.changes().getStartPageToken(**ALL_DRIVES))['startPageToken']
+    except (HttpError, *TRANSPORT_ERRORS) as e:
+        log.warning("Could not read the Drive changes feed position, re-syncs will walk the tree",
+                    extra={'error': str(e)})
+        return None
+
+
+def list_changes(service, page_token):
+    """Yields the files and folders changed since page_token, leaving out removed and trashed ones."""
+    while page_token:
+        response = execute_request(service.changes().list(
+            pageToken=page_token,
+            pageSize=LIST_PAGE_SIZE,
+            spaces='drive',
+            fields=CHANGE_FIELDS,
+            supportsAllDrives=True,
+            includeItemsFromAllDrives=True
+        ))
+        for change in response.get('changes', []):
+            item = change.get('file')
+            if change.get('removed') or not item or item.get('trashed'):
+                continue # Deletions are never mirrored
+            yield item
+        page_token = response.get('nextPageToken')
+
+
+def sync_changes(service, progress, page_token, pool=None, replace=False, transfers=None):
+    """
+    Applies the changes the Drive changes feed reports since page_token to the
+    copy, without listing any folder: new folders inside the tree are created and
+    queued in the frontier, new or modified files are copied and shortcuts
+    recreated. Changes outside the tree, renames, moves and deletions are ignored.
+
+    Returns whether every change was applied, or None if the feed couldn't be
+    read; waits for pooled copies (and with `transfers`, streamed ones) to finish
+    so the traversal that follows sees them.
+    """
+    folders, files = [], []
+    try:
+        for item in list_changes(service, page_token):
+            (folders if item['mimeType'] == FOLDER_MIME_TYPE else files).append(item)
+    except (HttpError, *TRANSPORT_ERRORS) as e:
+        log.error("Could not read the Drive changes feed", extra={'error': str(e)})
+        record_failure(progress, "<changes_feed>", e)
+        return None
+
+    results = []
+    # A new folder can be reported before its new parent; retry until no more resolve.
+    while folders:
+        unresolved = []
+        for item in folders:
+            if item['id'] in progress.folder_map:
+                continue
+            parent_id = next((parent for parent in item.get('parents', []) if parent in progress.folder_map), None)
+            if parent_id is None:
+                unresolved.append(item)
+                continue
+            log.debug("Creating new folder", extra={'path': item['name']})
+            try:
+                new_folder = execute_request(service.files().create(body={
+                    'name': item['name'],
+                    'mimeType': FOLDER_MIME_TYPE,
+                    'parents': [progress.folder_map[parent_id]],
+                    'appProperties': {SOURCE_PROPERTY: item['id']}
+                }, fields='id', **ALL_DRIVES))
+                progress.add_folder(item['id'], new_folder['id'])
+                # The traversal copies its contents.
+                progress.set_pending(item['id'], new_folder['id'], item['name'])
+                emit(progress, 'folder_created', item['name'])
+            except (HttpError, *TRANSPORT_ERRORS) as e:
+                log.error("Failed to create folder", extra={'path': item['name'], 'error': str(e)})
+                record_failure(progress, item['name'], e, item['id'], progress.folder_map[parent_id], kind='folder')
+                results.append(False)
+        if len(unresolved) == len(folders):
+            break # The rest are outside the tree
+        folders = unresolved
+
+    fallback = transfer_fallback(transfers, service, progress, results=results)
+    shortcuts = []
+    for item in files:
+        parent_id = next((parent for parent in item.get('parents', []) if parent in progress.folder_map), None)
+        if parent_id is None:
+            continue
+        fingerprint = file_fingerprint(item)
+        recorded = progress.file_version(item['id']) if item['id'] in progress.copied_files else None
+        if item['id'] in progress.copied_files and (recorded is None or not is_modified(recorded[1], fingerprint)):
+            continue
+        replace_id = recorded[0] if replace and recorded else None
+        if shortcut_target(item):
+            # After the copies, so one to a file that's new too points at its copy.
+            shortcuts.append((item, progress.folder_map[parent_id], fingerprint, replace_id))
+            continue
+        log.debug(f"Copying {'modified' if recorded else 'new'} file", extra={'path': item['name']})
+        if pool is None:
+            results.append(copy_file(service, item['id'], progress.folder_map[parent_id], progress, item['name'],
+                                     fingerprint, replace_id, fallback))
+        else:
+            pool.submit(copy_file, service, item['id'], progress.folder_map[parent_id], progress, item['name'],
+                        fingerprint, replace_id, fallback, callback=results.append, label=item['name'])
+    wait_for(pool, transfers)
+    for item, dest_folder_id, fingerprint, replace_id in shortcuts:
+        target_id = shortcut_target(item)
+        results.append(create_shortcut(service, item['id'], copied_target(progress, target_id) or target_id,
+                                       item['name'], dest_folder_id, progress, item['name'], fingerprint, replace_id))
+    return all(results)
+
+
+def verify_identities(service, identities, source_folder_id, dest_folder_id):
+    """
+    Takes the identities of an IdentityPool that can't read the source or add to
+    the destination out of the pool before a fork, instead of each striking out
+    on its own calls. The last identity is always kept, to report the errors.
+    """
+    for index in identities.active():
+        http = transports.acquire(identities.credentials[index])
+        try:
+            execute_request(service.files().get(fileId=source_folder_id, fields='id', **ALL_DRIVES), http)
+            dest = execute_request(service.files().get(fileId=dest_folder_id, fields='capabilities/canAddChildren',
+                                                       **ALL_DRIVES), http)
+            if not dest.get('capabilities', {}).get('canAddChildren', True):
+                identities.lose(index, "can't add to the destination folder")
+        except (HttpError, RefreshError) as e:
+            if is_access_error(e):
+                identities.lose(index, e)
+        finally:
+            transports.release(http)
+
+
+def fork_folder(service, credentials, source_folder_id, dest_folder_id, progress,
+                workers=DEFAULT_WORKERS, batch=False, sync=False, replace=False, dedup=True, plan=None,
+                transfers=None, corpus=None):
+    """
+    Copies a whole folder tree, spreading file copies over `workers` threads
+    while LIST_WORKERS more threads list the folders the copy will reach next.
+
+    With `sync`, a tree copied before is brought up to date: new and modified
+    files are copied (and with `replace`, stale copies trashed). The changes are
+    read from the Drive changes feed since the last fork, so unchanged folders are
+    never listed; without a saved feed position the whole tree is walked instead.
+
+    With `dedup`, files and folders already in the destination are adopted
+    rather than copied again (see DestinationIndex).
+
+    A `plan` (planner.Plan) made of the same source replays its saved listings
+    instead of listing the source tree again. A `corpus` (corpus.CorpusIndex of
+    the source) lists a source in a shared drive in bulk instead of folder by folder.
+
+    With `transfers` (a transfer.TransferPool, which the caller closes), files
+    Drive won't copy server-side are streamed through this process on its own
+    workers instead of failing; the fork waits for them before it ends.
+
+    `credentials` may be an IdentityPool: every call then goes out as the least
+    busy of its accounts (see execute_request()), after the ones without access
+    to both folders are dropped.
+
+    Items that fail transiently (rate limits, server errors, timeouts) are
+    retried after the tree is walked, in up to RETRY_PASSES passes with a long
+    backoff; what still fails stays in the progress store's failure queue for
+    retry_failed(). A process exiting during a pause stops the fork at once with
+    CopyInterrupted.
+    """
+    if plan is not None and plan.source_id != source_folder_id:
+        raise ValueError(f"The plan is for source folder '{plan.source_id}', not '{source_folder_id}'")
+    if isinstance(credentials, IdentityPool):
+        verify_identities(service, credentials, source_folder_id, dest_folder_id)
+    workers = clamp_workers(workers)
+    pool = lister = None
+    if workers > 1:
+        pool = CopyPool(credentials, workers, progress.failure_log)
+        lister = FolderLister(service, credentials)
+    if corpus is not None:
+        lister = corpus.lister(service, lister)
+    if plan is not None:
+        lister = plan.lister(service, lister)
+    if progress.events is None:
+        # Counted for the periodic progress line even when nobody follows the job.
+        progress.events = ProgressEvents()
+    reporter = ProgressReporter(progress.events, log).start()
+    try:
+        changes_applied, next_token = True, None
+        if sync:
+            # Read before syncing, so changes made during the sync are seen next time.
+            next_token = get_changes_token(service)
+            if progress.changes_token:
+                changes_applied = sync_changes(service, progress, progress.changes_token, pool, replace, transfers)
+            if changes_applied is None or (not progress.changes_token and not progress.has_pending()):
+                # No feed to read from (or it couldn't be read): walk the whole tree instead.
+                changes_applied = True
+                progress.reset_traversal()
+        elif progress.changes_token is None and source_folder_id not in progress.folder_map:
+            # A new fork: remember where the changes feed stands for a later re-sync.
+            # A plan's listings are as old as the plan, so changes since then count.
+            next_token = plan.changes_token if plan is not None else get_changes_token(service)
+            if next_token:
+                progress.set_changes_token(next_token)
+        index = DestinationIndex(service) if dedup else None
+        copy_folder_contents(service, source_folder_id, dest_folder_id, progress, pool=pool, batch=batch,
+                             lister=lister, sync=sync, replace=replace, index=index, transfers=transfers)
+        wait_for(pool, transfers)
+        for retry_pass in range(RETRY_PASSES):
+            transient = [failure for failure in progress.failures()
+                         if is_retryable(failure, transfers=transfers) and not is_resolved(progress, failure)]
+            if not transient:
+                break
+            wait_time = RETRY_BACKOFF * 2 ** retry_pass
+            log.info("Retrying transient failures after a pause",
+                     extra={'failures': len(transient), 'wait_seconds': wait_time, 'pass': retry_pass + 1})
+            if shutting_down.wait(wait_time):
+                raise CopyInterrupted("The process is exiting")
+            retry_failures(service, progress, pool=pool, batch=batch, lister=lister, sync=sync, replace=replace,
+                           index=index, transfers=transfers)
+        prune_failures(progress)
+        # Keep the old position while anything is left to do, so it's replayed next time.
+        if sync and next_token and changes_applied and not progress.has_pending():
+            progress.set_changes_token(next_token)
+    except BaseException:
+        # Interrupted: drop queued copies; the ones already running still finish
+        # and record their progress before we return. Transfers stop first, so
+        # no copy worker stays blocked handing one over.
+        if transfers is not None:
+            transfers.close(cancel=True)
+        if lister is not None:
+            lister.close()
+        if pool is not None:
+            pool.close(cancel=True)
+        reporter.stop()
+        raise
+    if lister is not None:
+        lister.close()
+    if pool is not None:
+        pool.close()
+    reporter.stop()
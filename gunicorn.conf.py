@@ -0,0 +1,8 @@
+# Read by gunicorn from the directory it's started in.
+
+
+def worker_exit(server, worker):
+    """Stops the worker's fork jobs, so it exits without sitting out their retry pauses"""
+    # Imported here: the master process loads this file but never runs a job.
+    from jobs import shutdown
+    shutdown()
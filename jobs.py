@@ -0,0 +1,519 @@
+import os
+import re
+import json
+import hashlib
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime
+
+from google.oauth2.credentials import Credentials
+
+import metrics
+from corpus import CorpusIndex
+from drive_client import IdentityPool, drive_service
+from drive_copy import DEFAULT_WORKERS, CopyInterrupted, fork_folder, is_permanent, retry_failed, shutting_down
+from planner import Plan, plan_fork
+from progress_events import ProgressEvents
+from progress_store import close_failure_log, load_progress
+from structured_log import get_logger
+from transfer import DEFAULT_EXPORT_FORMAT, TransferPool
+from verifier import report_problems, verify_fork
+
+try:
+    import fcntl
+except ImportError:  # Windows: no cross-process job locking, run a single server process
+    fcntl = None
+
+# A job is one (account, source, destination) fork. Each gets its own directory
+# holding job.json, its progress and its failure log, so concurrent forks by the
+# same or different users never share state, and re-submitting a fork resumes it.
+JOBS_DIR = 'jobs'
+# Forks that may run at the same time in one server process.
+MAX_CONCURRENT_JOBS = 4
+# Seconds between writes of a running job's counters to job.json.
+HEARTBEAT_SECONDS = 5
+# Optional SQLite database (.db) holding every job's progress and failures, keyed
+# by job ID, instead of per-job JSON files; meant for forks of millions of items.
+PROGRESS_DB = os.environ.get('DRIVE_FORKER_PROGRESS_DB')
+
+# The fork settings create_job() defaults to. A job first queued as a plan or
+# from an older job.json has these until a fork of its own is queued.
+FORK_DEFAULTS = {
+    'workers': DEFAULT_WORKERS,
+    'batch': False,
+    'sync': False,
+    'replace': False,
+    'dedup': True,
+    'transfer': True,
+    'export_format': DEFAULT_EXPORT_FORMAT,
+    'corpus': False,
+    'verify': False,
+}
+
+QUEUED, RUNNING, COMPLETED, FAILED = 'queued', 'running', 'completed', 'failed'
+# Stopped by a server shutdown; picked up again by resume_jobs().
+INTERRUPTED = 'interrupted'
+
+log = get_logger('jobs')
+_executor = ThreadPoolExecutor(max_workers=MAX_CONCURRENT_JOBS, thread_name_prefix='fork-job')
+_lock = threading.Lock()
+# Jobs running in this process: job_id -> ProgressStore.
+_running = {}
+
+
+def _credentials(credentials, account, identities=()):
+    """Returns the fork's Credentials, or an IdentityPool when the user added more accounts to it."""
+    creds = Credentials(**credentials)
+    if not identities:
+        return creds
+    return IdentityPool([creds] + [Credentials(**identity['credentials']) for identity in identities],
+                        names=[account['email']] + [identity['email'] for identity in identities])
+
+
+def fork_key(account_id, source_id, dest_id):
+    """Returns the job ID for an account's fork of source_id into dest_id."""
+    return hashlib.sha256(f"{account_id}\0{source_id}\0{dest_id}".encode('utf-8')).hexdigest()[:32]
+
+
+def is_valid_job_id(job_id):
+    """Job IDs come from URLs; only accept the hex keys fork_key() produces."""
+    return re.fullmatch(r'[0-9a-f]{32}', job_id or '') is not None
+
+
+def job_dir(job_id):
+    return os.path.join(JOBS_DIR, job_id)
+
+
+def _job_file(job_id):
+    return os.path.join(job_dir(job_id), 'job.json')
+
+
+def progress_file(job_id):
+    return os.path.join(job_dir(job_id), 'progress.json')
+
+
+def failure_log_file(job_id):
+    return os.path.join(job_dir(job_id), 'failed_files.log')
+
+
+def plan_file(job_id):
+    return os.path.join(job_dir(job_id), 'plan.jsonl')
+
+
+def verify_report_file(job_id):
+    return os.path.join(job_dir(job_id), 'verify.jsonl')
+
+
+def _load_progress(job_id, read_only=False):
+    if PROGRESS_DB:
+        return load_progress(PROGRESS_DB, job_id, read_only)
+    progress = load_progress(progress_file(job_id), read_only=read_only)
+    progress.failure_log = failure_log_file(job_id)
+    return progress
+
+
+def _read_job(job_id):
+    if not is_valid_job_id(job_id):
+        return None
+    try:
+        with open(_job_file(job_id), 'r') as f:
+            return json.load(f)
+    except (OSError, ValueError):
+        return None
+
+
+def _write_job(job):
+    """
+    Writes job.json atomically so readers in other processes never see half a
+    file, readable by the server's user only: it holds the user's OAuth tokens.
+    """
+    path = _job_file(job['id'])
+    tmp_path = path + '.tmp'
+    with os.fdopen(os.open(tmp_path, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o600), 'w') as f:
+        json.dump(job, f, indent=4)
+    os.replace(tmp_path, path)
+
+
+def _update_job(job_id, **fields):
+    with _lock:
+        job = _read_job(job_id)
+        job.update(fields)
+        _write_job(job)
+        return job
+
+
+def _claim(job_id):
+    """Takes the job's lock file so only one server process runs it; None if taken."""
+    handle = open(os.path.join(job_dir(job_id), 'lock'), 'w')
+    if fcntl is not None:
+        try:
+            fcntl.flock(handle, fcntl.LOCK_EX | fcntl.LOCK_NB)
+        except OSError:
+            handle.close()
+            return None
+    return handle
+
+
+def _counts(progress):
+    return {
+        'copied_files': len(progress.copied_files),
+        # Subtract the root, which is mapped rather than created.
+        'created_folders': max(0, len(progress.folder_map) - 1),
+    }
+
+
+def _count_failures(progress):
+    """Items in the job's failure queue."""
+    return sum(progress.failure_counts().values())
+
+
+def _heartbeat(job_id, progress, stop):
+    while not stop.wait(HEARTBEAT_SECONDS):
+        _update_job(job_id, counts=_counts(progress), failures=_count_failures(progress))
+
+
+def _run_job(job_id):
+    lock_handle = _claim(job_id)
+    if lock_handle is None:
+        log.info("Job already running in another process", extra={'job_id': job_id})
+        return
+    if _read_job(job_id)['status'] in (COMPLETED, FAILED):
+        # Another process finished it while this one was waiting to start it.
+        lock_handle.close()
+        return
+
+    job = {**FORK_DEFAULTS, **_update_job(job_id, status=RUNNING, started_at=datetime.now().isoformat(), error=None)}
+    log.info("Job started", extra={'job_id': job_id, 'source_id': job['source_id'], 'dest_id': job['dest_id']})
+    progress = _load_progress(job_id)
+    progress.events = ProgressEvents()
+    with _lock:
+        _running[job_id] = progress
+        metrics.active_jobs.set(len(_running))
+    stop = threading.Event()
+    threading.Thread(target=_heartbeat, args=(job_id, progress, stop), daemon=True).start()
+
+    status, error = COMPLETED, None
+    plan = transfers = corpus = verification = None
+    retry = job.get('retry')
+    # A dry run walking the source, instead of the fork.
+    plan_only = job.get('plan_only', False)
+    summary = None if plan_only else job.get('plan')
+    # A verification pass on its own, or after the fork.
+    verify_only = job.get('verify_only', False)
+    verify = verify_only or (retry is None and not plan_only and job.get('verify', False))
+    forking = retry is None and not verify_only and not plan_only
+    try:
+        creds = _credentials(job['credentials'], job['account'], job.get('identities'))
+        if forking and not job.get('sync', False) and os.path.exists(plan_file(job_id)):
+            plan = Plan(plan_file(job_id))
+        if job.get('transfer', True) and not verify_only and not plan_only:
+            transfers = TransferPool(creds, failure_log=progress.failure_log,
+                                     export_format=job.get('export_format', DEFAULT_EXPORT_FORMAT))
+        with drive_service(creds) as service:
+            if plan_only:
+                # Saved with the job; the fork queued afterwards copies from its listings.
+                summary = plan_fork(service, creds, job['source_id'], plan_file(job_id), job['batch'])
+            elif retry is not None:
+                retry_failed(service, creds, progress, retry['reason'], job['workers'], job['batch'],
+                             job.get('dedup', True), transfers)
+            elif forking:
+                if job.get('corpus', False):
+                    corpus = CorpusIndex(service, job['source_id'])
+                fork_folder(service, creds, job['source_id'], job['dest_id'], progress,
+                            job['workers'], job['batch'], job.get('sync', False), job.get('replace', False),
+                            job.get('dedup', True), plan, transfers, corpus)
+            if verify:
+                verification = verify_fork(service, creds, progress, verify_report_file(job_id), job['workers'])
+        if plan is not None:
+            # Its listings are out of date once the fork is done.
+            os.remove(plan_file(job_id))
+    except CopyInterrupted:
+        # The server process is exiting (e.g. a worker restart), not a real failure.
+        status = INTERRUPTED
+    except Exception as e:
+        log.exception("Job failed", extra={'job_id': job_id})
+        status, error = FAILED, str(e)
+    finally:
+        stop.set()
+        if plan is not None:
+            plan.close()
+        if corpus is not None:
+            corpus.close()
+        if transfers is not None:
+            transfers.close()
+        failures = _count_failures(progress)
+        progress.close()
+        # Publish the final state before live readers lose the in-memory events.
+        # An interrupted retry, verification or plan is resumed as one. Any other
+        # run leaves the last verification's counts out of date.
+        resumable = status == INTERRUPTED
+        # Only a job resume_jobs() picks up again needs the user's tokens; a
+        # finished one re-queued later gets them from the user's session again.
+        tokens = {} if resumable else {
+            'credentials': None,
+            'identities': [{'email': identity['email']} for identity in job.get('identities', [])],
+        }
+        _update_job(job_id, status=status, error=error, finished_at=datetime.now().isoformat(),
+                    counts=_counts(progress), failures=failures, retry=retry if resumable else None,
+                    verify_only=verify_only and resumable, verification=verification,
+                    plan_only=plan_only and resumable, plan=summary, **tokens)
+        with _lock:
+            _running.pop(job_id, None)
+            metrics.active_jobs.set(len(_running))
+        lock_handle.close()
+    log.info("Job stopped", extra={'job_id': job_id, 'status': status})
+
+
+def _new_job(job_id, account, source_id, dest_id):
+    """Creates the directory of a job about to be queued for the first time and returns its job.json fields."""
+    os.makedirs(job_dir(job_id), exist_ok=True)
+    return {
+        'id': job_id,
+        'account': account,
+        'source_id': source_id,
+        'dest_id': dest_id,
+        'created_at': datetime.now().isoformat(),
+        **FORK_DEFAULTS,
+        'counts': {'copied_files': 0, 'created_folders': 0},
+        'failures': 0,
+    }
+
+
+def create_job(credentials, account, source_id, dest_id, workers=DEFAULT_WORKERS, batch=False,
+               sync=False, replace=False, dedup=True, transfer=True, export_format=DEFAULT_EXPORT_FORMAT,
+               identities=None, corpus=False, verify=False):
+    """
+    Queues the account's fork of source_id into dest_id and returns its job ID.
+
+    If that fork is already queued or running, its existing job ID is returned;
+    if it ran before, it is re-queued and resumes from its saved progress, or with
+    `sync` copies what changed since (see drive_copy.fork_folder). Without `dedup`
+    items already in the destination are copied again. With `transfer`, files
+    Drive won't copy are streamed, Google files as `export_format` (see transfer.py).
+    `identities` ({'email', 'credentials'} of more accounts the user signed in
+    with) spread the fork's calls over those accounts' quotas too. With `corpus`,
+    a source in a shared drive is listed in bulk (see corpus.CorpusIndex). With
+    `verify`, the copy is compared with the source once the fork is done (see
+    verify_job()).
+    """
+    job_id = fork_key(account['id'], source_id, dest_id)
+    with _lock:
+        job = _read_job(job_id)
+        if job is not None and job['status'] in (QUEUED, RUNNING):
+            return job_id
+        if job is None:
+            job = _new_job(job_id, account, source_id, dest_id)
+        elif not PROGRESS_DB and os.path.exists(failure_log_file(job_id)):
+            # Keep the last run's failure log aside; the failure queue carries over,
+            # and items that fail again count another attempt.
+            close_failure_log(failure_log_file(job_id))
+            os.replace(failure_log_file(job_id), failure_log_file(job_id) + '.previous')
+        job.update({
+            'status': QUEUED,
+            'workers': workers,
+            'batch': batch,
+            'sync': sync,
+            'replace': replace,
+            'dedup': dedup,
+            'transfer': transfer,
+            'export_format': export_format,
+            'corpus': corpus,
+            'verify': verify,
+            'retry': None,
+            'verify_only': False,
+            'plan_only': False,
+            # Kept so the job can be resumed after a restart without the user's
+            # session, until it completes or fails (see _run_job()).
+            'credentials': credentials,
+            'identities': identities or [],
+            'queued_at': datetime.now().isoformat(),
+            'started_at': None,
+            'finished_at': None,
+            'error': None,
+        })
+        _write_job(job)
+    _executor.submit(_run_job, job_id)
+    return job_id
+
+
+def retry_job(job_id, credentials, reason=None, identities=None):
+    """
+    Queues a retry pass over a job's failure queue (see drive_copy.retry_failed)
+    instead of a whole fork, optionally only for the failures with `reason`,
+    with the user's current `credentials` and `identities` (see create_job()).
+    Returns False if the job is queued or running already.
+    """
+    with _lock:
+        job = _read_job(job_id)
+        if job['status'] in (QUEUED, RUNNING):
+            return False
+        job.update({
+            'status': QUEUED,
+            'retry': {'reason': reason},
+            'verify_only': False,
+            'plan_only': False,
+            'credentials': credentials,
+            'identities': identities or [],
+            'queued_at': datetime.now().isoformat(),
+            'started_at': None,
+            'finished_at': None,
+            'error': None,
+        })
+        _write_job(job)
+    _executor.submit(_run_job, job_id)
+    return True
+
+
+def verify_job(job_id, credentials, identities=None):
+    """
+    Queues a pass comparing a job's copy with its source (see
+    verifier.verify_fork) instead of a fork, with the user's current
+    `credentials` and `identities` (see create_job()). The differences go to the
+    job's report (get_verification()), its counts to the job's `verification`.
+    Returns False if the job is queued or running already.
+    """
+    with _lock:
+        job = _read_job(job_id)
+        if job['status'] in (QUEUED, RUNNING):
+            return False
+        job.update({
+            'status': QUEUED,
+            'retry': None,
+            'verify_only': True,
+            'plan_only': False,
+            'credentials': credentials,
+            'identities': identities or [],
+            'queued_at': datetime.now().isoformat(),
+            'started_at': None,
+            'finished_at': None,
+            'error': None,
+        })
+        _write_job(job)
+    _executor.submit(_run_job, job_id)
+    return True
+
+
+def get_verification(job_id):
+    """Returns a generator of the problems in a job's verification report, or None if it has none."""
+    path = verify_report_file(job_id)
+    if not os.path.exists(path):
+        return None
+    return report_problems(path)
+
+
+def plan_job(credentials, account, source_id, dest_id, batch=False, identities=None):
+    """
+    Queues a dry run of the account's fork of source_id into dest_id: a walk of
+    the source that copies nothing. Its summary (see planner.plan_fork) becomes
+    the job's `plan` once it completes. Returns the job ID, or None if the fork
+    is queued or running already.
+
+    The plan is saved with the job, so queuing that fork afterwards copies from
+    the plan's listings instead of listing the source again.
+    """
+    job_id = fork_key(account['id'], source_id, dest_id)
+    with _lock:
+        job = _read_job(job_id)
+        if job is not None and job['status'] in (QUEUED, RUNNING):
+            return None
+        if job is None:
+            job = _new_job(job_id, account, source_id, dest_id)
+        job.update({
+            'status': QUEUED,
+            'batch': batch,
+            'retry': None,
+            'verify_only': False,
+            'plan_only': True,
+            'plan': None,
+            'credentials': credentials,
+            'identities': identities or [],
+            'queued_at': datetime.now().isoformat(),
+            'started_at': None,
+            'finished_at': None,
+            'error': None,
+        })
+        _write_job(job)
+    _executor.submit(_run_job, job_id)
+    return job_id
+
+
+def get_job(job_id, account_id=None):
+    """
+    Returns the public view of a job (never its credentials, only the email
+    addresses of its added accounts), or None if it
+    doesn't exist or, when account_id is given, belongs to another account.
+    """
+    job = _read_job(job_id)
+    if job is None or (account_id is not None and job['account']['id'] != account_id):
+        return None
+    job.pop('credentials', None)
+    job['identities'] = [identity['email'] for identity in job.get('identities', [])]
+    with _lock:
+        progress = _running.get(job_id)
+    if progress is not None:
+        # Live numbers when the job runs in this process.
+        job['counts'] = _counts(progress)
+        job['failures'] = _count_failures(progress)
+    return job
+
+
+def get_job_events(job_id):
+    """Returns the live ProgressEvents of a job running in this process, or None."""
+    with _lock:
+        progress = _running.get(job_id)
+    return progress.events if progress is not None else None
+
+
+def is_finished(job):
+    """True once a job will make no more progress in this server process."""
+    return job['status'] in (COMPLETED, FAILED, INTERRUPTED)
+
+
+def list_jobs(account_id):
+    """Returns the account's jobs, most recently queued first."""
+    if not os.path.isdir(JOBS_DIR):
+        return []
+    jobs = [get_job(job_id, account_id) for job_id in os.listdir(JOBS_DIR)]
+    return sorted((job for job in jobs if job), key=lambda job: job['queued_at'], reverse=True)
+
+
+def get_failures(job_id):
+    """Returns a job's failure queue, each failure marked permanent or not (see drive_copy.is_permanent)."""
+    job = _read_job(job_id)
+    transfer = job.get('transfer', True) if job else True
+    with _lock:
+        progress = _running.get(job_id)
+    if progress is not None:
+        failures = progress.failures()
+    else:
+        # The job may be running in another server process, which writes the same
+        # files: read them as they stand, without compacting them.
+        progress = _load_progress(job_id, read_only=True)
+        try:
+            failures = progress.failures()
+        finally:
+            progress.release()
+    for failure in failures:
+        failure['permanent'] = is_permanent(failure, transfer)
+    return failures
+
+
+def resume_jobs():
+    """Re-queues jobs that were unfinished when the server last stopped."""
+    if not os.path.isdir(JOBS_DIR):
+        return
+    for job_id in os.listdir(JOBS_DIR):
+        job = _read_job(job_id)
+        if job and job['status'] in (QUEUED, RUNNING, INTERRUPTED):
+            log.info("Resuming job from saved progress", extra={'job_id': job_id})
+            _executor.submit(_run_job, job_id)
+
+
+def shutdown():
+    """
+    Stops taking jobs as the server process exits. A job pausing between retry
+    passes is interrupted at once, and queued ones stay queued; resume_jobs()
+    picks both up on the next start.
+    """
+    shutting_down.set()
+    _executor.shutdown(wait=False, cancel_futures=True)
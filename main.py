@@ -118,33 +118,41 @@
 
 import os
 import sys
-import json
-import time
 import pickle
-from datetime import datetime
+import argparse
+import threading
+from collections import Counter
 
 # pip install google-api-python-client google-auth-httplib2 google-auth-oauthlib
 # ALSO ADDED REQUIRMENTS TO INSTALL USING `pip install -r requirements.txt`
 from google.auth.transport.requests import Request
 from google_auth_oauthlib.flow import InstalledAppFlow
-from googleapiclient.discovery import build
-from googleapiclient.errors import HttpError
+
+import metrics
+from corpus import CorpusIndex
+from drive_client import IdentityPool, build_service, user_limiter
+from drive_copy import (BATCH_SIZE, DEFAULT_WORKERS, FAILED_LOG_FILE, MAX_FAILURE_ATTEMPTS, execute_request,
+                        fork_folder, is_permanent, log_failure, retry_failed)
+from planner import PLAN_FILE, Plan, format_plan, plan_fork
+from progress_store import (PROGRESS_FILE, fork_job, fork_progress_path, is_sqlite_path, load_progress,
+                            migrate_json_to_sqlite)
+from structured_log import LOG_FORMAT, LOG_FORMATS, LOG_LEVEL, configure_logging
+from transfer import DEFAULT_EXPORT_FORMAT, EXPORT_FORMAT_NAMES, TRANSFER_WORKERS, TransferPool
+from verifier import VERIFY_REPORT, format_verification, verify_fork
 
 
 # 'drive' is full access, which is needed to read one account and write to another.
 SCOPES = ['https://www.googleapis.com/auth/drive']
 # Files to store credentials and progress
 TOKEN_FILE = 'token.pickle'
-PROGRESS_FILE = 'copy_progress.json'
-FAILED_LOG_FILE = 'failed_files.log'
 
 
-def authenticate():
-    """Handles user authentication for the Google Drive API."""
+def get_credentials(token_file=TOKEN_FILE):
+    """Loads, refreshes or obtains the OAuth credentials of the user whose tokens are in token_file."""
     creds = None
-    # The file TOKEN_FILE stores the user's access and refresh tokens.
-    if os.path.exists(TOKEN_FILE):
-        with open(TOKEN_FILE, 'rb') as token:
+    # The token file stores the user's access and refresh tokens.
+    if os.path.exists(token_file):
+        with open(token_file, 'rb') as token:
             creds = pickle.load(token)
 
     # If there are no (valid) credentials available, let the user log in.
@@ -156,150 +164,234 @@ def authenticate():
             flow = InstalledAppFlow.from_client_secrets_file('credentials.json', SCOPES)
             creds = flow.run_local_server(port=0)
         # Save the credentials for the next run
-        with open(TOKEN_FILE, 'wb') as token:
+        with open(token_file, 'wb') as token:
             pickle.dump(creds, token)
 
-    return build('drive', 'v3', credentials=creds)
-
-
-def load_progress():
-    """Loads the progress from a JSON file."""
-    if os.path.exists(PROGRESS_FILE):
-        with open(PROGRESS_FILE, 'r') as f:
-            return json.load(f)
-    # If no progress file, start with a clean slate.
-    # folder_map maps source folder IDs to their new destination IDs.
-    # copied_files is a list of source file IDs that have been successfully copied.
-    # THIS HANDLES IF ANY ERROR OCCURES YOU WON'T DUPLICATE FILES/FOLDERS
-    return {'folder_map': {}, 'copied_files': []}
-
-
-def save_progress(progress):
-    """Saves the current progress to a JSON file."""
-    with open(PROGRESS_FILE, 'w') as f:
-        json.dump(progress, f, indent=4)
+    return creds
 
 
-def log_failure(path, error):
-    """Logs a failed file or folder operation to the log file."""
-    with open(FAILED_LOG_FILE, 'a') as f:
-        f.write(f"[{datetime.now().isoformat()}] Path: {path} | Error: {str(error)}\n")
+def account_email(creds):
+    """Returns the email address of the account credentials belong to."""
+    about = execute_request(build_service(creds).about().get(fields='user(emailAddress)'))
+    return about['user']['emailAddress']
 
 
-def copy_folder_contents(service, source_folder_id, dest_folder_id, progress, path=""):
+def get_identities(token_files=()):
     """
-    Recursively copies files and folders from a source to a destination,
-    tracking progress and handling interruptions.
+    Returns the user's credentials or, given the token files of more accounts, an
+    IdentityPool of all of them named by email address (an account given twice
+    is used once).
     """
-    # Map the root source folder to the root destination folder to start
-    if source_folder_id not in progress['folder_map']:
-        progress['folder_map'][source_folder_id] = dest_folder_id
-        save_progress(progress)
-    
-    page_token = None
-    while True:
-        try:
-            response = service.files().list(
-                q=f"'{source_folder_id}' in parents and trashed=false",
-                fields="nextPageToken, files(id, name, mimeType)",
-                pageToken=page_token,
-                pageSize=100  # Adjust page size as needed (max 1000)
-            ).execute()
-        except HttpError as e:
-            print(f"❌ ERROR: Could not list files in folder ID '{source_folder_id}': {e}")
-            log_failure(f"{path}/<folder_listing_failed>", e)
-            return # Stop processing this folder if we can't list its contents
-
-        items = response.get('files', [])
-        
-        for item in items:
-            item_id = item['id']
-            item_name = item['name']
-            item_type = item['mimeType']
-            current_path = os.path.join(path, item_name)
-
-            if item_type == 'application/vnd.google-apps.folder':
-                # --- FOLDER ---
-                new_dest_folder_id = None
-                if item_id in progress['folder_map']:
-                    # This folder was already created in a previous run.
-                    print(f"⏭️  SKIPPING Folder (already created): {current_path}")
-                    new_dest_folder_id = progress['folder_map'][item_id]
-                else:
-                    # Create the new folder in the destination.
-                    print(f"📁 Creating folder: {current_path}...")
-                    folder_metadata = {
-                        'name': item_name,
-                        'mimeType': 'application/vnd.google-apps.folder',
-                        'parents': [dest_folder_id]
-                    }
-                    try:
-                        new_folder = service.files().create(body=folder_metadata, fields='id').execute()
-                        new_dest_folder_id = new_folder['id']
-                        # IMPORTANT: Save progress immediately after successful creation.
-                        progress['folder_map'][item_id] = new_dest_folder_id
-                        save_progress(progress)
-                    except HttpError as e:
-                        print(f"❌ ERROR creating folder '{current_path}': {e}")
-                        log_failure(current_path, e)
-                        continue # Skip to the next item
-                
-                # Recursively copy the contents of this subfolder.
-                copy_folder_contents(service, item_id, new_dest_folder_id, progress, current_path)
-
-            else:
-                # --- FILE ---
-                if item_id in progress['copied_files']:
-                    # This file was already copied in a previous run.
-                    print(f"⏭️  SKIPPING File (already copied): {current_path}")
-                    continue
-
-                print(f"📄 Copying file: {current_path}...")
-                # The body only needs the new parent folder ID. Name and other metadata are copied.
-                file_metadata = {'parents': [dest_folder_id]}
-                
-                retries = 3
-                for i in range(retries):
-                    try:
-                        service.files().copy(fileId=item_id, body=file_metadata).execute()
-                        # IMPORTANT: Save progress immediately after successful copy.
-                        progress['copied_files'].append(item_id)
-                        save_progress(progress)
-                        print(f"✅ Copied: {current_path}")
-                        break # Success, break the retry loop
-                    except HttpError as e:
-                        error_reason = json.loads(e.content).get('error', {}).get('errors', [{}])[0].get('reason', 'unknown')
-                        if error_reason in ['userRateLimitExceeded', 'rateLimitExceeded']:
-                            wait_time = (2 ** i) + 1 # Exponential backoff
-                            print(f"⏳ RATE LIMIT HIT. Waiting for {wait_time}s and retrying... ({i+1}/{retries})")
-                            time.sleep(wait_time)
-                        elif error_reason == 'cannotCopyFile':
-                            print(f"⚠️  SKIPPED (File not copyable): {current_path}")
-                            log_failure(current_path, f"Permission error: {error_reason}")
-                            break # Don't retry for permission errors
-                        else:
-                            print(f"❌ ERROR copying file '{current_path}': {e}")
-                            log_failure(current_path, e)
-                            break # Don't retry for other errors
-
-        page_token = response.get('nextPageToken')
-        if not page_token:
-            break # Exit the loop when all pages are processed
+    creds = get_credentials()
+    if not token_files:
+        return creds
+    accounts = {}
+    for credentials in [creds] + [get_credentials(token_file) for token_file in token_files]:
+        accounts.setdefault(account_email(credentials), credentials)
+    if len(accounts) == 1:
+        return creds
+    return IdentityPool(list(accounts.values()), names=list(accounts))
+
+
+def authenticate(token_files=()):
+    """Handles user authentication for the Google Drive API."""
+    return build_service(get_identities(token_files))
+
+
+def parse_args():
+    """Parses the command-line options."""
+    parser = argparse.ArgumentParser(description="Fork a Google Drive folder into another folder.")
+    parser.add_argument('--workers', type=int, default=DEFAULT_WORKERS,
+                        help=f"number of files copied concurrently (default: {DEFAULT_WORKERS})")
+    parser.add_argument('--batch', action='store_true',
+                        help=f"group copies and folder creations into batch requests of up to {BATCH_SIZE}")
+    parser.add_argument('--no-transfer', dest='transfer', action='store_false',
+                        help="log files Drive refuses to copy (cannotCopyFile) as failed instead of streaming "
+                             "them through this machine")
+    parser.add_argument('--transfer-workers', type=int, default=TRANSFER_WORKERS,
+                        help=f"number of files streamed concurrently, apart from the copies "
+                             f"(default: {TRANSFER_WORKERS})")
+    parser.add_argument('--export-format', default=DEFAULT_EXPORT_FORMAT, choices=EXPORT_FORMAT_NAMES,
+                        help=f"what streamed Google Docs, Sheets and Slides become: 'native' converts them back "
+                             f"into Google files, the others keep the exported file (default: "
+                             f"{DEFAULT_EXPORT_FORMAT})")
+    parser.add_argument('--identity', metavar='TOKEN_FILE', action='append', default=[],
+                        help=f"also make the fork's calls as the account whose tokens are saved in this file "
+                             f"(logging in on first use), so the fork gets that account's API quota as well as "
+                             f"'{TOKEN_FILE}'s; repeat for more accounts, each with access to both folders")
+    parser.add_argument('--progress-db', metavar='PATH',
+                        help=f"keep progress and failures in this SQLite database (.db), one job per fork, instead "
+                             f"of a '{PROGRESS_FILE}' file per fork; the fork's file is imported on first use")
+    parser.add_argument('--retry-failed', action='store_true',
+                        help="retry the items earlier runs could not copy and that may still succeed, "
+                             "instead of running the whole fork")
+    parser.add_argument('--retry-reason', metavar='REASON',
+                        help="retry only the items that failed with this Drive error reason (e.g. "
+                             "cannotCopyFile, after fixing its cause), even if it is permanent")
+    parser.add_argument('--sync', action='store_true',
+                        help="re-sync a fork made before: only copy files that are new or changed since")
+    parser.add_argument('--replace', action='store_true',
+                        help="with --sync: move the outdated copies of changed files to the trash")
+    parser.add_argument('--no-dedup', dest='dedup', action='store_false',
+                        help="copy every item, even if an identical one is already in the destination")
+    parser.add_argument('--corpus-listing', action='store_true',
+                        help="for a source in a shared drive: list the whole drive in bulk (1000 items per call) "
+                             "and copy from that index instead of listing every folder; pays off on trees of many "
+                             "small folders")
+    parser.add_argument('--plan', action='store_true',
+                        help=f"dry run: count the source tree and estimate the fork's API calls and duration, "
+                             f"saving the listings to --plan-file (default: '{PLAN_FILE}')")
+    parser.add_argument('--plan-file', metavar='PATH',
+                        help="with --plan: where to save the plan; otherwise: copy from this plan's listings "
+                             "instead of listing the source again")
+    parser.add_argument('--verify', action='store_true',
+                        help=f"instead of running the fork, compare the fork's copy with its source, "
+                             f"folder by folder, by name, size and md5Checksum, writing what is missing, extra or "
+                             f"mismatched to --verify-report (default: the fork's own '{VERIFY_REPORT}'); an interrupted "
+                             f"verification resumes")
+    parser.add_argument('--verify-report', metavar='PATH', help="with --verify: where to write the differences")
+    parser.add_argument('--metrics-file', metavar='PATH',
+                        help=f"write Prometheus metrics (API latency, errors, retries, throughput) to this file "
+                             f"every {metrics.DUMP_INTERVAL:g}s and when the fork ends")
+    parser.add_argument('--log-level', default=LOG_LEVEL, type=str.upper,
+                        choices=['DEBUG', 'INFO', 'WARNING', 'ERROR'],
+                        help=f"DEBUG logs every item; INFO logs periodic progress (default: {LOG_LEVEL})")
+    parser.add_argument('--log-format', default=LOG_FORMAT, choices=LOG_FORMATS,
+                        help=f"log lines written to stderr as JSON objects or plain text (default: {LOG_FORMAT})")
+    args = parser.parse_args()
+    if args.replace and not args.sync:
+        parser.error("--replace only applies to --sync")
+    if args.progress_db and not is_sqlite_path(args.progress_db):
+        parser.error("--progress-db must end in .db, .sqlite or .sqlite3")
+    if args.verify_report and not args.verify:
+        parser.error("--verify-report only applies to --verify")
+    if args.verify and (args.plan or args.retry_failed or args.retry_reason):
+        parser.error("--verify can't be combined with --plan or --retry-failed")
+    if args.plan_file and args.sync and not args.plan:
+        parser.error("--sync reads the changes feed; a plan's listings would only be out of date")
+    return args
+
+
+def holds_fork(progress, source_id, dest_id):
+    """True if the progress maps source_id to dest_id, i.e. is (also) the progress of that fork."""
+    return progress.folder_map.get(source_id) == dest_id
+
+
+def open_progress(progress_db, source_id, dest_id):
+    """
+    Loads the progress of the fork of source_id into dest_id: a JSON file of its
+    own (fork_progress_path()), or its own job in the SQLite database, into which
+    that file is imported on first use. Progress that earlier versions kept for
+    every fork in one store is used for as long as it holds this fork.
+    """
+    json_path = fork_progress_path(source_id, dest_id)
+    if not os.path.exists(json_path) and os.path.exists(PROGRESS_FILE):
+        legacy = load_progress(PROGRESS_FILE)
+        if holds_fork(legacy, source_id, dest_id):
+            if not progress_db:
+                return legacy
+            json_path = PROGRESS_FILE
+        legacy.close()
+    if not progress_db:
+        return load_progress(json_path)
+    job = fork_job(source_id, dest_id)
+    progress = load_progress(progress_db, job)
+    if len(progress.folder_map):
+        return progress
+    legacy = load_progress(progress_db)
+    if holds_fork(legacy, source_id, dest_id):
+        progress.close()
+        return legacy
+    legacy.close()
+    if os.path.exists(json_path):
+        progress.close()
+        folders, files = migrate_json_to_sqlite(json_path, progress_db, job, failure_log=FAILED_LOG_FILE)
+        print(f"Imported {files} copied files and {folders} folders from '{json_path}' into '{progress_db}'")
+        progress = load_progress(progress_db, job)
+    return progress
+
+
+def progress_location(progress):
+    """Where a fork's progress is kept, for the console."""
+    if is_sqlite_path(progress.path):
+        return f"'{progress.path}' (job {progress.job})"
+    return f"'{progress.path}'"
+
+
+def print_failures(progress, transfers=None):
+    """Prints the failure queue's counts by reason, marking the ones retrying won't fix."""
+    counts, permanent = Counter(), Counter()
+    for failure in progress.failures():
+        reason = failure['reason'] or 'unknown'
+        counts[reason] += 1
+        # Permanent by reason, or retried MAX_FAILURE_ATTEMPTS times already.
+        permanent[reason] += is_permanent(failure, transfers)
+    for reason, count in sorted(counts.items()):
+        if permanent[reason] == count:
+            note = ' (permanent)'
+        elif permanent[reason]:
+            note = f" ({permanent[reason]} permanent)"
+        else:
+            note = ''
+        print(f"  {count} failed: {reason}{note}")
+
+
+def print_rates(creds):
+    """Prints the request rate the limiter of each account settled at."""
+    if not isinstance(creds, IdentityPool):
+        limiter_stats = user_limiter(creds).stats()
+        print(f"Drive request rate settled at {limiter_stats['rate']}/s "
+              f"({limiter_stats['throttles']} rate-limit responses).")
+        return
+    active = creds.active()
+    print("Drive request rates settled at:")
+    for index, name in enumerate(creds.names):
+        limiter_stats = creds.limiter(index).stats()
+        print(f"  {name}: {limiter_stats['rate']}/s ({limiter_stats['throttles']} rate-limit responses)"
+              f"{'' if index in active else ', dropped after losing access'}")
 
 
 def main():
     """Main function to orchestrate the copying process."""
+    args = parse_args()
+    configure_logging(args.log_level, args.log_format)
     print("--- Google Drive Folder Forking Script ---")
     
     # Authenticate and get the service object
     try:
-        service = authenticate()
+        creds = get_identities(args.identity)
+        service = build_service(creds)
         print("✓ Authentication successful.")
+        if isinstance(creds, IdentityPool):
+            print(f"Calls are spread over {len(creds)} accounts: {', '.join(creds.names)}")
     except Exception as e:
         print(f"❌ Authentication failed: {e}")
         print("Please ensure your 'credentials.json' file is valid and in the same directory.")
         sys.exit(1)
 
+    if args.plan:
+        source_id = input("Enter the SOURCE folder ID: ").strip()
+        plan_file = args.plan_file or PLAN_FILE
+        print(f"\nPlanning the fork of {source_id}, nothing will be copied...")
+        try:
+            summary = plan_fork(service, creds, source_id, plan_file, args.batch)
+        except KeyboardInterrupt:
+            print("\n\n--- 🛑 Planning Interrupted by User ---")
+            return
+        print("\n--- 📋 Fork Plan ---")
+        for line in format_plan(summary):
+            print(line)
+        print(f"\nThe listings were saved to '{plan_file}'; fork with --plan-file {plan_file} to skip listing again.")
+        return
+
+    plan = None
+    if args.plan_file:
+        try:
+            plan = Plan(args.plan_file)
+        except (OSError, ValueError) as e:
+            print(f"❌ Could not read the plan: {e}")
+            sys.exit(1)
+
     # Get folder IDs from user
     source_id = input("Enter the SOURCE folder ID: ").strip()
     dest_id = input("Enter the DESTINATION folder ID: ").strip()
@@ -308,25 +400,93 @@ def main():
         print("❌ Both source and destination folder IDs are required.")
         sys.exit(1)
 
-    # Load existing progress
-    progress = load_progress()
+    progress = open_progress(args.progress_db, source_id, dest_id)
+    if args.verify:
+        report_file = args.verify_report or fork_progress_path(source_id, dest_id, VERIFY_REPORT)
+        try:
+            if not len(progress.folder_map):
+                print(f"❌ Nothing to verify: {progress_location(progress)} holds no progress of this fork.")
+                return
+            print(f"\nVerifying the fork in {progress_location(progress)} against its source, "
+                  f"writing the differences to '{report_file}'...")
+            summary = verify_fork(service, creds, progress, report_file, args.workers)
+        except KeyboardInterrupt:
+            print("\n\n--- 🛑 Verification Interrupted by User ---")
+            print("Rerun with --verify to pick up where it stopped.")
+            return
+        finally:
+            progress.close()
+        print("\n--- 🔍 Verification ---")
+        for line in format_verification(summary):
+            print(line)
+        if any(summary[problem] for problem in ('missing', 'extra', 'mismatched', 'unlisted')):
+            print(f"\nEvery difference is listed in '{report_file}'.")
+        else:
+            print("\n✨ The copy matches its source.")
+        return
+
+    transfers = None
+    if args.transfer:
+        transfers = TransferPool(creds, args.transfer_workers, progress.failure_log, args.export_format)
+    if args.retry_failed or args.retry_reason:
+        try:
+            retried, recovered = retry_failed(service, creds, progress, args.retry_reason, args.workers, args.batch,
+                                              args.dedup, transfers)
+            print(f"\nRetried {retried} failed items{f' (reason {args.retry_reason})' if args.retry_reason else ''}; "
+                  f"{recovered} made it.")
+            print_failures(progress, transfers)
+        except KeyboardInterrupt:
+            print("\n\n--- 🛑 Retry Interrupted by User ---")
+        finally:
+            if transfers is not None:
+                transfers.close()
+            progress.close()
+        return
 
     print("\nStarting the copy process...")
     print(f"Source:      {source_id}")
     print(f"Destination: {dest_id}")
-    print(f"Progress will be saved to '{PROGRESS_FILE}'")
-    print(f"Errors will be logged to '{FAILED_LOG_FILE}'\n")
-
+    print(f"Progress will be saved to {progress_location(progress)}")
+    print(f"Errors will be logged to '{args.progress_db or FAILED_LOG_FILE}'")
+    print(f"Copy workers: {args.workers}{' (batched requests)' if args.batch else ''}")
+    if args.sync:
+        print(f"Mode: re-sync, {'trashing' if args.replace else 'keeping'} outdated copies")
+    if not args.dedup:
+        print("Not checking the destination for items already copied")
+    if transfers is not None:
+        print(f"Files Drive won't copy are streamed: {args.transfer_workers} transfer workers, "
+              f"Google files exported as {args.export_format}")
+    if plan is not None:
+        print(f"Listings: from the plan made at {plan.created_at}; items added since are copied by a later --sync")
+    elif args.corpus_listing:
+        print("Listings: the source's shared drive is indexed in bulk before the copy")
+    if args.metrics_file:
+        print(f"Metrics will be written to '{args.metrics_file}'")
+    print()
+
+    metrics_stop = threading.Event()
+    if args.metrics_file:
+        metrics_writer = threading.Thread(target=metrics.dump_periodically, args=(args.metrics_file, metrics_stop),
+                                          daemon=True)
+        metrics_writer.start()
+
+    corpus = CorpusIndex(service, source_id) if args.corpus_listing else None
     try:
-        copy_folder_contents(service, source_id, dest_id, progress)
+        fork_folder(service, creds, source_id, dest_id, progress, args.workers, args.batch, args.sync, args.replace,
+                    args.dedup, plan, transfers, corpus)
         print("\n--- 🏁 Process Finished ---")
-        copied_files_count = len(progress.get('copied_files', []))
-        created_folders_count = len(progress.get('folder_map', {})) - 1 # Subtract the root
+        copied_files_count = len(progress.copied_files)
+        created_folders_count = len(progress.folder_map) - 1 # Subtract the root
         print(f"Summary: Copied {copied_files_count} files and created {created_folders_count} folders.")
-        if os.path.exists(FAILED_LOG_FILE):
-             print(f"⚠️  Some items failed to copy. Check '{FAILED_LOG_FILE}' for details.")
+        print_rates(creds)
+        if progress.failure_counts():
+            print(f"⚠️  Some items failed to copy. Details are in '{args.progress_db or FAILED_LOG_FILE}':")
+            print_failures(progress, transfers)
+            print(f"Rerun with --retry-failed to retry the ones not marked permanent "
+                  f"(each is tried up to {MAX_FAILURE_ATTEMPTS} times).")
         else:
             print("✨ All items copied successfully!")
+        print("Run with --verify to compare the copy with its source.")
 
     except KeyboardInterrupt:
         print("\n\n--- 🛑 Process Interrupted by User ---")
@@ -336,6 +496,14 @@ def main():
         print(f"Error: {e}")
         log_failure("FATAL_ERROR", e)
         print("Progress has been saved. You may be able to resume by rerunning the script.")
+    finally:
+        if transfers is not None:
+            transfers.close()
+        # Fold the journal into the snapshot so the next run starts from one file.
+        progress.close()
+        if args.metrics_file:
+            metrics_stop.set()
+            metrics_writer.join()
 
 
 if __name__ == '__main__':
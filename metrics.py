@@ -0,0 +1,175 @@
+import os
+import threading
+from bisect import bisect_left
+
+from rate_limiter import all_limiters
+
+# Upper bounds (seconds) of the Drive request latency histogram buckets.
+LATENCY_BUCKETS = (0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0)
+# Seconds between the metrics file dumps of `main.py --metrics-file`.
+DUMP_INTERVAL = 15.0
+CONTENT_TYPE = 'text/plain; version=0.0.4; charset=utf-8'
+
+# Every metric, in the order render() writes them.
+_registry = []
+
+
+def _label_key(labelnames, labels):
+    return tuple(str(labels[name]) for name in labelnames)
+
+
+def _escape(value):
+    return value.replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+
+def _format_labels(labelnames, key, extra=()):
+    pairs = list(zip(labelnames, key)) + list(extra)
+    if not pairs:
+        return ''
+    return '{' + ','.join(f'{name}="{_escape(value)}"' for name, value in pairs) + '}'
+
+
+class _Metric:
+    kind = None
+
+    def __init__(self, name, documentation, labelnames=()):
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = tuple(labelnames)
+        self._values = {}
+        self._lock = threading.Lock()
+        _registry.append(self)
+
+    def _header(self):
+        return [f"# HELP {self.name} {self.documentation}", f"# TYPE {self.name} {self.kind}"]
+
+
+class Counter(_Metric):
+    """A value that only goes up, per label combination."""
+    kind = 'counter'
+
+    def __init__(self, name, documentation, labelnames=()):
+        super().__init__(name, documentation, labelnames)
+        if not self.labelnames:
+            self._values[()] = 0
+
+    def inc(self, amount=1, **labels):
+        key = _label_key(self.labelnames, labels)
+        with self._lock:
+            self._values[key] = self._values.get(key, 0) + amount
+
+    def render(self):
+        with self._lock:
+            values = sorted(self._values.items())
+        return self._header() + [f"{self.name}{_format_labels(self.labelnames, key)} {value}"
+                                 for key, value in values]
+
+
+class Gauge(Counter):
+    """A value that goes up and down; `collect`, if given, computes it at render time."""
+    kind = 'gauge'
+
+    def __init__(self, name, documentation, labelnames=(), collect=None):
+        super().__init__(name, documentation, labelnames)
+        self.collect = collect
+
+    def dec(self, amount=1, **labels):
+        self.inc(-amount, **labels)
+
+    def set(self, value, **labels):
+        key = _label_key(self.labelnames, labels)
+        with self._lock:
+            self._values[key] = value
+
+    def render(self):
+        if self.collect is not None:
+            for labels, value in self.collect():
+                self.set(value, **labels)
+        return super().render()
+
+
+class Histogram(_Metric):
+    """Observations counted into cumulative `buckets`, with their sum and count."""
+    kind = 'histogram'
+
+    def __init__(self, name, documentation, labelnames=(), buckets=LATENCY_BUCKETS):
+        super().__init__(name, documentation, labelnames)
+        self.buckets = tuple(buckets)
+
+    def observe(self, value, **labels):
+        key = _label_key(self.labelnames, labels)
+        with self._lock:
+            counts, total = self._values.get(key, ([0] * (len(self.buckets) + 1), 0.0))
+            counts[bisect_left(self.buckets, value)] += 1
+            self._values[key] = (counts, total + value)
+
+    def render(self):
+        with self._lock:
+            values = sorted((key, (list(counts), total)) for key, (counts, total) in self._values.items())
+        lines = self._header()
+        for key, (counts, total) in values:
+            cumulative = 0
+            for bound, count in zip(self.buckets + ('+Inf',), counts):
+                cumulative += count
+                labels = _format_labels(self.labelnames, key, [('le', str(bound))])
+                lines.append(f"{self.name}_bucket{labels} {cumulative}")
+            lines.append(f"{self.name}_sum{_format_labels(self.labelnames, key)} {total}")
+            lines.append(f"{self.name}_count{_format_labels(self.labelnames, key)} {cumulative}")
+        return lines
+
+
+def _limiter_rates():
+    return [({'limiter': key}, stats['rate']) for key, stats in all_limiters().items()]
+
+
+# --- Drive forker metrics ---
+
+api_requests = Counter('drive_api_requests_total', "Drive API calls by method, HTTP status and error reason.",
+                       ('method', 'status', 'reason'))
+api_latency = Histogram('drive_api_request_duration_seconds',
+                        "Drive API round-trip latency by method; a batch is one round-trip.", ('method',))
+api_retries = Counter('drive_api_retries_total', "Drive API calls retried after a rate limit, by method.",
+                      ('method',))
+files_copied = Counter('drive_files_copied_total', "Files copied.")
+bytes_copied = Counter('drive_bytes_copied_total', "Bytes of the files copied (Google Docs count as 0).")
+copy_queue = Gauge('drive_copy_queue_depth', "Copies queued or running on the copy workers.")
+bytes_transferred = Counter('drive_bytes_transferred_total',
+                            "Bytes streamed through this process for files Drive would not copy server-side.")
+transfer_queue = Gauge('drive_transfer_queue_depth', "Streamed transfers queued or running on the transfer workers.")
+identity_failovers = Counter('drive_identity_failovers_total',
+                             "Calls moved off an identity of an account pool, by identity (an opaque "
+                             "label, see drive_client.identity_label) and cause (rate_limit or access).",
+                             ('identity', 'cause'))
+list_queue = Gauge('drive_list_queue_depth', "Folder pages being listed ahead of the copy.")
+active_jobs = Gauge('drive_active_jobs', "Fork jobs running in this process.")
+request_rate = Gauge('drive_rate_limit_requests_per_second', "Current target rate of each Drive rate limiter.",
+                     ('limiter',), collect=_limiter_rates)
+
+
+def request_method(request):
+    """Names a Drive request for its metrics labels, e.g. 'files.copy'."""
+    method = getattr(request, 'methodId', None) or getattr(request, 'method', None) or 'unknown'
+    return method[len('drive.'):] if method.startswith('drive.') else method
+
+
+def render():
+    """Returns every metric in the Prometheus text exposition format."""
+    lines = []
+    for metric in _registry:
+        lines.extend(metric.render())
+    return '\n'.join(lines) + '\n'
+
+
+def write_file(path):
+    """Writes render() to path atomically, e.g. for node_exporter's textfile collector."""
+    tmp_path = path + '.tmp'
+    with open(tmp_path, 'w') as f:
+        f.write(render())
+    os.replace(tmp_path, path)
+
+
+def dump_periodically(path, stop, interval=DUMP_INTERVAL):
+    """Rewrites the metrics file every `interval` seconds until `stop` is set, then once more."""
+    while not stop.wait(interval):
+        write_file(path)
+    write_file(path)
@@ -0,0 +1,244 @@
+import os
+import json
+import math
+from collections import Counter
+from datetime import datetime
+
+from googleapiclient.errors import HttpError
+
+from drive_client import IdentityPool
+from drive_copy import BATCH_SIZE, FOLDER_MIME_TYPE, FolderLister, get_changes_token, list_pages
+from rate_limiter import get_limiter
+from structured_log import get_logger
+
+# Where `main.py --plan` saves the plan, one JSON line per listing page.
+PLAN_FILE = 'fork_plan.jsonl'
+PLAN_VERSION = 1
+# Enough to count a tree. A saved plan also keeps what the copy needs from each
+# listing (drive_copy.LIST_FIELDS), so it can stand in for it.
+COUNT_FIELDS = "nextPageToken, files(id, mimeType, size, capabilities/canCopy)"
+PLAN_FIELDS = ("nextPageToken, files(id, name, mimeType, size, modifiedTime, md5Checksum, version, "
+               "shortcutDetails/targetId, capabilities/canCopy)")
+# Google types files().copy always refuses, whatever capabilities.canCopy says.
+NON_COPYABLE_TYPES = {
+    'application/vnd.google-apps.site',
+    'application/vnd.google-apps.map',
+    'application/vnd.google-apps.fusiontable',
+}
+
+log = get_logger('planner')
+
+
+def is_copyable(item):
+    """False for items Drive will refuse to copy."""
+    return item['mimeType'] not in NON_COPYABLE_TYPES and item.get('capabilities', {}).get('canCopy', True)
+
+
+def plan_fork(service, credentials, source_folder_id, plan_path=None, batch=False):
+    """
+    Walks the source tree without copying anything and returns what forking it
+    would take (see estimate()).
+
+    Only counts are kept in memory, with the folders still to list, so a tree of
+    millions of files walks in constant memory. With `plan_path`, every listing
+    page is also written there, so the fork can replay the plan (Plan) instead of
+    listing the tree again.
+    """
+    summary = {
+        'source_id': source_folder_id,
+        'folders': 0,
+        'files': 0,
+        'bytes': 0,
+        # Google Docs, Sheets, ... have no size of their own.
+        'native_files': 0,
+        'non_copyable': Counter(),
+        'list_calls': 0,
+        'unlisted_folders': 0,
+    }
+    header = {'plan': PLAN_VERSION, 'source_id': source_folder_id, 'created_at': datetime.now().isoformat(),
+              # Read first, so a fork made from the plan re-syncs everything changed since.
+              'changes_token': get_changes_token(service)}
+    tmp_path = plan_path + '.tmp' if plan_path else None
+    out = open(tmp_path, 'w') if plan_path else None
+    lister = FolderLister(service, credentials, fields=PLAN_FIELDS if plan_path else COUNT_FIELDS)
+    identities = len(credentials) if isinstance(credentials, IdentityPool) else 1
+    try:
+        if out:
+            out.write(json.dumps(header) + '\n')
+        stack = [source_folder_id]
+        while stack:
+            lister.prefetch_all((folder_id, None) for folder_id in reversed(stack))
+            folder_id = stack.pop()
+            summary['folders'] += 1
+            page_token = None
+            try:
+                for response in lister.pages(folder_id):
+                    summary['list_calls'] += 1
+                    if out:
+                        out.write(json.dumps({'folder': folder_id, 'token': page_token, 'response': response}) + '\n')
+                    page_token = response.get('nextPageToken')
+                    for item in response.get('files', []):
+                        if item['mimeType'] == FOLDER_MIME_TYPE:
+                            stack.append(item['id'])
+                            continue
+                        summary['files'] += 1
+                        if 'size' in item:
+                            summary['bytes'] += int(item['size'])
+                        else:
+                            summary['native_files'] += 1
+                        if not is_copyable(item):
+                            summary['non_copyable'][item['mimeType']] += 1
+            except HttpError as e:
+                # Its contents are left out of the counts; the fork lists it itself.
+                log.error("Could not list folder", extra={'folder_id': folder_id, 'error': str(e)})
+                summary['unlisted_folders'] += 1
+        summary['non_copyable'] = dict(summary['non_copyable'])
+        summary.update(estimate(summary, batch, reuse_plan=plan_path is not None, identities=identities))
+        if out:
+            out.write(json.dumps({'summary': summary}) + '\n')
+            out.close()
+            os.replace(tmp_path, plan_path)
+    finally:
+        lister.close()
+        if out and not out.closed:
+            # Interrupted: a partial plan would leave folders out of the copy.
+            out.close()
+            os.remove(tmp_path)
+    return summary
+
+
+def estimate(summary, batch=False, reuse_plan=True, identities=1):
+    """
+    Returns the API calls, HTTP round-trips and ETA a fork of the planned tree needs.
+
+    Every call goes through a rate limiter, one per account of the fork, so the
+    ETA is the call count over their highest combined rate: a lower bound, reached
+    once the limiters have ramped up and only if Drive never pushes back. With
+    `reuse_plan` the source isn't listed again.
+    """
+    rate = get_limiter().max_rate * identities
+    copies = summary['files'] - sum(summary['non_copyable'].values())
+    creates = summary['folders'] - 1
+    lists = 0 if reuse_plan else summary['list_calls']
+    calls = {'list': lists, 'create': creates, 'copy': copies}
+    if batch:
+        round_trips = lists + math.ceil(creates / BATCH_SIZE) + math.ceil(copies / BATCH_SIZE)
+    else:
+        round_trips = sum(calls.values())
+    return {
+        'api_calls': calls,
+        'round_trips': round_trips,
+        'eta_seconds': round(sum(calls.values()) / rate),
+        'requests_per_second': rate,
+    }
+
+
+def format_plan(summary):
+    """Returns the plan summary as lines of text for the console."""
+    lines = [
+        f"Folders:      {summary['folders']}",
+        f"Files:        {summary['files']} ({summary['native_files']} Google Docs/Sheets/... without a size)",
+        f"Total size:   {summary['bytes'] / 1024 ** 3:.2f} GiB",
+        f"API calls:    {sum(summary['api_calls'].values())} ({summary['api_calls']['copy']} copies, "
+        f"{summary['api_calls']['create']} folder creations, {summary['api_calls']['list']} listings); "
+        f"{summary['round_trips']} HTTP round-trips",
+        f"ETA:          at least {summary['eta_seconds'] // 3600}h {summary['eta_seconds'] % 3600 // 60}m "
+        f"{summary['eta_seconds'] % 60}s at {summary.get('requests_per_second', get_limiter().max_rate):g} "
+        f"requests/s",
+    ]
+    for mime_type, count in sorted(summary['non_copyable'].items()):
+        lines.append(f"Not copyable: {count} x {mime_type}")
+    if summary['unlisted_folders']:
+        lines.append(f"Unlisted:     {summary['unlisted_folders']} folders could not be listed and aren't counted")
+    return lines
+
+
+class Plan:
+    """
+    A plan saved by plan_fork(). Only the position of each listing page in the
+    file is held in memory; the pages themselves are read back as the fork
+    reaches them.
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self.summary = None
+        self._offsets = {}
+        self._file = open(path, 'rb')
+        header = json.loads(self._file.readline())
+        if header.get('plan') != PLAN_VERSION:
+            self._file.close()
+            raise ValueError(f"'{path}' is not a plan this version can read")
+        self.source_id = header['source_id']
+        self.created_at = header['created_at']
+        self.changes_token = header.get('changes_token')
+        while True:
+            offset = self._file.tell()
+            line = self._file.readline()
+            if not line:
+                break
+            record = json.loads(line)
+            if 'summary' in record:
+                self.summary = record['summary']
+            else:
+                self._offsets[(record['folder'], record['token'])] = offset
+
+    def has_page(self, folder_id, page_token=None):
+        return (folder_id, page_token) in self._offsets
+
+    def page(self, folder_id, page_token=None):
+        """Returns the saved listing page, or None if the plan doesn't have it."""
+        offset = self._offsets.get((folder_id, page_token))
+        if offset is None:
+            return None
+        self._file.seek(offset)
+        return json.loads(self._file.readline())['response']
+
+    def lister(self, service, fallback=None):
+        """Returns a lister that replays this plan, and lists what it lacks with `fallback` (a FolderLister)."""
+        return PlannedLister(self, service, fallback)
+
+    def close(self):
+        self._file.close()
+
+
+class PlannedLister:
+    """Stands in for FolderLister during a fork, serving listings from a Plan (or a corpus.CorpusIndex)."""
+
+    def __init__(self, plan, service, fallback=None):
+        self.plan = plan
+        self.service = service
+        self.fallback = fallback
+
+    def prefetch(self, folder_id, page_token=None):
+        if self.plan.has_page(folder_id, page_token):
+            return True
+        return self.fallback.prefetch(folder_id, page_token) if self.fallback else True
+
+    def prefetch_all(self, pages):
+        for folder_id, page_token in pages:
+            if not self.prefetch(folder_id, page_token):
+                return
+
+    def discard(self, folder_id, page_token=None):
+        if self.fallback:
+            self.fallback.discard(folder_id, page_token)
+
+    def pages(self, folder_id, page_token=None):
+        """Yields a folder's pages from the plan; a folder it lacks (e.g. made since) is listed."""
+        while True:
+            response = self.plan.page(folder_id, page_token)
+            if response is None:
+                live = self.fallback.pages(folder_id, page_token) if self.fallback else \
+                    list_pages(self.service, folder_id, page_token)
+                yield from live
+                return
+            yield response
+            page_token = response.get('nextPageToken')
+            if not page_token:
+                return
+
+    def close(self):
+        if self.fallback:
+            self.fallback.close()
+        self.plan.close()
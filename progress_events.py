@@ -0,0 +1,72 @@
+import time
+import threading
+from collections import deque
+
+# Per-item events kept for subscribers; older ones are only reflected in the counters.
+RECENT_EVENTS = 200
+# Most per-item events a subscriber receives in one coalesced update.
+MAX_EVENTS_PER_UPDATE = 20
+# Seconds of history used for the throughput figure.
+THROUGHPUT_WINDOW = 30.0
+
+KINDS = ('discovered', 'folder_created', 'copied', 'skipped', 'failed')
+
+
+class ProgressEvents:
+    """
+    Counters and a short history of what a running copy is doing.
+
+    The copy engine calls emit() once per item; readers call update() on their own
+    schedule and get one coalesced summary (counts, throughput, ETA) plus the
+    item events they have not seen yet, so a fast job never floods a client.
+    """
+
+    def __init__(self):
+        self.started = time.monotonic()
+        self.counts = dict.fromkeys(KINDS, 0)
+        self._recent = deque(maxlen=RECENT_EVENTS)
+        self._done_times = deque()
+        self._seq = 0
+        self._lock = threading.Lock()
+
+    def emit(self, kind, path=None, detail=None):
+        """Records one item event (see KINDS)."""
+        with self._lock:
+            self.counts[kind] += 1
+            if kind == 'discovered':
+                return # Counted only; listing would drown out the interesting events
+            self._seq += 1
+            self._recent.append({'seq': self._seq, 'kind': kind, 'path': path, 'detail': detail})
+            if kind in ('copied', 'skipped', 'failed'):
+                now = time.monotonic()
+                self._done_times.append(now)
+                while self._done_times and now - self._done_times[0] > THROUGHPUT_WINDOW:
+                    self._done_times.popleft()
+
+    def update(self, since_seq=0):
+        """Returns the summary plus up to MAX_EVENTS_PER_UPDATE events after since_seq."""
+        with self._lock:
+            now = time.monotonic()
+            window = min(THROUGHPUT_WINDOW, now - self.started) or 1.0
+            while self._done_times and now - self._done_times[0] > THROUGHPUT_WINDOW:
+                self._done_times.popleft()
+            throughput = len(self._done_times) / window
+            counts = dict(self.counts)
+            # Only files listed so far are known, so this is an ETA for those.
+            remaining = counts['discovered'] - counts['copied'] - counts['skipped'] - counts['failed']
+            new_events = [event for event in self._recent if event['seq'] > since_seq]
+            return {
+                'seq': self._seq,
+                'counts': counts,
+                'elapsed_seconds': round(now - self.started, 1),
+                'files_per_second': round(throughput, 2),
+                'eta_seconds': round(remaining / throughput) if throughput and remaining > 0 else None,
+                'dropped_events': max(0, len(new_events) - MAX_EVENTS_PER_UPDATE),
+                'events': new_events[-MAX_EVENTS_PER_UPDATE:],
+            }
+
+
+def emit(progress, kind, path=None, detail=None):
+    """Forwards an item event to the progress' listener, if one is attached."""
+    if progress.events is not None:
+        progress.events.emit(kind, path, detail)
@@ -0,0 +1,797 @@
+import os
+import re
+import sys
+import json
+import time
+import bisect
+import hashlib
+import sqlite3
+import threading
+from datetime import datetime
+
+# The snapshot holds the compacted progress; the journal next to it holds every
+# folder/file completed since the last compaction, one short line per item.
+PROGRESS_FILE = 'copy_progress.json'
+JOURNAL_SUFFIX = '.journal'
+# Minimum number of journal records before it is folded back into the snapshot.
+# The threshold also grows with the snapshot so compaction stays amortized O(1).
+COMPACT_EVERY = 5000
+# Snapshot layout version; version 1 was the old indented dict with a copied_files list,
+# version 2 had no traversal frontier, version 3 no file versions, version 4 no failure queue.
+SNAPSHOT_VERSION = 5
+FAILED_LOG_FILE = 'failed_files.log'
+# Progress paths with these extensions use the SQLite backend instead of JSON.
+SQLITE_EXTENSIONS = ('.db', '.sqlite', '.sqlite3')
+# Job name used when a SQLite database holds a single fork (the CLI).
+DEFAULT_JOB = 'default'
+# The SQLite backend commits after this many records or seconds, whichever is first.
+# Ctrl-C and errors still commit on close(); only a hard kill can lose the batch.
+COMMIT_EVERY = 100
+COMMIT_INTERVAL = 1.0
+# Mapped folders read per query when the SQLite backend streams them in order.
+FOLDER_PAGE_SIZE = 1000
+
+_failure_lock = threading.Lock()
+# Failure logs stay open between failures; line buffering keeps them readable while a job runs.
+_failure_logs = {}
+
+
+def log_failure(path, error, log_file=None):
+    """Logs a failed file or folder operation to the log file."""
+    log_file = log_file or FAILED_LOG_FILE
+    with _failure_lock:
+        f = _failure_logs.get(log_file)
+        if f is None:
+            f = _failure_logs[log_file] = open(log_file, 'a', buffering=1)
+        f.write(f"[{datetime.now().isoformat()}] Path: {path} | Error: {str(error)}\n")
+
+
+def close_failure_log(log_file=None):
+    """Closes a failure log log_failure() kept open, so it can be moved or removed."""
+    with _failure_lock:
+        f = _failure_logs.pop(log_file or FAILED_LOG_FILE, None)
+    if f is not None:
+        f.close()
+
+
+class ProgressStore:
+    """Progress of a copy job: a JSON snapshot plus an append-only journal."""
+
+    def __init__(self, path=PROGRESS_FILE, compact_every=COMPACT_EVERY):
+        self.path = path
+        self.journal_path = path + JOURNAL_SUFFIX
+        self.compact_every = compact_every
+        # folder_map maps source folder IDs to their new destination IDs.
+        # copied_files is a set of source file IDs that have been successfully copied,
+        # so the skip check on resume is a hash lookup rather than a list scan.
+        self.folder_map = {}
+        self.copied_files = set()
+        # The traversal's frontier: source folders that exist in the destination but
+        # whose contents aren't fully copied yet, mapped to (dest_id, path, page_token).
+        # Folders whose contents are complete move to done_folders and are never re-listed.
+        self.frontier = {}
+        self.done_folders = set()
+        # For re-syncs: source file ID -> "dest_id fingerprint" of its copy (see
+        # drive_copy.file_fingerprint), and the Drive changes feed position that
+        # the next re-sync reads from.
+        self.file_versions = {}
+        self.changes_token = None
+        # The failure queue: failed items still to retry, by failure ID (see add_failure()).
+        self._failures = {}
+        self._failure_ids = {}
+        self._next_failure_id = 1
+        # Where copy failures for this job are logged; None means the shared log file.
+        self.failure_log = None
+        # Optional ProgressEvents that live progress readers subscribe to.
+        self.events = None
+        self._journal = None
+        self._journal_records = 0
+        # Copy workers record progress concurrently; the lock keeps the in-memory
+        # state and the journal in the same order.
+        self._lock = threading.Lock()
+
+    def load(self, repair=True):
+        """
+        Reads the snapshot and replays the journal on top of it. Without `repair`
+        nothing on disk is changed: a torn last line, which may be a record
+        another process is appending right now, is skipped but left in place.
+        """
+        if os.path.exists(self.path):
+            with open(self.path, 'r') as f:
+                snapshot = json.load(f)
+            self.folder_map = {sys.intern(src): sys.intern(dst)
+                               for src, dst in snapshot.get('folder_map', {}).items()}
+            copied = snapshot.get('copied_files', '')
+            if isinstance(copied, list):
+                # Version 1 snapshot (or an old copy_progress.json) stored a JSON list.
+                self.copied_files = set(copied)
+            else:
+                self.copied_files = set(copied.split())
+            self.frontier = {src: tuple(entry) for src, entry in snapshot.get('frontier', {}).items()}
+            self.done_folders = set(snapshot.get('done_folders', '').split())
+            self.file_versions = snapshot.get('file_versions', {})
+            self.changes_token = snapshot.get('changes_token')
+            for failure in snapshot.get('failures', []):
+                self._set_failure(failure)
+
+        if os.path.exists(self.journal_path):
+            good_offset = 0
+            with open(self.journal_path, 'rb') as f:
+                for raw in f:
+                    if not raw.endswith(b'\n'):
+                        # Torn write from a crash mid-append; everything before it is intact.
+                        break
+                    good_offset += len(raw)
+                    line = raw.decode('utf-8').rstrip('\n')
+                    if line.startswith('X '):
+                        # A failure queue entry, added or updated.
+                        self._set_failure(json.loads(line[2:]))
+                        self._journal_records += 1
+                        continue
+                    record = line.split(' ', 4)
+                    if not record[0]:
+                        continue
+                    if record[0] == 'D':
+                        self.folder_map[sys.intern(record[1])] = sys.intern(record[2])
+                    elif record[0] == 'F':
+                        self.copied_files.add(record[1])
+                        if len(record) == 4:
+                            self.file_versions[record[1]] = f"{record[2]} {record[3]}"
+                    elif record[0] == 'P':
+                        # A stale journal may re-pend a folder the snapshot has as done.
+                        if record[1] not in self.done_folders:
+                            page_token = None if record[3] == '-' else record[3]
+                            self.frontier[record[1]] = (record[2], json.loads(record[4]), page_token)
+                    elif record[0] == 'C':
+                        self.frontier.pop(record[1], None)
+                        self.done_folders.add(record[1])
+                    elif record[0] == 'R':
+                        self.frontier.clear()
+                        self.done_folders.clear()
+                    elif record[0] == 'T':
+                        self.changes_token = record[1]
+                    elif record[0] == 'Y':
+                        self._drop_failure(int(record[1]))
+                    elif record[0] == 'Z':
+                        self._failures.clear()
+                        self._failure_ids.clear()
+                    self._journal_records += 1
+            # Drop the torn tail so the next append starts on a fresh line.
+            if repair and good_offset != os.path.getsize(self.journal_path):
+                with open(self.journal_path, 'r+b') as f:
+                    f.truncate(good_offset)
+        return self
+
+    def add_folder(self, source_id, dest_id):
+        """Records a created (or mapped) destination folder."""
+        # Folder IDs recur as parents throughout a job, so keep one copy of each.
+        source_id, dest_id = sys.intern(source_id), sys.intern(dest_id)
+        with self._lock:
+            self.folder_map[source_id] = dest_id
+            self._append(f"D {source_id} {dest_id}\n")
+
+    def add_file(self, source_id, dest_id=None, fingerprint=None):
+        """Records a successfully copied file, with its copy's ID and source fingerprint if known."""
+        with self._lock:
+            self.copied_files.add(source_id)
+            if fingerprint is None:
+                self._append(f"F {source_id}\n")
+            else:
+                self.file_versions[source_id] = f"{dest_id or '-'} {fingerprint}"
+                self._append(f"F {source_id} {dest_id or '-'} {fingerprint}\n")
+
+    def file_version(self, source_id):
+        """Returns (dest_id, fingerprint) recorded for a copied file, or None."""
+        version = self.file_versions.get(source_id)
+        if version is None:
+            return None
+        dest_id, fingerprint = version.split(' ', 1)
+        return (None if dest_id == '-' else dest_id), fingerprint
+
+    def mapped_folders(self, after=None):
+        """Yields (source_id, dest_id) of every mapped folder in source ID order, after `after` if given."""
+        with self._lock:
+            source_ids = sorted(self.folder_map)
+        for index in range(bisect.bisect_right(source_ids, after) if after is not None else 0, len(source_ids)):
+            yield source_ids[index], self.folder_map[source_ids[index]]
+
+    def set_changes_token(self, page_token):
+        """Records where the next re-sync starts reading the Drive changes feed."""
+        with self._lock:
+            self.changes_token = page_token
+            self._append(f"T {page_token}\n")
+
+    def reset_traversal(self):
+        """Forgets which folders are complete, so the next run walks the whole tree again."""
+        with self._lock:
+            self.frontier.clear()
+            self.done_folders.clear()
+            self._append("R\n")
+
+    def set_pending(self, source_id, dest_id, path, page_token=None):
+        """Records that a folder's contents must be copied, from page_token on."""
+        with self._lock:
+            self.frontier[source_id] = (dest_id, path, page_token)
+            # The path goes last and JSON-quoted: names may contain spaces or newlines.
+            self._append(f"P {source_id} {dest_id} {page_token or '-'} {json.dumps(path)}\n")
+
+    def complete_folder(self, source_id):
+        """Records that every item directly in a folder has been copied."""
+        with self._lock:
+            self.frontier.pop(source_id, None)
+            self.done_folders.add(source_id)
+            self._append(f"C {source_id}\n")
+
+    def pending_folders(self):
+        """Returns the frontier as (source_id, dest_id, path, page_token) tuples, oldest first."""
+        with self._lock:
+            return [(src, dst, path, page_token) for src, (dst, path, page_token) in self.frontier.items()]
+
+    def has_pending(self):
+        """True while the frontier holds a folder."""
+        return bool(self.frontier)
+
+    def newest_pending(self, limit, skip=()):
+        """Returns up to `limit` frontier entries not in `skip`, newest first, like pending_folders()."""
+        entries = []
+        with self._lock:
+            for src in reversed(self.frontier):
+                if src in skip:
+                    continue
+                dst, path, page_token = self.frontier[src]
+                entries.append((src, dst, path, page_token))
+                if len(entries) == limit:
+                    break
+        return entries
+
+    def _append(self, line):
+        if self._journal is None:
+            self._journal = open(self.journal_path, 'a', encoding='utf-8')
+        self._journal.write(line)
+        # Flush per record so an interrupted process loses at most the line in flight.
+        self._journal.flush()
+        self._journal_records += 1
+        snapshot_size = len(self.folder_map) + len(self.copied_files)
+        if self._journal_records >= max(self.compact_every, snapshot_size):
+            self._compact()
+
+    def compact(self):
+        """Writes a fresh snapshot atomically and empties the journal."""
+        with self._lock:
+            self._compact()
+
+    def _compact(self):
+        tmp_path = self.path + '.tmp'
+        snapshot = {
+            'version': SNAPSHOT_VERSION,
+            'folder_map': self.folder_map,
+            # One space-joined string instead of a quoted JSON array: smaller on
+            # disk, parsed without escapes and split() straight back into the set.
+            'copied_files': ' '.join(self.copied_files),
+            'frontier': self.frontier,
+            'done_folders': ' '.join(self.done_folders),
+            'file_versions': self.file_versions,
+            'changes_token': self.changes_token,
+            'failures': list(self._failures.values()),
+        }
+        with open(tmp_path, 'w') as f:
+            json.dump(snapshot, f, separators=(',', ':'))
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(tmp_path, self.path)
+        # Replaying a stale journal over the new snapshot is harmless, so a crash
+        # between the replace above and the truncate below loses nothing.
+        if self._journal is not None:
+            self._journal.close()
+            self._journal = None
+        open(self.journal_path, 'w').close()
+        self._journal_records = 0
+
+    def _set_failure(self, failure):
+        self._failures[failure['id']] = failure
+        self._failure_ids[(failure['kind'], failure['item_id'])] = failure['id']
+        self._next_failure_id = max(self._next_failure_id, failure['id'] + 1)
+
+    def _drop_failure(self, failure_id):
+        failure = self._failures.pop(failure_id, None)
+        if failure is not None:
+            self._failure_ids.pop((failure['kind'], failure['item_id']), None)
+        return failure
+
+    def add_failure(self, path, error, item_id=None, parent_id=None, reason=None, kind='file'):
+        """
+        Appends a failed item to the failure log and, when it can be retried
+        (item_id is known), queues it; an item already queued counts one more attempt.
+        """
+        log_failure(path, error, self.failure_log)
+        if item_id is None:
+            return
+        with self._lock:
+            failure = self._failures.get(self._failure_ids.get((kind, item_id)))
+            if failure is None:
+                failure = {'id': self._next_failure_id, 'kind': kind, 'item_id': item_id, 'attempts': 0}
+            failure.update(parent_id=parent_id, path=path, reason=reason, error=str(error),
+                           failed_at=datetime.now().isoformat(), attempts=failure['attempts'] + 1)
+            self._set_failure(failure)
+            self._append(f"X {json.dumps(failure)}\n")
+
+    def failure(self, item_id, kind='file'):
+        """Returns the queued failure of an item, or None."""
+        with self._lock:
+            failure = self._failures.get(self._failure_ids.get((kind, item_id)))
+            return dict(failure) if failure is not None else None
+
+    def failures(self, reason=None):
+        """Returns the queued failures as dicts, optionally only those with `reason`."""
+        with self._lock:
+            return [dict(failure) for _, failure in sorted(self._failures.items())
+                    if reason is None or failure['reason'] == reason]
+
+    def failure_counts(self):
+        """Returns {reason: count} for the queued failures."""
+        counts = {}
+        with self._lock:
+            for failure in self._failures.values():
+                reason = failure['reason'] or 'unknown'
+                counts[reason] = counts.get(reason, 0) + 1
+        return counts
+
+    def remove_failure(self, failure_id):
+        """Drops a failure from the queue, e.g. after the item was retried successfully."""
+        with self._lock:
+            if self._drop_failure(failure_id) is not None:
+                self._append(f"Y {failure_id}\n")
+
+    def clear_failures(self):
+        """Empties the failure queue."""
+        with self._lock:
+            self._failures.clear()
+            self._failure_ids.clear()
+            self._append("Z\n")
+
+    def close(self):
+        """Compacts the journal into the snapshot and releases the file handles."""
+        self.compact()
+        close_failure_log(self.failure_log)
+
+    def release(self):
+        """Releases the journal without compacting it, for a reader of a store another process may be writing."""
+        with self._lock:
+            if self._journal is not None:
+                self._journal.close()
+                self._journal = None
+
+
+_SCHEMA = """
+CREATE TABLE IF NOT EXISTS folders (
+    job TEXT NOT NULL,
+    source_id TEXT NOT NULL,
+    dest_id TEXT NOT NULL,
+    PRIMARY KEY (job, source_id)
+) WITHOUT ROWID;
+CREATE TABLE IF NOT EXISTS files (
+    job TEXT NOT NULL,
+    source_id TEXT NOT NULL,
+    PRIMARY KEY (job, source_id)
+) WITHOUT ROWID;
+CREATE TABLE IF NOT EXISTS frontier (
+    job TEXT NOT NULL,
+    source_id TEXT NOT NULL,
+    dest_id TEXT NOT NULL,
+    path TEXT NOT NULL,
+    page_token TEXT,
+    seq INTEGER NOT NULL,
+    PRIMARY KEY (job, source_id)
+) WITHOUT ROWID;
+CREATE TABLE IF NOT EXISTS done_folders (
+    job TEXT NOT NULL,
+    source_id TEXT NOT NULL,
+    PRIMARY KEY (job, source_id)
+) WITHOUT ROWID;
+CREATE TABLE IF NOT EXISTS file_versions (
+    job TEXT NOT NULL,
+    source_id TEXT NOT NULL,
+    dest_id TEXT,
+    fingerprint TEXT NOT NULL,
+    PRIMARY KEY (job, source_id)
+) WITHOUT ROWID;
+CREATE TABLE IF NOT EXISTS sync_state (
+    job TEXT PRIMARY KEY,
+    changes_token TEXT
+);
+CREATE TABLE IF NOT EXISTS failures (
+    id INTEGER PRIMARY KEY,
+    job TEXT NOT NULL,
+    kind TEXT NOT NULL,
+    item_id TEXT,
+    parent_id TEXT,
+    path TEXT,
+    reason TEXT,
+    error TEXT,
+    failed_at TEXT NOT NULL,
+    attempts INTEGER NOT NULL DEFAULT 1
+);
+CREATE INDEX IF NOT EXISTS frontier_by_seq ON frontier (job, seq);
+CREATE INDEX IF NOT EXISTS failures_by_reason ON failures (job, reason);
+CREATE INDEX IF NOT EXISTS failures_by_item ON failures (job, item_id);
+"""
+
+
+_FAILURE_COLUMNS = ('id', 'kind', 'item_id', 'parent_id', 'path', 'reason', 'error', 'failed_at', 'attempts')
+
+
+def _create_schema(conn):
+    """Creates the tables, adding the columns later versions introduced to an older database."""
+    conn.executescript(_SCHEMA)
+    columns = {row[1] for row in conn.execute("PRAGMA table_info(failures)")}
+    if 'attempts' not in columns:
+        conn.execute("ALTER TABLE failures ADD COLUMN attempts INTEGER NOT NULL DEFAULT 1")
+
+
+class _FolderMapView:
+    """Read-only dict-like view of the folders table, queried on demand."""
+
+    def __init__(self, store):
+        self._store = store
+
+    def get(self, source_id, default=None):
+        row = self._store._query_one(
+            "SELECT dest_id FROM folders WHERE job = ? AND source_id = ?", (self._store.job, source_id))
+        return row[0] if row else default
+
+    def __getitem__(self, source_id):
+        dest_id = self.get(source_id)
+        if dest_id is None:
+            raise KeyError(source_id)
+        return dest_id
+
+    def __contains__(self, source_id):
+        return self.get(source_id) is not None
+
+    def __len__(self):
+        return self._store._count('folders')
+
+    def items(self):
+        return self._store._query_all(
+            "SELECT source_id, dest_id FROM folders WHERE job = ?", (self._store.job,))
+
+
+class _CopiedFilesView:
+    """Read-only set-like view of the files table, queried on demand."""
+
+    def __init__(self, store):
+        self._store = store
+
+    def __contains__(self, source_id):
+        return self._store._query_one(
+            "SELECT 1 FROM files WHERE job = ? AND source_id = ?", (self._store.job, source_id)) is not None
+
+    def __len__(self):
+        return self._store._count('files')
+
+    def __iter__(self):
+        return (row[0] for row in self._store._query_all(
+            "SELECT source_id FROM files WHERE job = ?", (self._store.job,)))
+
+
+class _DoneFoldersView:
+    """Read-only set-like view of the done_folders table."""
+
+    def __init__(self, store):
+        self._store = store
+
+    def __contains__(self, source_id):
+        return self._store._query_one(
+            "SELECT 1 FROM done_folders WHERE job = ? AND source_id = ?", (self._store.job, source_id)) is not None
+
+
+class _FrontierView:
+    """Read-only view of the frontier table, for membership checks."""
+
+    def __init__(self, store):
+        self._store = store
+
+    def __contains__(self, source_id):
+        return self._store._query_one(
+            "SELECT 1 FROM frontier WHERE job = ? AND source_id = ?", (self._store.job, source_id)) is not None
+
+
+class SqliteProgressStore:
+    """
+    Progress of a copy job kept in SQLite (WAL mode), for multi-million-item forks.
+
+    Nothing is loaded up front: folder_map and copied_files are views that query
+    the indexed tables per lookup, and failures are rows that can be filtered by
+    reason. One database can hold many jobs, keyed by the `job` column.
+    """
+
+    def __init__(self, path, job=DEFAULT_JOB):
+        self.path = path
+        self.job = job
+        self.folder_map = _FolderMapView(self)
+        self.copied_files = _CopiedFilesView(self)
+        self.frontier = _FrontierView(self)
+        self.done_folders = _DoneFoldersView(self)
+        # Kept for interface parity with ProgressStore; failures live in the database.
+        self.failure_log = None
+        self.events = None
+        self._lock = threading.Lock()
+        self._counts = {}
+        self._uncommitted = 0
+        self._last_commit = time.monotonic()
+        self._conn = sqlite3.connect(path, check_same_thread=False, timeout=30)
+        self._conn.execute("PRAGMA journal_mode=WAL")
+        # In WAL mode NORMAL only skips the fsync per commit; it stays crash-consistent.
+        self._conn.execute("PRAGMA synchronous=NORMAL")
+        _create_schema(self._conn)
+        self._conn.commit()
+
+    def load(self):
+        """Nothing to replay: lookups go straight to the database."""
+        return self
+
+    def _query_one(self, sql, params):
+        with self._lock:
+            return self._conn.execute(sql, params).fetchone()
+
+    def _query_all(self, sql, params):
+        with self._lock:
+            return self._conn.execute(sql, params).fetchall()
+
+    def _count(self, table):
+        with self._lock:
+            if table not in self._counts:
+                self._counts[table] = self._conn.execute(
+                    f"SELECT COUNT(*) FROM {table} WHERE job = ?", (self.job,)).fetchone()[0]
+            return self._counts[table]
+
+    def _write(self, sql, params, table=None):
+        """Runs one statement, committing when a batch is due, and returns how many rows it changed."""
+        with self._lock:
+            cursor = self._conn.execute(sql, params)
+            if table in self._counts and cursor.rowcount > 0:
+                self._counts[table] += cursor.rowcount
+            self._uncommitted += 1
+            now = time.monotonic()
+            if self._uncommitted >= COMMIT_EVERY or now - self._last_commit >= COMMIT_INTERVAL:
+                self._commit(now)
+            return cursor.rowcount
+
+    def _commit(self, now=None):
+        self._conn.commit()
+        self._uncommitted = 0
+        self._last_commit = now or time.monotonic()
+
+    def add_folder(self, source_id, dest_id):
+        """Records a created (or mapped) destination folder."""
+        self._write("INSERT OR REPLACE INTO folders (job, source_id, dest_id) VALUES (?, ?, ?)",
+                    (self.job, source_id, dest_id))
+        # REPLACE can't tell an insert from an update, so recount on next len().
+        with self._lock:
+            self._counts.pop('folders', None)
+
+    def add_file(self, source_id, dest_id=None, fingerprint=None):
+        """Records a successfully copied file, with its copy's ID and source fingerprint if known."""
+        self._write("INSERT OR IGNORE INTO files (job, source_id) VALUES (?, ?)",
+                    (self.job, source_id), 'files')
+        if fingerprint is not None:
+            self._write("INSERT OR REPLACE INTO file_versions (job, source_id, dest_id, fingerprint) "
+                        "VALUES (?, ?, ?, ?)", (self.job, source_id, dest_id, fingerprint))
+
+    def file_version(self, source_id):
+        """Returns (dest_id, fingerprint) recorded for a copied file, or None."""
+        return self._query_one("SELECT dest_id, fingerprint FROM file_versions WHERE job = ? AND source_id = ?",
+                               (self.job, source_id))
+
+    def mapped_folders(self, after=None):
+        """Yields (source_id, dest_id) of every mapped folder in source ID order, after `after` if given."""
+        while True:
+            rows = self._query_all("SELECT source_id, dest_id FROM folders WHERE job = ? AND source_id > ? "
+                                   "ORDER BY source_id LIMIT ?", (self.job, after or '', FOLDER_PAGE_SIZE))
+            yield from rows
+            if len(rows) < FOLDER_PAGE_SIZE:
+                return
+            after = rows[-1][0]
+
+    @property
+    def changes_token(self):
+        """Where the next re-sync starts reading the Drive changes feed, if known."""
+        row = self._query_one("SELECT changes_token FROM sync_state WHERE job = ?", (self.job,))
+        return row[0] if row else None
+
+    def set_changes_token(self, page_token):
+        """Records where the next re-sync starts reading the Drive changes feed."""
+        self._write("INSERT OR REPLACE INTO sync_state (job, changes_token) VALUES (?, ?)", (self.job, page_token))
+
+    def reset_traversal(self):
+        """Forgets which folders are complete, so the next run walks the whole tree again."""
+        self._write("DELETE FROM frontier WHERE job = ?", (self.job,))
+        self._write("DELETE FROM done_folders WHERE job = ?", (self.job,))
+
+    def set_pending(self, source_id, dest_id, path, page_token=None):
+        """Records that a folder's contents must be copied, from page_token on."""
+        # Keep the original seq on updates so pending_folders() stays in traversal order.
+        self._write("INSERT INTO frontier (job, source_id, dest_id, path, page_token, seq) "
+                    "VALUES (?, ?, ?, ?, ?, (SELECT COALESCE(MAX(seq), 0) + 1 FROM frontier WHERE job = ?)) "
+                    "ON CONFLICT (job, source_id) DO UPDATE SET page_token = excluded.page_token",
+                    (self.job, source_id, dest_id, path, page_token, self.job))
+
+    def complete_folder(self, source_id):
+        """Records that every item directly in a folder has been copied."""
+        self._write("DELETE FROM frontier WHERE job = ? AND source_id = ?", (self.job, source_id))
+        self._write("INSERT OR IGNORE INTO done_folders (job, source_id) VALUES (?, ?)", (self.job, source_id))
+
+    def pending_folders(self):
+        """Returns the frontier as (source_id, dest_id, path, page_token) tuples, oldest first."""
+        return self._query_all("SELECT source_id, dest_id, path, page_token FROM frontier "
+                               "WHERE job = ? ORDER BY seq", (self.job,))
+
+    def has_pending(self):
+        """True while the frontier holds a folder."""
+        return self._query_one("SELECT 1 FROM frontier WHERE job = ? LIMIT 1", (self.job,)) is not None
+
+    def newest_pending(self, limit, skip=()):
+        """Returns up to `limit` frontier entries not in `skip`, newest first, like pending_folders()."""
+        rows = self._query_all("SELECT source_id, dest_id, path, page_token FROM frontier "
+                               "WHERE job = ? ORDER BY seq DESC LIMIT ?", (self.job, limit + len(skip)))
+        return [row for row in rows if row[0] not in skip][:limit]
+
+    def add_failure(self, path, error, item_id=None, parent_id=None, reason=None, kind='file'):
+        """
+        Records a failed item with enough context to retry it later; an item that
+        already failed before counts one more attempt instead of adding a row.
+        """
+        failed_at = datetime.now().isoformat()
+        if item_id is not None and self._write(
+                "UPDATE failures SET parent_id = ?, path = ?, reason = ?, error = ?, failed_at = ?, "
+                "attempts = attempts + 1 WHERE job = ? AND kind = ? AND item_id = ?",
+                (parent_id, path, reason, str(error), failed_at, self.job, kind, item_id)):
+            return
+        self._write("INSERT INTO failures (job, kind, item_id, parent_id, path, reason, error, failed_at) "
+                    "VALUES (?, ?, ?, ?, ?, ?, ?, ?)",
+                    (self.job, kind, item_id, parent_id, path, reason, str(error), failed_at))
+
+    def failure(self, item_id, kind='file'):
+        """Returns the recorded failure of an item, or None."""
+        row = self._query_one(f"SELECT {', '.join(_FAILURE_COLUMNS)} FROM failures "
+                              "WHERE job = ? AND item_id = ? AND kind = ?", (self.job, item_id, kind))
+        return dict(zip(_FAILURE_COLUMNS, row)) if row else None
+
+    def failures(self, reason=None):
+        """Returns this job's failures as dicts, optionally only those with `reason`."""
+        sql = f"SELECT {', '.join(_FAILURE_COLUMNS)} FROM failures WHERE job = ?"
+        params = (self.job,)
+        if reason is not None:
+            sql += " AND reason = ?"
+            params += (reason,)
+        return [dict(zip(_FAILURE_COLUMNS, row)) for row in self._query_all(sql + " ORDER BY id", params)]
+
+    def failure_counts(self):
+        """Returns {reason: count} for this job's failures."""
+        return dict(self._query_all(
+            "SELECT COALESCE(reason, 'unknown'), COUNT(*) FROM failures WHERE job = ? GROUP BY 1",
+            (self.job,)))
+
+    def remove_failure(self, failure_id):
+        """Deletes a failure row, e.g. after the item was retried successfully."""
+        self._write("DELETE FROM failures WHERE id = ?", (failure_id,))
+
+    def clear_failures(self):
+        """Deletes all of this job's failures, before a run that retries them anyway."""
+        self._write("DELETE FROM failures WHERE job = ?", (self.job,))
+
+    def compact(self):
+        """Commits pending writes."""
+        with self._lock:
+            self._commit()
+
+    def close(self):
+        """Commits pending writes and closes the database."""
+        with self._lock:
+            self._commit()
+            self._conn.close()
+        # Workers that crash outright still write to a failure log file.
+        close_failure_log(self.failure_log)
+
+    def release(self):
+        """Closes the database without touching the failure log, for a reader of another process' job."""
+        with self._lock:
+            self._commit()
+            self._conn.close()
+
+
+def fork_job(source_id, dest_id):
+    """Names the progress of the fork of source_id into dest_id: its SQLite job, and part of its JSON file name."""
+    return hashlib.sha256(f"{source_id}\0{dest_id}".encode('utf-8')).hexdigest()[:16]
+
+
+def fork_progress_path(source_id, dest_id, path=PROGRESS_FILE):
+    """Returns the JSON progress file of one fork: `path` with the fork's name before the extension."""
+    root, extension = os.path.splitext(path)
+    return f"{root}.{fork_job(source_id, dest_id)}{extension}"
+
+
+def is_sqlite_path(path):
+    return path.lower().endswith(SQLITE_EXTENSIONS)
+
+
+def load_progress(path=PROGRESS_FILE, job=DEFAULT_JOB, read_only=False):
+    """
+    Loads the progress for `path`: a SQLite database (by extension, holding
+    `job`) or a JSON snapshot plus journal. With `read_only`, for reading
+    progress another process may be writing, nothing on disk is changed, and
+    the store is let go of with release() rather than close().
+    """
+    if is_sqlite_path(path):
+        return SqliteProgressStore(path, job).load()
+    return ProgressStore(path).load(repair=not read_only)
+
+
+_FAILURE_LINE = re.compile(r"^\[(?P<at>[^\]]*)\] Path: (?P<path>.*?) \| Error: (?P<error>.*)$")
+# Failures the copy engine words as "<summary>: <Drive reason>".
+_FAILURE_REASON = re.compile(r"^(?:Permission error|Rate limit retries exhausted): (\w+)$")
+
+
+def _has_failure_queue(json_path):
+    """True unless the snapshot predates the failure queue (a journal alone is always newer)."""
+    if not os.path.exists(json_path):
+        return True
+    with open(json_path, 'r') as f:
+        snapshot = json.load(f)
+    return isinstance(snapshot.get('version'), int) and snapshot['version'] >= 5
+
+
+def migrate_json_to_sqlite(json_path, db_path, job=DEFAULT_JOB, failure_log=None):
+    """
+    Copies a JSON progress snapshot + journal with its failure queue into a
+    SQLite progress database; progress older than the failure queue has its
+    failure log imported instead, if given. Returns the number of folders and
+    files imported.
+    """
+    progress = ProgressStore(json_path).load()
+    conn = sqlite3.connect(db_path)
+    conn.execute("PRAGMA journal_mode=WAL")
+    _create_schema(conn)
+    with conn:
+        conn.executemany("INSERT OR REPLACE INTO folders (job, source_id, dest_id) VALUES (?, ?, ?)",
+                         ((job, src, dst) for src, dst in progress.folder_map.items()))
+        conn.executemany("INSERT OR IGNORE INTO files (job, source_id) VALUES (?, ?)",
+                         ((job, source_id) for source_id in progress.copied_files))
+        conn.executemany("INSERT OR REPLACE INTO frontier (job, source_id, dest_id, path, page_token, seq) "
+                         "VALUES (?, ?, ?, ?, ?, ?)",
+                         ((job, src, dst, path, page_token, seq) for seq, (src, dst, path, page_token)
+                          in enumerate(progress.pending_folders(), 1)))
+        conn.executemany("INSERT OR IGNORE INTO done_folders (job, source_id) VALUES (?, ?)",
+                         ((job, source_id) for source_id in progress.done_folders))
+        conn.executemany("INSERT OR REPLACE INTO file_versions (job, source_id, dest_id, fingerprint) "
+                         "VALUES (?, ?, ?, ?)",
+                         ((job, source_id) + progress.file_version(source_id) for source_id in progress.file_versions))
+        if progress.changes_token:
+            conn.execute("INSERT OR REPLACE INTO sync_state (job, changes_token) VALUES (?, ?)",
+                         (job, progress.changes_token))
+        conn.executemany("INSERT INTO failures (job, kind, item_id, parent_id, path, reason, error, failed_at, "
+                         "attempts) VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)",
+                         ((job, f['kind'], f['item_id'], f['parent_id'], f['path'], f['reason'], f['error'],
+                           f['failed_at'], f['attempts']) for f in progress.failures()))
+        # Once there is a failure queue, the log is only history: its failures are
+        # queued, or have been retried since.
+        if failure_log and os.path.exists(failure_log) and not _has_failure_queue(json_path):
+            with open(failure_log, 'r') as f:
+                for line in f:
+                    match = _FAILURE_LINE.match(line.rstrip('\n'))
+                    if not match:
+                        continue
+                    reason = _FAILURE_REASON.match(match['error'])
+                    reason = reason[1] if reason else None
+                    # The log doesn't say what failed or where it was going, so
+                    # these rows are for reporting only and are never retried.
+                    conn.execute("INSERT INTO failures (job, kind, path, reason, error, failed_at) "
+                                 "VALUES (?, 'unknown', ?, ?, ?, ?)",
+                                 (job, match['path'], reason, match['error'], match['at']))
+    conn.close()
+    return len(progress.folder_map), len(progress.copied_files)
+
+
+def save_progress(progress):
+    """Saves the current progress as a compact snapshot."""
+    progress.compact()
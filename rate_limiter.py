@@ -0,0 +1,137 @@
+import time
+import random
+import threading
+
+# Requests per second a fresh limiter starts at, and the range it may move in.
+# Drive's default per-user quota works out to a little over 200 requests/s.
+INITIAL_RATE = 10.0
+MIN_RATE = 0.5
+MAX_RATE = 200.0
+# Added to the rate for every second's worth of successful requests.
+ADDITIVE_INCREASE = 1.0
+# Until the first rate limit is seen, the rate doubles every second's worth of
+# successes (slow start) instead of creeping up additively.
+SLOW_START = True
+# Multiplier applied to the rate when Drive reports a rate limit.
+MULTIPLICATIVE_DECREASE = 0.5
+# Rate-limit errors within this many seconds of a decrease don't decrease again;
+# they come from requests that were already in flight at the old rate.
+DECREASE_WINDOW = 1.0
+# Seconds of unused rate that may be spent as an immediate burst.
+BURST_SECONDS = 1.0
+# Backoff for throttled requests that carry no Retry-After header.
+BACKOFF_BASE = 1.0
+BACKOFF_CAP = 64.0
+
+
+class RateLimiter:
+    """
+    Paces Drive requests with a token bucket whose rate adapts AIMD-style.
+
+    The rate doubles per second of successes until Drive first pushes back, then
+    every success nudges it up additively; a rate-limit response halves it
+    (once per DECREASE_WINDOW, so a burst of errors counts once) and pauses all
+    callers for the server-supplied Retry-After, or a jittered exponential backoff.
+    """
+
+    def __init__(self, initial_rate=INITIAL_RATE, min_rate=MIN_RATE, max_rate=MAX_RATE):
+        self.min_rate = min_rate
+        self.max_rate = max_rate
+        self._rate = initial_rate
+        self._lock = threading.Lock()
+        # Time at which the next request may start (virtual scheduling clock).
+        self._next_slot = time.monotonic()
+        self._paused_until = 0.0
+        self._last_decrease = 0.0
+        self._slow_start = SLOW_START
+        self.successes = 0
+        self.throttles = 0
+
+    @property
+    def rate(self):
+        """Current target rate in requests per second."""
+        return self._rate
+
+    def acquire(self, cost=1):
+        """Blocks until `cost` requests may be sent (a batch costs one per call)."""
+        with self._lock:
+            now = time.monotonic()
+            slot = max(self._next_slot, now - BURST_SECONDS, self._paused_until)
+            self._next_slot = slot + cost / self._rate
+        delay = slot - now
+        if delay > 0:
+            time.sleep(delay)
+
+    def delay(self):
+        """
+        Seconds a request sent now would wait, negative while unused burst is
+        left; the lowest marks the least busy of several limiters.
+        """
+        with self._lock:
+            now = time.monotonic()
+            return max(self._next_slot, now - BURST_SECONDS, self._paused_until) - now
+
+    def on_success(self, count=1):
+        """Raises the rate after requests went through."""
+        with self._lock:
+            self.successes += count
+            if self._slow_start:
+                self._rate = min(self.max_rate, self._rate + count)
+            else:
+                self._rate = min(self.max_rate, self._rate + ADDITIVE_INCREASE * count / self._rate)
+
+    def on_throttle(self, retry_after=None, attempt=0):
+        """
+        Backs off after a rate-limit response and returns the pause in seconds.
+
+        `retry_after` is the server's Retry-After value when it sent one; otherwise
+        the pause is a full-jitter exponential backoff based on `attempt`.
+        """
+        if retry_after is None:
+            delay = random.uniform(0, min(BACKOFF_CAP, BACKOFF_BASE * (2 ** attempt)))
+        else:
+            delay = retry_after
+        with self._lock:
+            now = time.monotonic()
+            self.throttles += 1
+            self._slow_start = False
+            if now >= self._last_decrease + DECREASE_WINDOW:
+                self._rate = max(self.min_rate, self._rate * MULTIPLICATIVE_DECREASE)
+                self._last_decrease = now
+            self._paused_until = max(self._paused_until, now + delay)
+        return delay
+
+    def stats(self):
+        """Snapshot of the limiter state for monitoring."""
+        with self._lock:
+            return {
+                'rate': round(self._rate, 2),
+                'paused_for': round(max(0.0, self._paused_until - time.monotonic()), 2),
+                'successes': self.successes,
+                'throttles': self.throttles,
+            }
+
+
+_limiters = {}
+_limiters_lock = threading.Lock()
+
+
+def get_limiter(key='default'):
+    """Returns the process-wide limiter for `key`, creating it on first use."""
+    with _limiters_lock:
+        if key not in _limiters:
+            _limiters[key] = RateLimiter()
+        return _limiters[key]
+
+
+def drop_limiter(key):
+    """Forgets the limiter for `key`, once nothing sends requests under it any more."""
+    with _limiters_lock:
+        _limiters.pop(key, None)
+
+
+def all_limiters():
+    """Returns a {key: stats} snapshot of every limiter in the process."""
+    with _limiters_lock:
+        limiters = dict(_limiters)
+    return {key: limiter.stats() for key, limiter in limiters.items()}
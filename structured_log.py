@@ -0,0 +1,119 @@
+import os
+import sys
+import json
+import queue
+import atexit
+import logging
+import threading
+import logging.handlers
+from datetime import datetime, timezone
+
+# Level and format of the log written to stderr; main.py can override both.
+LOG_LEVEL = os.environ.get('DRIVE_FORKER_LOG_LEVEL', 'INFO')
+# 'json' writes one object per line; 'text' is easier on the eyes in a terminal.
+LOG_FORMAT = os.environ.get('DRIVE_FORKER_LOG_FORMAT', 'json')
+LOG_FORMATS = ('json', 'text')
+# Seconds between the aggregated progress lines of a running fork.
+PROGRESS_INTERVAL = 10.0
+ROOT_LOGGER = 'drive_forker'
+
+# Attributes every LogRecord has; anything else was passed with extra= and becomes a field.
+_RECORD_ATTRS = set(vars(logging.LogRecord('', 0, '', 0, '', (), None))) | {'message', 'asctime'}
+_listener = None
+_configure_lock = threading.Lock()
+
+
+def get_logger(name):
+    """Returns the logger of one module, e.g. get_logger('drive_copy')."""
+    return logging.getLogger(f"{ROOT_LOGGER}.{name}")
+
+
+def _fields(record):
+    return {key: value for key, value in vars(record).items() if key not in _RECORD_ATTRS}
+
+
+class JsonFormatter(logging.Formatter):
+    """One JSON object per record: time, level, logger, message and the extra= fields."""
+
+    def format(self, record):
+        entry = {
+            'ts': datetime.fromtimestamp(record.created, timezone.utc).isoformat(timespec='milliseconds'),
+            'level': record.levelname,
+            'logger': record.name,
+            'msg': record.getMessage(),
+        }
+        entry.update(_fields(record))
+        return json.dumps(entry, default=str)
+
+
+class TextFormatter(logging.Formatter):
+    """`time LEVEL message key=value ...` for reading in a terminal."""
+
+    def format(self, record):
+        fields = ' '.join(f"{key}={value}" for key, value in _fields(record).items())
+        return (f"{datetime.fromtimestamp(record.created).strftime('%H:%M:%S')} {record.levelname:<7} "
+                f"{record.getMessage()}{' ' + fields if fields else ''}")
+
+
+def configure_logging(level=None, fmt=None, stream=None):
+    """
+    Sends every drive_forker.* logger to `stream` (stderr by default) at `level`.
+
+    Records are handed to a queue and written by a background thread, so the
+    copy threads never wait on the console; the queue is drained at exit.
+    Calling it again only changes the level.
+    """
+    global _listener
+    logger = logging.getLogger(ROOT_LOGGER)
+    logger.setLevel((level or LOG_LEVEL).upper())
+    with _configure_lock:
+        if _listener is not None:
+            return logger
+        handler = logging.StreamHandler(stream or sys.stderr)
+        handler.setFormatter(TextFormatter() if (fmt or LOG_FORMAT) == 'text' else JsonFormatter())
+        records = queue.SimpleQueue()
+        logger.addHandler(logging.handlers.QueueHandler(records))
+        logger.propagate = False
+        _listener = logging.handlers.QueueListener(records, handler)
+        _listener.start()
+        atexit.register(_listener.stop)
+    return logger
+
+
+class ProgressReporter:
+    """
+    Logs a fork's aggregated progress (the ProgressEvents counts, files/s and
+    ETA) at info level every `interval` seconds, and once more when stopped, so
+    the per-item messages can stay at debug level.
+    """
+
+    def __init__(self, events, logger, interval=PROGRESS_INTERVAL):
+        self.events = events
+        self.logger = logger
+        self.interval = interval
+        self._seq = 0
+        self._stop = threading.Event()
+        self._thread = threading.Thread(target=self._run, name='progress-log', daemon=True)
+
+    def start(self):
+        self._thread.start()
+        return self
+
+    def _run(self):
+        while not self._stop.wait(self.interval):
+            self.report()
+
+    def report(self):
+        update = self.events.update(self._seq)
+        self._seq = update['seq']
+        self.logger.info("progress", extra={
+            **update['counts'],
+            'elapsed_seconds': update['elapsed_seconds'],
+            'files_per_second': update['files_per_second'],
+            'eta_seconds': update['eta_seconds'],
+        })
+
+    def stop(self):
+        self._stop.set()
+        self._thread.join()
+        self.report()
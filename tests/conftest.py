@@ -0,0 +1,29 @@
+import os
+import sys
+
+import pytest
+
+# The modules live at the top of the repository, next to this directory, and
+# the fake Drive the tests run against next to the benchmarks that use it.
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+sys.path.insert(0, os.path.join(ROOT, 'benchmarks'))
+
+from fake_drive import FakeDrive  # noqa: E402
+from progress_store import close_failure_log, load_progress  # noqa: E402
+
+
+@pytest.fixture
+def drive():
+    return FakeDrive()
+
+
+@pytest.fixture
+def progress(tmp_path, monkeypatch):
+    """A fork's progress in a fresh JSON store, its failure log next to it."""
+    monkeypatch.chdir(tmp_path)
+    progress = load_progress(str(tmp_path / 'progress.json'))
+    progress.failure_log = str(tmp_path / 'failed.log')
+    yield progress
+    progress.close()
+    close_failure_log(progress.failure_log)
@@ -0,0 +1,53 @@
+from google.oauth2.credentials import Credentials
+
+from drive_client import TransportPool, identity_label, limiter_for, user_limiter
+from rate_limiter import all_limiters, get_limiter
+
+
+def credentials(user):
+    return Credentials(token='token', refresh_token=f'refresh-{user}', client_id='client', client_secret='secret',
+                       token_uri='https://oauth2.example/token')
+
+
+def test_users_get_their_own_limiter():
+    alice, bob = credentials('alice'), credentials('bob')
+    user_limiter(alice).on_throttle(retry_after=5)
+    assert user_limiter(alice) is not user_limiter(bob)
+    assert user_limiter(bob).stats()['paused_for'] == 0
+    # Another Credentials object from the same session is the same user.
+    assert user_limiter(credentials('alice')) is user_limiter(alice)
+
+
+def test_limiter_for_transport_without_credentials_is_default():
+    class Transport:
+        pass
+
+    transport = Transport()
+    assert limiter_for(transport) is get_limiter()
+    transport.credentials = credentials('carol')
+    assert limiter_for(transport) is user_limiter(transport.credentials)
+
+
+def test_transports_are_reused_and_share_credentials():
+    pool = TransportPool()
+    first = pool.acquire(credentials('dave'))
+    pool.release(first)
+    second = pool.acquire(credentials('dave'))
+    assert second is first
+    assert pool.acquire(credentials('dave')).credentials is first.credentials
+
+
+def test_idle_users_are_let_go():
+    pool = TransportPool(idle_timeout=10)
+    erin, frank = credentials('erin'), credentials('frank')
+    pool.release(pool.acquire(erin))
+    held = pool.acquire(frank)
+    user_limiter(erin)
+    pool.sweep(now=pool._last_used[next(iter(pool._last_used))] + 5)
+    assert len(pool._credentials) == 2
+    pool.sweep(now=max(pool._last_used.values()) + 60)
+    # Frank's transport is still out, so only Erin is forgotten, limiter and all.
+    assert list(pool._credentials.values()) == [held.credentials]
+    assert identity_label(erin) not in all_limiters()
+    pool.release(held)
+    assert pool.acquire(frank) is held
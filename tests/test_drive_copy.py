@@ -0,0 +1,328 @@
+import socket
+import threading
+
+import pytest
+from google.oauth2.credentials import Credentials
+
+import rate_limiter
+from drive_copy import (BATCH_SIZE, MAX_RETRIES, SOURCE_PROPERTY, CopyPool, FolderCheckpoint, copy_file,
+                        copy_files_batched, copy_folder_contents, fork_folder)
+from fake_drive import FOLDER_MIME_TYPE, FakeDrive, drive_error
+from progress_store import close_failure_log, load_progress
+
+
+@pytest.fixture(autouse=True)
+def unlimited(monkeypatch):
+    """Fresh rate limiters that never hold a call back, so backoffs cost the tests no time."""
+    monkeypatch.setattr(rate_limiter, '_limiters', {})
+    monkeypatch.setattr(rate_limiter.RateLimiter, 'acquire', lambda self, cost=1: None)
+
+
+@pytest.fixture
+def credentials():
+    return Credentials(token='token', refresh_token='refresh', client_id='client', client_secret='secret',
+                       token_uri='https://oauth2.example/token')
+
+
+@pytest.fixture
+def dest(drive):
+    return drive.add('dest', FOLDER_MIME_TYPE)
+
+
+def copies(drive, dest):
+    """Source IDs of the files copied anywhere under dest, once per copy."""
+    found, stack = [], [dest]
+    while stack:
+        for child_id in drive.children[stack.pop()]:
+            item = drive.items[child_id]
+            if item['mimeType'] == FOLDER_MIME_TYPE:
+                stack.append(child_id)
+            else:
+                found.append(item['appProperties'][SOURCE_PROPERTY])
+    return found
+
+
+def fail_copies(drive, errors):
+    """Makes files.copy of the IDs in `errors` raise the errors queued for them, one per call."""
+    copy = drive._copy
+
+    def failing(file_id, body):
+        if errors.get(file_id):
+            raise errors[file_id].pop(0)
+        return copy(file_id, body)
+
+    drive._copy = failing
+
+
+# --- copy_file ---
+
+def test_copy_file_records_the_copy(drive, progress, dest):
+    file_id = drive.add('a.txt', 'text/plain')
+    assert copy_file(drive, file_id, dest, progress, 'a.txt', 'fingerprint')
+    [copy_id] = drive.children[dest]
+    assert drive.items[copy_id]['appProperties'] == {SOURCE_PROPERTY: file_id}
+    assert progress.file_version(file_id) == (copy_id, 'fingerprint')
+
+
+@pytest.mark.parametrize('error, reason', [
+    (drive_error(500, 'backendError'), 'backendError'),
+    (drive_error(403, 'cannotCopyFile'), 'cannotCopyFile'),
+    (socket.timeout('timed out'), 'TimeoutError'),
+])
+def test_copy_file_queues_failures(drive, progress, dest, error, reason):
+    file_id = drive.add('a.txt', 'text/plain')
+    fail_copies(drive, {file_id: [error]})
+    assert not copy_file(drive, file_id, dest, progress, 'a.txt')
+    [failure] = progress.failures()
+    assert (failure['item_id'], failure['parent_id'], failure['reason']) == (file_id, dest, reason)
+
+
+def test_copy_file_retries_rate_limits(drive, progress, dest):
+    file_id = drive.add('a.txt', 'text/plain')
+    fail_copies(drive, {file_id: [drive_error(429, 'rateLimitExceeded')] * MAX_RETRIES})
+    assert copy_file(drive, file_id, dest, progress, 'a.txt')
+    assert progress.failures() == []
+
+
+def test_copy_file_gives_up_on_rate_limits(drive, progress, dest):
+    file_id = drive.add('a.txt', 'text/plain')
+    fail_copies(drive, {file_id: [drive_error(403, 'userRateLimitExceeded')] * (MAX_RETRIES + 1)})
+    assert not copy_file(drive, file_id, dest, progress, 'a.txt')
+    assert [failure['reason'] for failure in progress.failures()] == ['userRateLimitExceeded']
+
+
+def test_copy_file_hands_uncopyable_files_to_the_fallback(drive, progress, dest):
+    file_id = drive.add('a.txt', 'text/plain')
+    drive.uncopyable.add(file_id)
+    handed = []
+    assert copy_file(drive, file_id, dest, progress, 'a.txt', 'fingerprint',
+                     fallback=lambda *args: handed.append(args))
+    assert handed == [(file_id, dest, 'a.txt', 'fingerprint', None)]
+    assert progress.failures() == []
+
+
+# --- copy_files_batched ---
+
+def batch_of(drive, dest, count):
+    return [(drive.add(f"file{n}.txt", 'text/plain'), dest, f"file{n}.txt", None, None) for n in range(count)]
+
+
+def test_batched_copies_go_in_batches(drive, progress, dest):
+    files = batch_of(drive, dest, BATCH_SIZE + 5)
+    assert copy_files_batched(drive, files, progress)
+    assert drive.round_trips['batch'] == 2
+    assert sorted(copies(drive, dest)) == sorted(file[0] for file in files)
+
+
+def test_only_rate_limited_sub_requests_are_sent_again(drive, progress, dest):
+    files = batch_of(drive, dest, 10)
+    throttled = [file[0] for file in files[:3]]
+    fail_copies(drive, {file_id: [drive_error(403, 'userRateLimitExceeded')] for file_id in throttled})
+    drive.uncopyable.add(files[3][0])
+    assert not copy_files_batched(drive, files, progress)
+    # Ten copies, then the three throttled ones again; the uncopyable one isn't retried.
+    assert drive.calls['files.copy'] == 13
+    assert drive.round_trips['batch'] == 2
+    assert sorted(copies(drive, dest)) == sorted(file[0] for file in files if file is not files[3])
+    assert [(failure['item_id'], failure['reason']) for failure in progress.failures()] == \
+        [(files[3][0], 'cannotCopyFile')]
+
+
+def test_batched_copies_give_up_on_rate_limits(drive, progress, dest):
+    files = batch_of(drive, dest, 3)
+    fail_copies(drive, {files[0][0]: [drive_error(429, 'rateLimitExceeded')] * (MAX_RETRIES + 1)})
+    assert not copy_files_batched(drive, files, progress)
+    assert drive.round_trips['batch'] == MAX_RETRIES + 1
+    assert [(failure['item_id'], failure['reason']) for failure in progress.failures()] == \
+        [(files[0][0], 'rateLimitExceeded')]
+    assert files[1][0] in progress.copied_files and files[2][0] in progress.copied_files
+
+
+# --- CopyPool ---
+
+def test_copy_pool_runs_work_concurrently(credentials):
+    pool = CopyPool(credentials, workers=4)
+    # Only passed once all four workers are in it at the same time.
+    together = threading.Barrier(4)
+    results = []
+
+    def work(n, http=None):
+        together.wait(5)
+        return n
+
+    for n in range(8):
+        pool.submit(work, n, callback=results.append)
+    pool.close()
+    assert sorted(results) == list(range(8))
+
+
+def test_copy_pool_gives_each_worker_its_own_transport(credentials):
+    pool = CopyPool(credentials, workers=3)
+    seen, lock = {}, threading.Lock()
+    barrier = threading.Barrier(3)
+
+    def work(http=None):
+        barrier.wait(5)
+        with lock:
+            seen.setdefault(threading.current_thread().name, set()).add(id(http))
+
+    for _ in range(3):
+        pool.submit(work)
+    pool.close()
+    assert len(seen) == 3
+    assert all(len(https) == 1 for https in seen.values())
+    assert len({https.pop() for https in seen.values()}) == 3
+
+
+def test_copy_pool_reports_work_that_raised(credentials, tmp_path):
+    failure_log = str(tmp_path / 'failed.log')
+    pool = CopyPool(credentials, workers=2, failure_log=failure_log)
+    results = []
+
+    def broken(http=None):
+        raise RuntimeError("worker bug")
+
+    pool.submit(broken, callback=results.append, label='a.txt')
+    pool.close()
+    close_failure_log(failure_log)
+    assert results == [False]
+    with open(failure_log) as f:
+        assert 'a.txt' in f.read()
+
+
+def test_copy_pool_bounds_its_queue(credentials):
+    pool = CopyPool(credentials, workers=1, queue_size=2)
+    release = threading.Event()
+    pool.submit(lambda http=None: release.wait(5))
+    pool.submit(lambda http=None: None)
+    blocked = threading.Thread(target=pool.submit, args=(lambda http=None: None,))
+    blocked.start()
+    blocked.join(0.2)
+    assert blocked.is_alive()
+    release.set()
+    blocked.join(5)
+    assert not blocked.is_alive()
+    pool.close()
+
+
+# --- FolderCheckpoint ---
+
+def test_checkpoint_advances_past_finished_pages_only(progress):
+    checkpoint = FolderCheckpoint(progress, 'src', 'dst', 'folder')
+    first = checkpoint.start_page(None, 'page2')
+    checkpoint.add(first)
+    checkpoint.page_queued(first)
+    second = checkpoint.start_page('page2', None)
+    checkpoint.add(second)
+    checkpoint.page_queued(second)
+    # The second page's copy finishing first moves nothing.
+    checkpoint.done(second)
+    assert 'src' not in progress.frontier
+    checkpoint.done(first)
+    assert progress.frontier['src'] == ('dst', 'folder', None)
+    checkpoint.finish()
+    assert 'src' not in progress.frontier
+    assert 'src' in progress.done_folders
+
+
+def test_checkpoint_keeps_a_page_with_a_failed_copy(progress):
+    progress.set_pending('src', 'dst', 'folder')
+    checkpoint = FolderCheckpoint(progress, 'src', 'dst', 'folder')
+    first = checkpoint.start_page(None, 'page2')
+    checkpoint.add(first)
+    checkpoint.page_queued(first)
+    checkpoint.done(first, False)
+    second = checkpoint.start_page('page2', None)
+    checkpoint.page_queued(second)
+    checkpoint.finish()
+    # Listed again from the first page next run; its copied files are skipped then.
+    assert progress.frontier['src'] == ('dst', 'folder', None)
+    assert 'src' not in progress.done_folders
+
+
+def test_checkpoint_moves_to_the_next_page(progress):
+    checkpoint = FolderCheckpoint(progress, 'src', 'dst', 'folder')
+    first = checkpoint.start_page(None, 'page2')
+    checkpoint.page_queued(first)
+    assert progress.frontier['src'] == ('dst', 'folder', 'page2')
+
+
+# --- Whole trees ---
+
+def test_copy_folder_contents_copies_the_tree(drive, progress, dest, credentials):
+    root = drive.build_tree(depth=2, width=2, files=5)
+    pool = CopyPool(credentials, workers=4)
+    copy_folder_contents(drive, root, dest, progress, pool=pool)
+    pool.close()
+    assert drive.snapshot(dest) == drive.snapshot(root)
+    folders, files = drive.tree_size(root)
+    assert len(progress.done_folders) == folders
+    assert not progress.has_pending()
+    assert drive.calls['files.copy'] == files
+
+
+def test_an_interrupted_walk_resumes_where_it_stopped(tmp_path, monkeypatch):
+    monkeypatch.chdir(tmp_path)
+    drive = FakeDrive(max_page_size=3)
+    root = drive.build_tree(depth=2, width=2, files=7)
+    dest = drive.add('dest', FOLDER_MIME_TYPE)
+    path = str(tmp_path / 'progress.json')
+    _, files = drive.tree_size(root)
+
+    def interrupt(method):
+        if method == 'files.copy' and drive.calls['files.copy'] == files // 2:
+            raise RuntimeError("interrupted")
+
+    drive.before_call = interrupt
+    progress = load_progress(path)
+    with pytest.raises(RuntimeError):
+        copy_folder_contents(drive, root, dest, progress)
+    progress.close()
+    drive.before_call = None
+
+    progress = load_progress(path)
+    # The folder being copied resumes from the page it stopped in.
+    assert any(page_token is not None for _, _, page_token in progress.frontier.values())
+    done_before = set(progress.done_folders)
+    assert done_before
+    listed, list_folder = set(), drive._list
+
+    def listing(parent, page_token, page_size):
+        listed.add(parent)
+        return list_folder(parent, page_token, page_size)
+
+    drive._list = listing
+    copy_folder_contents(drive, root, dest, progress)
+    progress.close()
+    assert drive.snapshot(dest) == drive.snapshot(root)
+    # No file was copied twice, and no finished folder listed again.
+    assert drive.calls['files.copy'] == files
+    assert len(copies(drive, dest)) == files
+    assert not listed & done_before
+
+
+def test_an_interrupted_fork_resumes(tmp_path, monkeypatch, credentials):
+    monkeypatch.chdir(tmp_path)
+    drive = FakeDrive()
+    root = drive.build_tree(depth=3, width=2, files=4)
+    dest = drive.add('dest', FOLDER_MIME_TYPE)
+    path = str(tmp_path / 'progress.json')
+
+    def interrupt(method):
+        if method == 'files.create' and drive.calls['files.create'] == 5:
+            raise RuntimeError("interrupted")
+
+    drive.before_call = interrupt
+    progress = load_progress(path)
+    with pytest.raises(RuntimeError):
+        fork_folder(drive, credentials, root, dest, progress, workers=4, dedup=False)
+    progress.close()
+    drive.before_call = None
+
+    progress = load_progress(path)
+    assert progress.has_pending()
+    fork_folder(drive, credentials, root, dest, progress, workers=4, dedup=False)
+    assert not progress.has_pending()
+    progress.close()
+    assert drive.snapshot(dest) == drive.snapshot(root)
+    assert len(copies(drive, dest)) == drive.tree_size(root)[1]
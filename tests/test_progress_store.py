@@ -0,0 +1,306 @@
+import os
+import json
+
+import pytest
+
+from progress_store import (JOURNAL_SUFFIX, SNAPSHOT_VERSION, ProgressStore, SqliteProgressStore, close_failure_log,
+                            load_progress, migrate_json_to_sqlite)
+
+
+@pytest.fixture
+def progress_path(tmp_path, monkeypatch):
+    # Failures also go to a log file, relative to the working directory by default.
+    monkeypatch.chdir(tmp_path)
+    return str(tmp_path / 'progress.json')
+
+
+def open_store(path):
+    """A store that never compacts on its own, so everything stays in the journal."""
+    progress = ProgressStore(path, compact_every=10 ** 6).load()
+    progress.failure_log = path + '.failed.log'
+    return progress
+
+
+def release(progress):
+    """Closes the journal without compacting it, as a killed process would leave it."""
+    if progress._journal is not None:
+        progress._journal.close()
+    close_failure_log(progress.failure_log)
+
+
+def write_snapshot(path, snapshot, **dump):
+    with open(path, 'w') as f:
+        json.dump(snapshot, f, **dump)
+
+
+def record_some_progress(progress):
+    progress.add_folder('root', 'dest-root')
+    progress.add_folder('a', 'dest-a')
+    progress.add_file('f1')
+    progress.add_file('f2', 'copy-f2', '2024-01-01T00:00:00.000Z|abc|7')
+    progress.set_pending('a', 'dest-a', 'root/a b', 'token-2')
+    progress.set_pending('root', 'dest-root', 'root')
+    progress.complete_folder('root')
+    progress.set_changes_token('changes-9')
+    progress.add_failure('root/a b/f3', 'Rate limit retries exhausted: userRateLimitExceeded', 'f3', 'dest-a',
+                         'userRateLimitExceeded')
+    progress.add_failure('root/a b/f3', 'backendError', 'f3', 'dest-a', 'backendError')
+    progress.add_failure('root/a b/f4', 'cannotCopyFile', 'f4', 'dest-a', 'cannotCopyFile')
+    progress.remove_failure(progress.failure('f4')['id'])
+
+
+def assert_recorded(progress):
+    assert progress.folder_map == {'root': 'dest-root', 'a': 'dest-a'}
+    assert progress.copied_files == {'f1', 'f2'}
+    assert progress.file_version('f1') is None
+    assert progress.file_version('f2') == ('copy-f2', '2024-01-01T00:00:00.000Z|abc|7')
+    assert progress.pending_folders() == [('a', 'dest-a', 'root/a b', 'token-2')]
+    assert progress.done_folders == {'root'}
+    assert progress.changes_token == 'changes-9'
+    [failure] = progress.failures()
+    assert (failure['item_id'], failure['parent_id'], failure['reason'], failure['attempts']) == \
+        ('f3', 'dest-a', 'backendError', 2)
+    assert progress.failure('f4') is None
+
+
+# --- Journal replay ---
+
+def test_journal_replays_every_record(progress_path):
+    progress = open_store(progress_path)
+    record_some_progress(progress)
+    release(progress)
+    assert not os.path.exists(progress_path)
+
+    assert_recorded(open_store(progress_path))
+
+
+def test_journal_replays_on_top_of_the_snapshot(progress_path):
+    progress = open_store(progress_path)
+    progress.add_folder('root', 'dest-root')
+    progress.add_file('f1')
+    progress.set_pending('root', 'dest-root', 'root')
+    progress.compact()
+    progress.add_file('f2')
+    progress.complete_folder('root')
+    release(progress)
+
+    progress = open_store(progress_path)
+    assert progress.copied_files == {'f1', 'f2'}
+    assert not progress.has_pending()
+    assert progress.done_folders == {'root'}
+
+
+def test_journal_reset_and_cleared_failures(progress_path):
+    progress = open_store(progress_path)
+    record_some_progress(progress)
+    progress.reset_traversal()
+    progress.clear_failures()
+    release(progress)
+
+    progress = open_store(progress_path)
+    assert not progress.has_pending()
+    assert progress.done_folders == set()
+    assert progress.failures() == []
+    # Only the walk and the queue are forgotten, not what was copied.
+    assert progress.copied_files == {'f1', 'f2'}
+
+
+def test_close_compacts_the_journal(progress_path):
+    progress = open_store(progress_path)
+    record_some_progress(progress)
+    progress.close()
+    assert os.path.getsize(progress_path + JOURNAL_SUFFIX) == 0
+    with open(progress_path) as f:
+        assert json.load(f)['version'] == SNAPSHOT_VERSION
+
+    assert_recorded(open_store(progress_path))
+
+
+# --- Torn last line ---
+
+def test_torn_last_line_is_dropped(progress_path):
+    progress = open_store(progress_path)
+    record_some_progress(progress)
+    release(progress)
+    journal = progress_path + JOURNAL_SUFFIX
+    intact = os.path.getsize(journal)
+    with open(journal, 'a') as f:
+        # A process killed halfway through appending a record.
+        f.write('F f9 copy-f9 2024-01-0')
+
+    progress = open_store(progress_path)
+    assert_recorded(progress)
+    assert 'f9' not in progress.copied_files
+    assert os.path.getsize(journal) == intact
+
+    # The next record starts on a line of its own and survives the next load.
+    progress.add_file('f5')
+    release(progress)
+    progress = open_store(progress_path)
+    assert progress.copied_files == {'f1', 'f2', 'f5'}
+
+
+def test_torn_failure_record_is_dropped(progress_path):
+    progress = open_store(progress_path)
+    progress.add_file('f1')
+    release(progress)
+    with open(progress_path + JOURNAL_SUFFIX, 'a') as f:
+        f.write('X {"id": 1, "kind": "file", "item_id": "f2", "att')
+
+    progress = open_store(progress_path)
+    assert progress.copied_files == {'f1'}
+    assert progress.failures() == []
+
+
+def test_read_only_load_changes_nothing_on_disk(progress_path):
+    progress = open_store(progress_path)
+    record_some_progress(progress)
+    release(progress)
+    journal = progress_path + JOURNAL_SUFFIX
+    with open(journal, 'a') as f:
+        # Another process halfway through appending a record.
+        f.write('F f9')
+    with open(journal, 'rb') as f:
+        before = f.read()
+
+    progress = load_progress(progress_path, read_only=True)
+    assert_recorded(progress)
+    progress.release()
+
+    with open(journal, 'rb') as f:
+        assert f.read() == before
+    assert not os.path.exists(progress_path)
+
+
+# --- Snapshot versions ---
+
+SNAPSHOTS = {
+    # The old indented dict with a JSON list of copied files, and no version.
+    1: ({'folder_map': {'root': 'dest-root', 'a': 'dest-a'}, 'copied_files': ['f1', 'f2']}, {'indent': 4}),
+    2: ({'version': 2, 'folder_map': {'root': 'dest-root', 'a': 'dest-a'}, 'copied_files': 'f1 f2'}, {}),
+    3: ({'version': 3, 'folder_map': {'root': 'dest-root', 'a': 'dest-a'}, 'copied_files': 'f1 f2',
+         'frontier': {'a': ['dest-a', 'root/a', None]}, 'done_folders': 'root'}, {}),
+    4: ({'version': 4, 'folder_map': {'root': 'dest-root', 'a': 'dest-a'}, 'copied_files': 'f1 f2',
+         'frontier': {'a': ['dest-a', 'root/a', None]}, 'done_folders': 'root',
+         'file_versions': {'f2': 'copy-f2 2024-01-01T00:00:00.000Z|abc|7'}, 'changes_token': 'changes-9'}, {}),
+    5: ({'version': 5, 'folder_map': {'root': 'dest-root', 'a': 'dest-a'}, 'copied_files': 'f1 f2',
+         'frontier': {'a': ['dest-a', 'root/a', None]}, 'done_folders': 'root',
+         'file_versions': {'f2': 'copy-f2 2024-01-01T00:00:00.000Z|abc|7'}, 'changes_token': 'changes-9',
+         'failures': [{'id': 3, 'kind': 'file', 'item_id': 'f3', 'parent_id': 'dest-a', 'path': 'root/a/f3',
+                       'reason': 'backendError', 'error': 'backendError', 'failed_at': '2024-01-01T00:00:00',
+                       'attempts': 2}]}, {}),
+}
+
+
+@pytest.mark.parametrize('version', sorted(SNAPSHOTS))
+def test_snapshot_version_loads(progress_path, version):
+    snapshot, dump = SNAPSHOTS[version]
+    write_snapshot(progress_path, snapshot, **dump)
+
+    progress = open_store(progress_path)
+    assert progress.folder_map == {'root': 'dest-root', 'a': 'dest-a'}
+    assert progress.copied_files == {'f1', 'f2'}
+    if version >= 3:
+        assert progress.pending_folders() == [('a', 'dest-a', 'root/a', None)]
+        assert progress.done_folders == {'root'}
+    else:
+        assert not progress.has_pending()
+    if version >= 4:
+        assert progress.file_version('f2') == ('copy-f2', '2024-01-01T00:00:00.000Z|abc|7')
+        assert progress.changes_token == 'changes-9'
+    else:
+        assert progress.file_version('f2') is None
+        assert progress.changes_token is None
+    if version >= 5:
+        assert [(f['id'], f['item_id'], f['attempts']) for f in progress.failures()] == [(3, 'f3', 2)]
+        # New failures are numbered after the loaded ones.
+        progress.add_failure('root/a/f4', 'backendError', 'f4', 'dest-a', 'backendError')
+        assert progress.failure('f4')['id'] == 4
+    else:
+        assert progress.failures() == []
+
+
+@pytest.mark.parametrize('version', sorted(SNAPSHOTS))
+def test_snapshot_version_is_rewritten_as_current(progress_path, version):
+    snapshot, dump = SNAPSHOTS[version]
+    write_snapshot(progress_path, snapshot, **dump)
+    progress = open_store(progress_path)
+    progress.add_file('f5')
+    progress.close()
+
+    with open(progress_path) as f:
+        assert json.load(f)['version'] == SNAPSHOT_VERSION
+    progress = open_store(progress_path)
+    assert progress.copied_files == {'f1', 'f2', 'f5'}
+    assert progress.folder_map == {'root': 'dest-root', 'a': 'dest-a'}
+
+
+# --- JSON to SQLite migration ---
+
+def test_migration_copies_the_failure_queue(progress_path, tmp_path):
+    progress = open_store(progress_path)
+    record_some_progress(progress)
+    progress.add_failure('root/a b', 'backendError', 'a', 'dest-a', 'backendError', kind='listing')
+    expected = progress.failures()
+    progress.close()
+    db_path = str(tmp_path / 'progress.db')
+
+    assert migrate_json_to_sqlite(progress_path, db_path, job='fork') == (2, 2)
+
+    progress = SqliteProgressStore(db_path, 'fork').load()
+    try:
+        fields = ('kind', 'item_id', 'parent_id', 'path', 'reason', 'error', 'failed_at', 'attempts')
+        assert [{key: f[key] for key in fields} for f in progress.failures()] == \
+            [{key: f[key] for key in fields} for f in expected]
+        assert progress.failure('a', 'listing')['reason'] == 'backendError'
+        assert progress.failure_counts() == {'backendError': 2}
+        assert progress.folder_map['a'] == 'dest-a'
+        assert 'f2' in progress.copied_files
+        assert progress.file_version('f2') == ('copy-f2', '2024-01-01T00:00:00.000Z|abc|7')
+        assert progress.pending_folders() == [('a', 'dest-a', 'root/a b', 'token-2')]
+        assert 'root' in progress.done_folders
+        assert progress.changes_token == 'changes-9'
+        # A failure seen again counts another attempt on the migrated row.
+        progress.add_failure('root/a b/f3', 'backendError', 'f3', 'dest-a', 'backendError')
+        assert progress.failure('f3')['attempts'] == 3
+    finally:
+        progress.close()
+
+
+def test_migration_imports_the_failure_log_of_older_progress(progress_path, tmp_path):
+    snapshot, dump = SNAPSHOTS[4]
+    write_snapshot(progress_path, snapshot, **dump)
+    failure_log = str(tmp_path / 'failed_files.log')
+    with open(failure_log, 'w') as f:
+        f.write("[2024-01-01T00:00:00] Path: root/a/f3 | Error: Rate limit retries exhausted: userRateLimitExceeded\n"
+                "[2024-01-01T00:00:01] Path: root/a/f4 | Error: <HttpError 500>\n"
+                "not a failure line\n")
+    db_path = str(tmp_path / 'progress.db')
+
+    migrate_json_to_sqlite(progress_path, db_path, failure_log=failure_log)
+
+    progress = SqliteProgressStore(db_path).load()
+    try:
+        assert [(f['kind'], f['item_id'], f['path'], f['reason']) for f in progress.failures()] == [
+            ('unknown', None, 'root/a/f3', 'userRateLimitExceeded'),
+            ('unknown', None, 'root/a/f4', None),
+        ]
+    finally:
+        progress.close()
+
+
+def test_migration_ignores_the_failure_log_once_there_is_a_queue(progress_path, tmp_path):
+    snapshot, dump = SNAPSHOTS[5]
+    write_snapshot(progress_path, snapshot, **dump)
+    failure_log = str(tmp_path / 'failed_files.log')
+    with open(failure_log, 'w') as f:
+        f.write("[2024-01-01T00:00:00] Path: root/a/f3 | Error: backendError\n")
+    db_path = str(tmp_path / 'progress.db')
+
+    migrate_json_to_sqlite(progress_path, db_path, failure_log=failure_log)
+
+    progress = SqliteProgressStore(db_path).load()
+    try:
+        assert [(f['kind'], f['item_id'], f['attempts']) for f in progress.failures()] == [('file', 'f3', 2)]
+    finally:
+        progress.close()
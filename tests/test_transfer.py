@@ -0,0 +1,108 @@
+import hashlib
+import threading
+
+import pytest
+
+from fake_drive import FOLDER_MIME_TYPE, FakeUpload
+from transfer import CHUNK_SIZE, GOOGLE_DOC, StreamingUpload, transfer_file
+
+CHUNK = 1024
+
+
+def download(drive, file_id, size, chunksize=CHUNK):
+    """A StreamingUpload reading `file_id` through the fake's media endpoint."""
+    return StreamingUpload(drive.files().get_media(fileId=file_id), 'text/plain', size, chunksize=chunksize)
+
+
+def test_chunks_are_read_in_order_and_released(drive):
+    size = 3 * CHUNK + 500
+    file_id = drive.add('big.bin', 'text/plain', size=size)
+    media = download(drive, file_id, size)
+    data = b''
+    while media.position < size:
+        data += media.getbytes(media.position, CHUNK)
+        # The chunk being sent, the next one and at most one more.
+        assert len(media._buffer) <= 3 * CHUNK
+    assert data == drive._read(file_id, 0, size - 1)
+    assert drive.bytes_downloaded == size
+
+
+def test_a_resent_chunk_comes_from_the_buffer(drive):
+    file_id = drive.add('big.bin', 'text/plain', size=4 * CHUNK)
+    media = download(drive, file_id, 4 * CHUNK)
+    media.getbytes(0, CHUNK)
+    second = media.getbytes(CHUNK, CHUNK)
+    downloaded = drive.bytes_downloaded
+    # Drive asks for the chunk again, e.g. after a dropped connection.
+    assert media.getbytes(CHUNK, CHUNK) == second
+    assert drive.bytes_downloaded == downloaded
+
+
+def test_resuming_before_the_buffer_fails(drive):
+    file_id = drive.add('big.bin', 'text/plain', size=4 * CHUNK)
+    media = download(drive, file_id, 4 * CHUNK)
+    media.getbytes(0, CHUNK)
+    media.getbytes(CHUNK, CHUNK)
+    with pytest.raises(ValueError):
+        media.getbytes(0, CHUNK)
+
+
+def test_export_size_is_known_once_the_rest_fits(drive):
+    doc_id = drive.add('notes', GOOGLE_DOC)
+    media = StreamingUpload(drive.files().export_media(fileId=doc_id, mimeType='application/pdf'),
+                            'application/pdf', method='files.export')
+    exported = f"{doc_id} exported as application/pdf".encode('utf-8')
+    assert media.size() == len(exported)
+    assert media.getbytes(0, CHUNK) == exported
+
+
+def test_transfer_file_streams_in_chunks(drive, progress):
+    size = 2 * CHUNK_SIZE + CHUNK_SIZE // 2
+    dest = drive.add('dest', FOLDER_MIME_TYPE)
+    file_id = drive.add('big.bin', 'application/octet-stream', size=size)
+    assert transfer_file(drive, file_id, dest, progress, 'big.bin')
+    copy = drive.items[drive.children[dest][0]]
+    assert copy['size'] == str(size)
+    assert copy['md5Checksum'] == drive.items[file_id]['md5Checksum']
+    assert drive.calls['files.upload'] == 3
+    assert file_id in progress.copied_files
+
+
+@pytest.mark.parametrize('export_format, name, mime_type', [
+    ('native', 'notes', GOOGLE_DOC),
+    ('office', 'notes.docx', 'application/vnd.openxmlformats-officedocument.wordprocessingml.document'),
+])
+def test_transfer_file_exports_google_files(drive, progress, export_format, name, mime_type):
+    dest = drive.add('dest', FOLDER_MIME_TYPE)
+    doc_id = drive.add('notes', GOOGLE_DOC)
+    assert transfer_file(drive, doc_id, dest, progress, 'notes', export_format=export_format)
+    copy = drive.items[drive.children[dest][0]]
+    assert (copy['name'], copy['mimeType']) == (name, mime_type)
+
+
+def test_a_restarted_upload_is_queued_for_retry(drive, progress, monkeypatch):
+    dest = drive.add('dest', FOLDER_MIME_TYPE)
+    file_id = drive.add('big.bin', 'application/octet-stream', size=2 * CHUNK_SIZE + 1)
+    send = FakeUpload._send
+
+    def restart(upload):
+        # Drive lost the upload: it asks for the file from the start.
+        if upload.progress == 2 * CHUNK_SIZE:
+            upload.progress, upload._md5 = 0, hashlib.md5()
+        return send(upload)
+
+    monkeypatch.setattr(FakeUpload, '_send', restart)
+    assert not transfer_file(drive, file_id, dest, progress, 'big.bin')
+    [failure] = progress.failures()
+    assert (failure['item_id'], failure['parent_id'], failure['reason']) == (file_id, dest, 'ValueError')
+    assert file_id not in progress.copied_files
+
+
+def test_a_stopped_transfer_leaves_the_file(drive, progress):
+    dest = drive.add('dest', FOLDER_MIME_TYPE)
+    file_id = drive.add('big.bin', 'application/octet-stream', size=CHUNK)
+    stop = threading.Event()
+    stop.set()
+    assert not transfer_file(drive, file_id, dest, progress, 'big.bin', stop=stop)
+    assert drive.children[dest] == []
+    assert progress.failures() == []
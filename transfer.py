@@ -0,0 +1,239 @@
+import threading
+from functools import partial
+
+from googleapiclient.errors import HttpError
+from googleapiclient.http import MediaIoBaseDownload, MediaUpload
+
+import metrics
+from drive_client import ShardedHttp
+from drive_copy import (ALL_DRIVES, SOURCE_PROPERTY, TRANSPORT_ERRORS, CopyPool, count_copy, execute_request,
+                        record_failure, trash_file)
+from progress_events import emit
+from structured_log import get_logger
+
+# Bytes moved per download request and per upload request. Resumable uploads
+# need a multiple of 256 KiB; a transfer holds about three chunks in memory.
+CHUNK_SIZE = 8 * 1024 * 1024
+# Concurrent streamed transfers, on threads of their own so a few large files
+# never hold up the server-side copies.
+TRANSFER_WORKERS = 2
+# Transfers that may wait for a worker; a copy worker handing over one more blocks.
+TRANSFER_QUEUE = 256
+
+GOOGLE_APPS_PREFIX = 'application/vnd.google-apps.'
+GOOGLE_DOC = 'application/vnd.google-apps.document'
+GOOGLE_SHEET = 'application/vnd.google-apps.spreadsheet'
+GOOGLE_SLIDES = 'application/vnd.google-apps.presentation'
+GOOGLE_DRAWING = 'application/vnd.google-apps.drawing'
+GOOGLE_SCRIPT = 'application/vnd.google-apps.script'
+PDF = ('application/pdf', '.pdf')
+# What Google Docs, Sheets, ... are exported as, per --export-format: (MIME type, file extension).
+EXPORT_FORMATS = {
+    'office': {
+        GOOGLE_DOC: ('application/vnd.openxmlformats-officedocument.wordprocessingml.document', '.docx'),
+        GOOGLE_SHEET: ('application/vnd.openxmlformats-officedocument.spreadsheetml.sheet', '.xlsx'),
+        GOOGLE_SLIDES: ('application/vnd.openxmlformats-officedocument.presentationml.presentation', '.pptx'),
+        GOOGLE_DRAWING: PDF,
+        GOOGLE_SCRIPT: ('application/vnd.google-apps.script+json', '.json'),
+    },
+    'opendocument': {
+        GOOGLE_DOC: ('application/vnd.oasis.opendocument.text', '.odt'),
+        GOOGLE_SHEET: ('application/vnd.oasis.opendocument.spreadsheet', '.ods'),
+        GOOGLE_SLIDES: ('application/vnd.oasis.opendocument.presentation', '.odp'),
+        GOOGLE_DRAWING: PDF,
+        GOOGLE_SCRIPT: ('application/vnd.google-apps.script+json', '.json'),
+    },
+    'pdf': {GOOGLE_DOC: PDF, GOOGLE_SHEET: PDF, GOOGLE_SLIDES: PDF, GOOGLE_DRAWING: PDF},
+}
+# 'native' exports to Office and has Drive convert the upload back into a Google
+# Doc, Sheet or Slides; the other types stay in their Office export format.
+NATIVE = 'native'
+NATIVE_TYPES = {GOOGLE_DOC, GOOGLE_SHEET, GOOGLE_SLIDES}
+EXPORT_FORMAT_NAMES = (NATIVE,) + tuple(EXPORT_FORMATS)
+DEFAULT_EXPORT_FORMAT = NATIVE
+
+log = get_logger('transfer')
+
+
+def export_target(mime_type, export_format=DEFAULT_EXPORT_FORMAT):
+    """
+    Returns (export MIME type, extension, uploaded MIME type) for a Google file,
+    or None if it can't be exported (Forms, Sites, Maps, ...). The extension is
+    None when the upload is converted back into a Google file.
+    """
+    export_type = EXPORT_FORMATS['office' if export_format == NATIVE else export_format].get(mime_type)
+    if export_type is None:
+        return None
+    if export_format == NATIVE and mime_type in NATIVE_TYPES:
+        return export_type[0], None, mime_type
+    return export_type[0], export_type[1], export_type[0]
+
+
+class _Step:
+    """One chunk of a transfer, sent through execute_request() like any other call."""
+
+    def __init__(self, method, fn):
+        self.methodId = method
+        self.fn = fn
+
+    def execute(self, http=None):
+        return self.fn()
+
+
+class StreamingUpload(MediaUpload):
+    """
+    A resumable upload whose bytes come from a chunked download of the source.
+
+    The download runs only as far ahead as the upload needs, so a transfer holds
+    the chunk being sent (kept until it's acknowledged, in case it has to be sent
+    again), the next one and at most one more downloaded chunk, whatever the file
+    size, and nothing is written to disk. Exports are an exception Drive makes:
+    it sends them whole, up to its 10 MB export limit.
+    """
+
+    def __init__(self, request, mimetype, size=None, chunksize=CHUNK_SIZE, method='files.get_media', http=None):
+        self._mimetype = mimetype
+        self._size = size
+        self._chunksize = chunksize
+        self._method = method
+        # Only for the rate limiter: the download sends on the request's own transport.
+        self._http = http
+        self._download = MediaIoBaseDownload(self, request, chunksize)
+        self._done = False
+        self._buffer = bytearray()
+        # File offset of the first buffered byte.
+        self._offset = 0
+        # Bytes handed to the upload so far.
+        self.position = 0
+
+    def write(self, data):
+        """Called by the download with each chunk it receives."""
+        self._buffer.extend(data)
+
+    def _fill(self, end):
+        while not self._done and self._offset + len(self._buffer) < end:
+            _, self._done = execute_request(_Step(self._method, self._download.next_chunk), self._http)
+
+    def chunksize(self):
+        return self._chunksize
+
+    def mimetype(self):
+        return self._mimetype
+
+    def size(self):
+        """
+        The source's size, or for an export the total once the rest fits in one
+        chunk, so the last chunk is sent as such even if it is exactly full.
+        """
+        if self._size is None:
+            self._fill(self.position + self._chunksize + 1)
+            if self._done:
+                return self._offset + len(self._buffer)
+        return self._size
+
+    def resumable(self):
+        return True
+
+    def has_stream(self):
+        return False
+
+    def getbytes(self, begin, length):
+        if begin < self._offset:
+            raise ValueError(f"Upload restarted at byte {begin}, which was already released")
+        del self._buffer[:begin - self._offset]
+        self._offset = begin
+        # One byte more tells a last full chunk apart from one with more to come.
+        self._fill(begin + length + 1)
+        data = bytes(self._buffer[:length])
+        self.position = begin + len(data)
+        return data
+
+    def to_json(self):
+        raise NotImplementedError("A streamed upload can't be serialized")
+
+
+def transfer_file(service, item_id, dest_folder_id, progress, current_path, fingerprint=None, replace_id=None,
+                  export_format=DEFAULT_EXPORT_FORMAT, stop=None, http=None):
+    """
+    Copies a file files().copy refused by streaming it through this process:
+    a chunked download (or export, for Google files) feeding a resumable upload.
+    Returns whether it succeeded; like copy_file(), failures are recorded and
+    replace_id is trashed once the copy exists. Stops between chunks once `stop`
+    is set, leaving the file for the next run.
+    """
+    if isinstance(http, ShardedHttp):
+        # A download and a resumable upload each stay with the identity that started them.
+        http = http.pin()
+    try:
+        source = execute_request(service.files().get(fileId=item_id, fields='name, mimeType, size', **ALL_DRIVES),
+                                 http)
+        body = {'name': source['name'], 'parents': [dest_folder_id], 'appProperties': {SOURCE_PROPERTY: item_id}}
+        if source['mimeType'].startswith(GOOGLE_APPS_PREFIX):
+            target = export_target(source['mimeType'], export_format)
+            if target is None:
+                log.warning("File can't be exported", extra={'path': current_path, 'mime_type': source['mimeType']})
+                record_failure(progress, current_path, f"No export format for {source['mimeType']}",
+                               item_id, dest_folder_id, 'cannotExportFile')
+                return False
+            media_type, extension, body['mimeType'] = target
+            if extension and not body['name'].endswith(extension):
+                body['name'] += extension
+            request = service.files().export_media(fileId=item_id, mimeType=media_type)
+            size, method = None, 'files.export'
+        else:
+            media_type = body['mimeType'] = source['mimeType']
+            request = service.files().get_media(fileId=item_id, **ALL_DRIVES)
+            size, method = int(source.get('size', 0)), 'files.get_media'
+        if http is not None:
+            # The download sends its chunks on the request's own transport.
+            request.http = http
+        media = StreamingUpload(request, media_type, size, method=method, http=http)
+        upload = service.files().create(body=body, media_body=media, fields='id, size', **ALL_DRIVES)
+        new_file = None
+        while new_file is None:
+            if stop is not None and stop.is_set():
+                log.info("Transfer interrupted", extra={'path': current_path})
+                return False
+            _, new_file = execute_request(_Step('files.create', partial(upload.next_chunk, http=http)), http)
+    except (HttpError, ValueError, *TRANSPORT_ERRORS) as e:
+        # ValueError: the upload resumed from bytes the stream had already let
+        # go of; the retry starts the transfer over.
+        log.error("Failed to transfer file", extra={'path': current_path, 'error': str(e)})
+        record_failure(progress, current_path, e, item_id, dest_folder_id)
+        return False
+    progress.add_file(item_id, new_file['id'], fingerprint)
+    count_copy(new_file)
+    metrics.bytes_transferred.inc(media.position)
+    emit(progress, 'copied', current_path)
+    log.debug("Transferred", extra={'path': current_path, 'bytes': media.position})
+    if replace_id:
+        trash_file(service, replace_id, progress, current_path, http)
+    return True
+
+
+class TransferPool(CopyPool):
+    """
+    The workers streaming the files Drive won't copy server-side (see
+    transfer_file()), apart from the copy workers and with a queue of their own.
+    """
+
+    def __init__(self, credentials, workers=TRANSFER_WORKERS, failure_log=None,
+                 export_format=DEFAULT_EXPORT_FORMAT):
+        super().__init__(credentials, workers, failure_log, name='transfer-worker', queue=metrics.transfer_queue,
+                         queue_size=TRANSFER_QUEUE)
+        self.export_format = export_format
+        self._stop = threading.Event()
+
+    def transfer(self, service, item_id, dest_folder_id, progress, current_path, fingerprint=None, replace_id=None,
+                 callback=None):
+        """Queues transfer_file() for one file; callback gets its result."""
+        log.debug("Streaming file Drive won't copy", extra={'path': current_path})
+        self.submit(partial(transfer_file, export_format=self.export_format, stop=self._stop), service, item_id,
+                    dest_folder_id, progress, current_path, fingerprint, replace_id, callback=callback,
+                    label=current_path)
+
+    def close(self, cancel=False):
+        """Waits for the transfers, or with `cancel` stops the running ones after their current chunk."""
+        if cancel:
+            self._stop.set()
+        super().close(cancel)
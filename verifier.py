@@ -0,0 +1,255 @@
+import os
+import json
+import threading
+from datetime import datetime
+from functools import partial
+
+from googleapiclient.errors import HttpError
+
+from drive_copy import (DEFAULT_WORKERS, DEST_LIST_FIELDS, FOLDER_MIME_TYPE, LIST_FIELDS, SHORTCUT_MIME_TYPE,
+                        SOURCE_PROPERTY, TRANSPORT_ERRORS, CopyPool, list_pages)
+from structured_log import get_logger
+from transfer import GOOGLE_APPS_PREFIX
+
+# Where `main.py --verify` writes the differences it finds, one JSON line each,
+# with the fork's name before the extension (progress_store.fork_progress_path()).
+VERIFY_REPORT = 'verify_report.jsonl'
+VERIFY_VERSION = 1
+# Folders compared ahead of the oldest one still being compared; their results
+# wait in memory until they can be written to the report in order.
+VERIFY_WINDOW = 256
+# missing: a source item without a copy; extra: a destination item that copies
+# nothing in the source; mismatched: a copy differing in name, type, size or
+# md5Checksum; unlisted: a folder pair that could not be listed, so wasn't compared.
+PROBLEMS = ('missing', 'extra', 'mismatched', 'unlisted')
+
+log = get_logger('verifier')
+
+
+def item_kind(item):
+    """'folder', 'shortcut' or 'file': what a copy of the item has to be too."""
+    if item['mimeType'] == FOLDER_MIME_TYPE:
+        return 'folder'
+    return 'shortcut' if item['mimeType'] == SHORTCUT_MIME_TYPE else 'file'
+
+
+def compare_items(source, copy):
+    """
+    Returns the fields a copy differs from its source item in; empty if it matches.
+    A streamed Google file is exported under another type, with the export's
+    extension added to its name, and has no size or checksum to compare.
+    """
+    fields = []
+    if item_kind(source) != item_kind(copy):
+        fields.append('mimeType')
+    exported = source['mimeType'] != copy['mimeType'] and source['mimeType'].startswith(GOOGLE_APPS_PREFIX)
+    if copy['name'] != source['name'] and not (exported and copy['name'].startswith(source['name'])):
+        fields.append('name')
+    if 'md5Checksum' in source:
+        fields.extend(field for field in ('size', 'md5Checksum') if copy.get(field) != source.get(field))
+    return fields
+
+
+def compare_folder(service, progress, source_id, dest_id, http=None):
+    """
+    Lists a source folder and its copy and returns (items compared, problems).
+
+    Each source item is matched to its copy by the ID the fork recorded for it,
+    then by the source ID stamped on copies (SOURCE_PROPERTY), then by name; the
+    copy's folder is held in memory while the source is read page by page.
+    """
+    problems = []
+    where = {'folder': source_id, 'dest_folder': dest_id}
+    copies, by_source, by_name = {}, {}, {}
+    items = 0
+    try:
+        for response in list_pages(service, dest_id, fields=DEST_LIST_FIELDS, http=http):
+            for copy in response.get('files', []):
+                copies[copy['id']] = copy
+                stamped = (copy.get('appProperties') or {}).get(SOURCE_PROPERTY)
+                if stamped:
+                    by_source.setdefault(stamped, copy['id'])
+                by_name.setdefault(copy['name'], []).append(copy['id'])
+        for response in list_pages(service, source_id, fields=LIST_FIELDS, http=http):
+            for item in response.get('files', []):
+                items += 1
+                kind = item_kind(item)
+                if kind == 'folder':
+                    recorded = progress.folder_map.get(item['id'])
+                else:
+                    version = progress.file_version(item['id'])
+                    recorded = version[0] if version else None
+                copy = copies.pop(recorded, None) if recorded else None
+                if copy is None:
+                    copy = copies.pop(by_source.get(item['id']), None)
+                if copy is None:
+                    copy = next((copies.pop(copy_id) for copy_id in by_name.get(item['name'], ())
+                                 if copy_id in copies), None)
+                if copy is None:
+                    failure = progress.failure(item['id'], kind)
+                    problems.append({'problem': 'missing', **where, 'id': item['id'], 'name': item['name'],
+                                     'mimeType': item['mimeType'], 'failure': failure and failure['reason']})
+                    continue
+                fields = compare_items(item, copy)
+                if fields:
+                    problems.append({'problem': 'mismatched', **where, 'id': item['id'], 'dest_id': copy['id'],
+                                     'name': item['name'], 'fields': fields,
+                                     'source': {field: item.get(field) for field in fields},
+                                     'dest': {field: copy.get(field) for field in fields}})
+    except (HttpError, *TRANSPORT_ERRORS) as e:
+        log.error("Could not list folder pair", extra={**where, 'error': str(e)})
+        return items, [{'problem': 'unlisted', **where, 'error': str(e)}]
+    problems.extend({'problem': 'extra', **where, 'dest_id': copy['id'], 'name': copy['name'],
+                     'mimeType': copy['mimeType']} for copy in copies.values())
+    return items, problems
+
+
+class VerifyReport:
+    """
+    The report of a verification pass: a header line, one JSON line per problem
+    found, and a checkpoint line with the running counts after each run of
+    folders compared in source ID order.
+
+    Folders are compared concurrently but written in order, so an interrupted
+    pass resumes after the last checkpoint; anything written after it is cut
+    off first. A finished report is started over.
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self.counts = dict.fromkeys(('folders', 'items') + PROBLEMS, 0)
+        # The last source folder written out; the pass resumes after it.
+        self.after = None
+        self._results = {}
+        self._next = self._reserved = 0
+        self._cond = threading.Condition()
+        offset = self._resume_offset()
+        if offset is None:
+            self._file = open(path, 'w')
+            self._write({'verify': VERIFY_VERSION, 'started_at': datetime.now().isoformat()})
+        else:
+            with open(path, 'r+b') as f:
+                f.truncate(offset)
+            self._file = open(path, 'a')
+
+    def _resume_offset(self):
+        """Reads an unfinished report's last checkpoint and returns where it ends, or None to start over."""
+        if not os.path.exists(self.path):
+            return None
+        offset = checkpoint = None
+        with open(self.path, 'rb') as f:
+            try:
+                if json.loads(f.readline()).get('verify') != VERIFY_VERSION:
+                    return None
+                offset = f.tell()
+                for line in iter(f.readline, b''):
+                    record = json.loads(line)
+                    if 'summary' in record:
+                        return None
+                    if 'verified' in record:
+                        checkpoint, offset = record, f.tell()
+            except ValueError:
+                # A torn last line: it is past the last checkpoint and cut off.
+                pass
+        if checkpoint is not None:
+            self.after, self.counts = checkpoint['verified'], checkpoint['counts']
+        return offset
+
+    def _write(self, record):
+        self._file.write(json.dumps(record) + '\n')
+
+    def reserve(self):
+        """Returns the position of the next folder, blocking while VERIFY_WINDOW folders wait to be written."""
+        with self._cond:
+            while self._reserved - self._next >= VERIFY_WINDOW:
+                self._cond.wait()
+            self._reserved += 1
+            return self._reserved - 1
+
+    def done(self, position, source_id, result):
+        """Takes a folder's compare_folder() result (False if it raised) and writes what is now in order."""
+        if not result:
+            result = (0, [{'problem': 'unlisted', 'folder': source_id, 'error': "Comparison failed, see the log"}])
+        with self._cond:
+            self._results[position] = (source_id, result)
+            if self._next not in self._results:
+                return
+            while self._next in self._results:
+                source_id, (items, problems) = self._results.pop(self._next)
+                for problem in problems:
+                    self._write(problem)
+                    self.counts[problem['problem']] += 1
+                self.counts['folders'] += 1
+                self.counts['items'] += items
+                self.after = source_id
+                self._next += 1
+            self._write({'verified': self.after, 'counts': self.counts})
+            self._file.flush()
+            self._cond.notify_all()
+
+    def finish(self):
+        """Writes the summary line, closes the report and returns the summary."""
+        summary = dict(self.counts, finished_at=datetime.now().isoformat())
+        self._write({'summary': summary})
+        self.close()
+        return summary
+
+    def close(self):
+        self._file.close()
+
+
+def verify_fork(service, credentials, progress, report_path=VERIFY_REPORT, workers=DEFAULT_WORKERS):
+    """
+    Compares every folder of a fork (progress.folder_map) with its copy, `workers`
+    folder pairs at a time, and returns the counts of items compared and of the
+    problems found (see PROBLEMS), each of which is written to the report at
+    `report_path` (see VerifyReport). An interrupted pass started again with the
+    same report resumes where it stopped.
+
+    Missing items that are in the failure queue carry the reason they failed.
+    Only one destination folder's listing is held at a time per worker, so the
+    pass runs in constant memory however large the tree.
+    """
+    report = VerifyReport(report_path)
+    if report.after is not None:
+        log.info("Resuming verification", extra={'folders': report.counts['folders'], 'report': report_path})
+    pool = CopyPool(credentials, workers, progress.failure_log, name='verify-worker')
+    try:
+        for source_id, dest_id in progress.mapped_folders(report.after):
+            pool.submit(compare_folder, service, progress, source_id, dest_id,
+                        callback=partial(report.done, report.reserve(), source_id), label=source_id)
+        pool.wait()
+        summary = report.finish()
+    except BaseException:
+        pool.close(cancel=True)
+        report.close()
+        raise
+    pool.close()
+    log.info("Verification finished", extra={key: summary[key] for key in ('folders', 'items') + PROBLEMS})
+    return summary
+
+
+def report_problems(report_path):
+    """Yields the problems in a verification report, as it stands, one dict at a time."""
+    with open(report_path, 'r') as f:
+        for line in f:
+            try:
+                record = json.loads(line)
+            except ValueError:
+                # The line being written right now.
+                return
+            if 'problem' in record:
+                yield record
+
+
+def format_verification(summary):
+    """Returns the verification summary as lines of text for the console."""
+    lines = [
+        f"Folders:      {summary['folders']} compared, {summary['items']} items",
+        f"Missing:      {summary['missing']} source items have no copy",
+        f"Extra:        {summary['extra']} destination items copy nothing in the source",
+        f"Mismatched:   {summary['mismatched']} copies differ in name, type, size or checksum",
+    ]
+    if summary['unlisted']:
+        lines.append(f"Unlisted:     {summary['unlisted']} folders could not be listed and weren't compared")
+    return lines